@@ -0,0 +1,128 @@
+"""
+Resumable bulk generation jobs. A job file lists one item per line, either a plain prompt or a JSON object
+    {"prompt": "a photograph of an astronaut riding a horse", "seed": 42, "steps": 50, "scale": 7.5, "id": "a1"}
+where everything but the prompt is optional, and is streamed rather than read into memory. Finished items are
+appended to a manifest, and a restarted job skips everything the manifest lists as done.
+"""
+import os
+import json
+import threading
+
+
+class JobItem(object):
+    """One sample of a job, missing fields are taken from defaults (seed, steps and scale)."""
+    def __init__(self, id, prompt, seed, steps, scale):
+        self.id = id
+        self.prompt = prompt
+        self.seed = seed
+        self.steps = steps
+        self.scale = scale
+
+    @property
+    def name(self):
+        """File name of the output, without extension."""
+        return f"{self.id:08}" if isinstance(self.id, int) else str(self.id)
+
+    @property
+    def key(self):
+        """Items with the same key can be sampled in one batch."""
+        return self.steps, self.scale
+
+
+def _valid_id(id):
+    """Ids name the output files, so they are ints or strs that stay inside the output directory."""
+    if isinstance(id, bool):
+        return False
+    if isinstance(id, int):
+        return True
+    separators = [sep for sep in (os.sep, os.altsep, "/") if sep]
+    return isinstance(id, str) and id != "" and ".." not in id and not any(sep in id for sep in separators)
+
+
+def read_job(path, seed=42, steps=50, scale=7.5):
+    """
+    Generator of the JobItems of a job file. Items without an id are numbered by their line, items without a
+    seed get seed + line, so that every item is reproducible on its own. Ids have to be ints or strs without
+    path separators and "..".
+    """
+    with open(path, "r") as f:
+        for line_nr, line in enumerate(f):
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            if line.lstrip().startswith("{"):
+                entry = json.loads(line)
+            else:
+                entry = {"prompt": line}
+            if not isinstance(entry.get("prompt"), str):
+                raise ValueError(f"{path}:{line_nr + 1}: every item needs a prompt")
+            if not _valid_id(entry.get("id", line_nr)):
+                raise ValueError(f"{path}:{line_nr + 1}: invalid id {entry['id']!r}, ids have to be ints or "
+                                 f"strs without path separators and '..'")
+            yield JobItem(id=entry.get("id", line_nr),
+                          prompt=entry["prompt"],
+                          seed=int(entry.get("seed", seed + line_nr)),
+                          steps=int(entry.get("steps", steps)),
+                          scale=float(entry.get("scale", scale)))
+
+
+def batch_items(items, batch_size):
+    """Groups consecutive items with the same key into lists of at most batch_size items."""
+    batch = []
+    for item in items:
+        if batch and (len(batch) == batch_size or item.key != batch[0].key):
+            yield batch
+            batch = []
+        batch.append(item)
+    if batch:
+        yield batch
+
+
+class Manifest(object):
+    """
+    Append-only record of the finished items of a job, one JSON line per item. Lines are flushed to disk as
+    they are added, a line cut off by a crash is ignored when the manifest is read again.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        cut_off = False
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        self.done.add(json.loads(line)["id"])
+                    except (ValueError, KeyError):
+                        continue
+            with open(path, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    cut_off = f.read(1) != b"\n"
+        self.lock = threading.Lock()
+        self.file = open(path, "a")
+        if cut_off:
+            # terminate a line cut off by a crash, so that it does not swallow the next record
+            self.file.write("\n")
+
+    def __contains__(self, id):
+        return id in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def pending(self, items):
+        """The items that are not done yet."""
+        return (item for item in items if item.id not in self.done)
+
+    def add(self, records):
+        """Mark items done, every record is a dict with at least the item's id."""
+        with self.lock:
+            for record in records:
+                self.file.write(json.dumps(record) + "\n")
+                self.done.add(record["id"])
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
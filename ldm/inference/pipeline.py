@@ -0,0 +1,134 @@
+"""
+Staged inference pipeline: every stage runs on its own thread and the stages are connected by bounded queues,
+so e.g. text encoding of the next batch and decoding/saving of the previous batch overlap with sampling of the
+current one. The queues bound the number of batches in flight, and with it the memory use.
+"""
+import queue
+import threading
+import time
+from contextlib import nullcontext
+
+
+_DONE = object()
+
+
+class Stage(object):
+    """A named step of a Pipeline, fn maps the output of the previous stage to the input of the next one."""
+    def __init__(self, name, fn):
+        self.name = name
+        self.fn = fn
+        self.calls = 0
+        self.busy = 0.  # seconds spent in fn
+        self.waiting = 0.  # seconds spent waiting for input
+        self.blocked = 0.  # seconds spent waiting for room in the output queue
+
+    def reset(self):
+        self.calls = 0
+        self.busy = self.waiting = self.blocked = 0.
+
+
+class Pipeline(object):
+    """
+    Runs items through a list of (name, fn) stages. Items keep their order, at most queue_size items wait
+    between two stages. thread_context is a callable returning a context manager that is entered on every stage
+    thread, for thread local state like torch.no_grad() or autocast. An exception in a stage stops the pipeline
+    and is raised again by run().
+    """
+    def __init__(self, stages, queue_size=1, thread_context=nullcontext):
+        self.stages = [Stage(name, fn) for name, fn in stages]
+        self.queue_size = queue_size
+        self.thread_context = thread_context
+        self.elapsed = 0.
+        self._stop = threading.Event()
+        self._error = None
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _feed(self, items, q):
+        try:
+            for item in items:
+                if not self._put(q, item):
+                    return
+        except BaseException as e:
+            self._fail(e)
+            return
+        self._put(q, _DONE)
+
+    def _work(self, stage, in_q, out_q):
+        try:
+            with self.thread_context():
+                while True:
+                    tic = time.perf_counter()
+                    item = self._get(in_q)
+                    toc = time.perf_counter()
+                    stage.waiting += toc - tic
+                    if item is _DONE:
+                        self._put(out_q, _DONE)
+                        return
+                    out = stage.fn(item)
+                    tic = time.perf_counter()
+                    stage.busy += tic - toc
+                    stage.calls += 1
+                    if not self._put(out_q, out):
+                        return
+                    stage.blocked += time.perf_counter() - tic
+        except BaseException as e:
+            self._fail(e)
+
+    def _fail(self, e):
+        if self._error is None:
+            self._error = e
+        self._stop.set()
+
+    def run(self, items):
+        """Generator of the outputs of the last stage, in the order of items."""
+        self._stop.clear()
+        self._error = None
+        for stage in self.stages:
+            stage.reset()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)]
+        threads += [threading.Thread(target=self._work, args=(stage, queues[i], queues[i + 1]), daemon=True)
+                    for i, stage in enumerate(self.stages)]
+        tic = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                out = self._get(queues[-1])
+                if out is _DONE:
+                    break
+                yield out
+        finally:
+            # also stops the stage threads when the consumer stops early
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            self.elapsed = time.perf_counter() - tic
+        if self._error is not None:
+            raise self._error
+
+    def report(self):
+        """Per stage utilization, the stage with the highest one is the bottleneck of the pipeline."""
+        lines = [f"{'stage':>12} {'calls':>6} {'busy s':>8} {'util':>6} {'wait s':>8} {'blocked s':>10}"]
+        for stage in self.stages:
+            util = stage.busy / self.elapsed if self.elapsed > 0 else 0.
+            lines.append(f"{stage.name:>12} {stage.calls:6d} {stage.busy:8.2f} {util:6.1%} "
+                         f"{stage.waiting:8.2f} {stage.blocked:10.2f}")
+        lines.append(f"wall time {self.elapsed:.2f}s")
+        return "\n".join(lines)
@@ -0,0 +1,196 @@
+"""
+Work queue on a shared filesystem, to spread a job over many worker processes and machines. The coordinator
+splits the job into chunks of items, workers lease chunks, keep them alive with heartbeats and complete them.
+A lease that has not seen a heartbeat for lease_timeout seconds is put back, so the chunks of a dead worker are
+picked up by the others. All state lives in three directories and moves between them with atomic renames:
+    todo/<chunk>.json                 chunks waiting for a worker
+    leased/<chunk>.<worker>.json      leased chunks, the file's mtime is the last heartbeat
+    done/<chunk>.json                 completed chunks
+    clock                             touched by the coordinator, its mtime is the current time of the filesystem
+Heartbeats and the clock are stamped with os.utime() without explicit times, which on NFS and other shared
+filesystems takes the time of the file server. Expiry compares these mtimes with each other and never with
+the local clock, so it assumes one clock for the whole filesystem but not synchronized clocks between machines.
+A chunk can end up being processed twice when its worker was only slow, so outputs have to be idempotent, as
+the id-named outputs of txt2img --job are.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+from itertools import chain
+
+from ldm.inference.jobs import JobItem
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class Lease(object):
+    """A chunk leased by a worker, count_done() completes it once all of its items are done."""
+    def __init__(self, queue, chunk, path, items):
+        self.queue = queue
+        self.chunk = chunk
+        self.path = path
+        self.items = items
+        self.remaining = len(items)
+        self.lock = threading.Lock()
+
+    def heartbeat(self):
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            raise LeaseLost(f"the lease of chunk {self.chunk} expired")
+
+    def count_done(self, n=1):
+        with self.lock:
+            self.remaining -= n
+            if self.remaining == 0:
+                self.queue.complete(self)
+
+
+class FileWorkQueue(object):
+    def __init__(self, root):
+        self.root = root
+        self.dirs = {state: os.path.join(root, state) for state in ["todo", "leased", "done"]}
+        for path in self.dirs.values():
+            os.makedirs(path, exist_ok=True)
+
+    def _write(self, path, data):
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def _chunks(self, state):
+        return sorted(name for name in os.listdir(self.dirs[state]) if name.endswith(".json"))
+
+    def put(self, items, chunk_size=16):
+        """Split JobItems into chunks and queue them, returns the number of chunks."""
+        n_chunks, chunk = 0, []
+        for item in chain(items, [None]):
+            if item is not None:
+                chunk.append(vars(item))
+            if chunk and (item is None or len(chunk) == chunk_size):
+                self._write(os.path.join(self.dirs["todo"], f"{n_chunks:08}.json"), {"items": chunk})
+                n_chunks, chunk = n_chunks + 1, []
+        return n_chunks
+
+    def lease(self, worker):
+        """Lease the next chunk for worker, None if no chunk is waiting."""
+        for name in self._chunks("todo"):
+            chunk = name[:-len(".json")]
+            path = os.path.join(self.dirs["leased"], f"{chunk}.{worker}.json")
+            try:
+                # only one worker can win the rename
+                os.rename(os.path.join(self.dirs["todo"], name), path)
+            except FileNotFoundError:
+                continue
+            try:
+                os.utime(path)
+                with open(path, "r") as f:
+                    items = [JobItem(**item) for item in json.load(f)["items"]]
+            except FileNotFoundError:
+                # the file kept the mtime of its old lease and was requeued right away
+                continue
+            return Lease(self, chunk, path, items)
+        return None
+
+    def complete(self, lease):
+        done_path = os.path.join(self.dirs["done"], f"{lease.chunk}.json")
+        try:
+            os.replace(lease.path, done_path)
+        except FileNotFoundError:
+            # the lease expired in the meantime, the chunk is done all the same
+            self._write(done_path, {"items": [vars(item) for item in lease.items]})
+            try:
+                os.remove(os.path.join(self.dirs["todo"], f"{lease.chunk}.json"))
+            except FileNotFoundError:
+                pass
+
+    def _filesystem_time(self):
+        """Touches the clock file and returns its mtime, the current time on the clock that stamps heartbeats."""
+        path = os.path.join(self.root, "clock")
+        with open(path, "a"):
+            pass
+        os.utime(path)
+        return os.path.getmtime(path)
+
+    def requeue_expired(self, lease_timeout):
+        """
+        Put leases without a heartbeat for lease_timeout seconds back into todo, returns their chunks. The age of
+        a heartbeat is measured against the clock file, so the coordinator's own clock does not matter.
+        """
+        requeued = []
+        now = self._filesystem_time()
+        for name in self._chunks("leased"):
+            path = os.path.join(self.dirs["leased"], name)
+            try:
+                expired = now - os.path.getmtime(path) > lease_timeout
+                chunk = name.split(".")[0]
+                if expired and not os.path.exists(os.path.join(self.dirs["done"], f"{chunk}.json")):
+                    os.rename(path, os.path.join(self.dirs["todo"], f"{chunk}.json"))
+                    requeued.append(chunk)
+                elif expired:
+                    os.remove(path)
+            except FileNotFoundError:
+                continue
+        return requeued
+
+    def status(self):
+        return {state: len(self._chunks(state)) for state in self.dirs}
+
+    def finished(self):
+        status = self.status()
+        return status["todo"] == 0 and status["leased"] == 0
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class Worker(object):
+    """
+    Leases chunks of a FileWorkQueue for one worker process and keeps them alive with a heartbeat thread until
+    all of their items are counted done.
+    """
+    def __init__(self, queue, worker_id=None, heartbeat_interval=10., poll_interval=5.):
+        self.queue = queue
+        self.worker_id = (worker_id or default_worker_id()).replace(".", "-")
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.held = []
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._thread.start()
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            with self.lock:
+                self.held = [lease for lease in self.held if lease.remaining > 0]
+                leases = list(self.held)
+            for lease in leases:
+                try:
+                    lease.heartbeat()
+                except LeaseLost as e:
+                    print(f"{self.worker_id}: {e}")
+
+    def leases(self):
+        """Leased chunks until the queue is finished, waits for requeued chunks while others hold leases."""
+        while True:
+            lease = self.queue.lease(self.worker_id)
+            if lease is None:
+                if self.queue.finished():
+                    return
+                time.sleep(self.poll_interval)
+                continue
+            with self.lock:
+                self.held.append(lease)
+            yield lease
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
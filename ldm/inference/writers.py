@@ -0,0 +1,355 @@
+"""
+Output writers that take image encoding, watermarking and saving off the sampling thread. PNG compression alone
+can take longer than a low-step sample, so batches are written by a pool of worker processes. The grid and shard
+writers stream their input, so their memory use does not grow with the number of samples.
+"""
+import io
+import os
+import re
+import json
+import tarfile
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+
+# name: (file extension, PIL format)
+IMAGE_FORMATS = {
+    "png": ("png", "PNG"),
+    "webp": ("webp", "WEBP"),
+    "jpeg": ("jpg", "JPEG"),
+}
+
+
+def save_options(format, compress_level=6, quality=95):
+    """PIL save options, compress_level (0-9) applies to png, quality (1-100) to webp and jpeg."""
+    if format == "png":
+        return {"compress_level": compress_level}
+    if format == "webp":
+        return {"quality": quality, "lossless": quality >= 100}
+    if format == "jpeg":
+        return {"quality": quality}
+    raise ValueError(f"unknown image format {format}, choose from {list(IMAGE_FORMATS)}")
+
+
+class FileNamer(object):
+    """
+    Hands out numbered paths like <directory>/<prefix>00042.png. A path is reserved by creating it exclusively,
+    so several writers (threads or processes) sharing a directory never get the same name.
+    """
+    def __init__(self, directory, prefix="", digits=5, ext="png"):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.prefix = prefix
+        self.digits = digits
+        self.ext = ext
+        self.lock = threading.Lock()
+        # start after the highest existing index, the exclusive create below resolves any races
+        pattern = re.compile(rf"^{re.escape(prefix)}(\d{{{digits},}})\.{re.escape(ext)}$")
+        indices = [int(m.group(1)) for m in map(pattern.match, os.listdir(directory)) if m]
+        self.next_index = max(indices) + 1 if indices else 0
+
+    def reserve(self):
+        with self.lock:
+            while True:
+                path = os.path.join(self.directory, f"{self.prefix}{self.next_index:0{self.digits}}.{self.ext}")
+                self.next_index += 1
+                try:
+                    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                    return path
+                except FileExistsError:
+                    continue
+
+
+_watermark_encoders = dict()
+
+
+def put_watermark_batch(images, watermark):
+    """Invisible watermark for a (b, h, w, 3) uint8 RGB batch, the encoder works on BGR images."""
+    if watermark not in _watermark_encoders:
+        from imwatermark import WatermarkEncoder
+        encoder = WatermarkEncoder()
+        encoder.set_watermark('bytes', watermark.encode('utf-8'))
+        _watermark_encoders[watermark] = encoder
+    encoder = _watermark_encoders[watermark]
+    bgr = np.ascontiguousarray(images[..., ::-1])
+    return np.stack([encoder.encode(image, 'dwtDct') for image in bgr])[..., ::-1]
+
+
+def write_images(paths, images, format="png", options=None, watermark=None):
+    """Save a (b, h, w, 3) uint8 batch, every file is written to a temporary name first and then renamed."""
+    if watermark is not None:
+        images = put_watermark_batch(images, watermark)
+    for path, image in zip(paths, images):
+        tmp_path = path + ".tmp"
+        Image.fromarray(np.ascontiguousarray(image)).save(tmp_path, format=IMAGE_FORMATS[format][1],
+                                                          **(options or {}))
+        os.replace(tmp_path, path)
+    return paths
+
+
+def _noop(_):
+    return None
+
+
+class ImageWriter(object):
+    """
+    Writes uint8 image batches with a pool of `processes` worker processes, or one background thread for
+    processes=0. At most queue_size batches are in flight, write() blocks when the queue is full. Errors of
+    the workers and of the on_done callbacks are raised by the next write() or by close(). write() may be called from several threads.
+
+    The workers are forked when the writer is created, so create it before the model is loaded and moved to
+    the GPU.
+    """
+    def __init__(self, format="png", compress_level=6, quality=95, watermark=None, processes=2, queue_size=4):
+        self.options = save_options(format, compress_level, quality)
+        self.format = format
+        self.ext = IMAGE_FORMATS[format][0]
+        self.watermark = watermark
+        if processes > 0:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("fork" if "fork" in methods else None)
+            self.pool = ProcessPoolExecutor(processes, mp_context=context)
+            # start the workers now, while the parent is still small and has no CUDA context
+            list(self.pool.map(_noop, range(processes)))
+        else:
+            self.pool = ThreadPoolExecutor(1)
+        self.slots = threading.BoundedSemaphore(queue_size)
+        # guards namers and futures, the grid callback writes from another thread than the save stage
+        self.lock = threading.Lock()
+        self.namers = dict()
+        self.futures = []
+
+    def _namer(self, directory, prefix, digits):
+        key = (directory, prefix, digits)
+        with self.lock:
+            if key not in self.namers:
+                self.namers[key] = FileNamer(directory, prefix=prefix, digits=digits, ext=self.ext)
+            return self.namers[key]
+
+    def _check(self, wait=False):
+        finished, pending = [], []
+        with self.lock:
+            for future in self.futures:
+                if wait or future.done():
+                    finished.append(future)
+                else:
+                    pending.append(future)
+            self.futures = pending
+        # wait outside of the lock, so that other threads can keep queueing batches
+        for future in finished:
+            future.result()
+
+    def write(self, images, directory, prefix="", digits=5, names=None, on_done=None):
+        """
+        Queue a (b, h, w, 3) uint8 batch for writing and return the paths it will be written to. The files are
+        numbered, unless names (without extension) are given. on_done(paths) is called once the batch is on disk.
+        """
+        self._check()
+        images = np.asarray(images)
+        assert images.dtype == np.uint8 and images.ndim == 4, 'expected a (b, h, w, c) uint8 batch'
+        if names is None:
+            namer = self._namer(directory, prefix, digits)
+            paths = [namer.reserve() for _ in range(len(images))]
+        else:
+            assert len(names) == len(images), 'expected one name per image'
+            os.makedirs(directory, exist_ok=True)
+            paths = [os.path.join(directory, f"{prefix}{name}.{self.ext}") for name in names]
+
+        # completes after on_done, concurrent.futures would only log an exception raised in a done callback
+        tracked = Future()
+
+        def done(future):
+            self.slots.release()
+            try:
+                future.result()
+                if on_done is not None:
+                    on_done(paths)
+            except BaseException as e:
+                tracked.set_exception(e)
+            else:
+                tracked.set_result(paths)
+
+        self.slots.acquire()
+        future = self.pool.submit(write_images, paths, images, self.format, self.options, self.watermark)
+        future.add_done_callback(done)
+        with self.lock:
+            self.futures.append(tracked)
+        return paths
+
+    def close(self):
+        try:
+            self._check(wait=True)
+        finally:
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class GridAssembler(object):
+    """
+    Builds image grids incrementally, laid out like torchvision's make_grid. Images are pasted into a uint8
+    canvas of at most max_images images as they arrive, a full grid is passed to on_full and a new one is started,
+    so memory does not grow with the number of samples.
+    """
+    def __init__(self, on_full, nrow=8, max_images=64, padding=2, pad_value=0):
+        self.on_full = on_full
+        self.nrow = nrow
+        self.max_images = max_images
+        self.padding = padding
+        self.pad_value = pad_value
+        self.canvas = None
+        self.count = 0
+
+    def _cell(self, i):
+        h, w = self.image_shape[:2]
+        row, col = divmod(i, self.nrow)
+        y = row * (h + self.padding) + self.padding
+        x = col * (w + self.padding) + self.padding
+        return y, x
+
+    def add(self, images):
+        """Add a (b, h, w, c) uint8 batch."""
+        for image in images:
+            if self.canvas is None:
+                self.image_shape = image.shape
+                h, w, c = image.shape
+                rows = -(-self.max_images // self.nrow)
+                self.canvas = np.full((rows * (h + self.padding) + self.padding,
+                                       self.nrow * (w + self.padding) + self.padding, c),
+                                      self.pad_value, dtype=np.uint8)
+            y, x = self._cell(self.count)
+            self.canvas[y:y + image.shape[0], x:x + image.shape[1]] = image
+            self.count += 1
+            if self.count == self.max_images:
+                self.flush()
+
+    def flush(self):
+        """Pass the current, possibly partial, grid to on_full."""
+        if self.count == 0:
+            return
+        h, w = self.image_shape[:2]
+        cols = min(self.nrow, self.count)
+        rows = -(-self.count // cols)
+        grid = self.canvas[:rows * (h + self.padding) + self.padding, :cols * (w + self.padding) + self.padding]
+        self.on_full(grid.copy())
+        self.canvas.fill(self.pad_value)
+        self.count = 0
+
+
+class ShardedWriter(object):
+    """
+    Base class of writers that split a stream of samples into shards of shard_size samples, named
+    <prefix>-00000.<ext>, <prefix>-00001.<ext>, ... Every finished shard gets a line in index.jsonl with its file
+    name, the index of its first sample and its number of samples. Shards are written to a temporary name and
+    renamed when complete.
+    """
+    ext = None
+
+    def __init__(self, directory, shard_size=10000, prefix="samples"):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self.shard = 0
+        self.count = 0  # samples written in total
+        self.shard_count = 0  # samples in the current shard
+        self.index_file = open(os.path.join(directory, "index.jsonl"), "w")
+
+    @property
+    def shard_name(self):
+        return f"{self.prefix}-{self.shard:05}.{self.ext}"
+
+    def write(self, samples):
+        """Add a batch of samples, a (b, ...) array."""
+        samples = np.asarray(samples)
+        while len(samples) > 0:
+            n = min(len(samples), self.shard_size - self.shard_count)
+            self._add(samples[:n])
+            self.shard_count += n
+            self.count += n
+            samples = samples[n:]
+            if self.shard_count == self.shard_size:
+                self._finish_shard()
+
+    def _finish_shard(self):
+        if self.shard_count == 0:
+            return
+        path = os.path.join(self.directory, self.shard_name)
+        self._close_shard(path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self.index_file.write(json.dumps({"shard": self.shard_name, "start": self.count - self.shard_count,
+                                          "count": self.shard_count}) + "\n")
+        self.index_file.flush()
+        self.shard += 1
+        self.shard_count = 0
+
+    def _add(self, samples):
+        raise NotImplementedError()
+
+    def _close_shard(self, path):
+        raise NotImplementedError()
+
+    def close(self):
+        self._finish_shard()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ShardedNpzWriter(ShardedWriter):
+    """Stores samples in .npz shards under the key arr_0, like np.savez(path, samples) does."""
+    ext = "npz"
+
+    def __init__(self, directory, shard_size=10000, prefix="samples"):
+        super().__init__(directory, shard_size=shard_size, prefix=prefix)
+        self.buffer = None
+
+    def _add(self, samples):
+        if self.buffer is None:
+            self.buffer = np.empty((self.shard_size,) + samples.shape[1:], dtype=samples.dtype)
+        self.buffer[self.shard_count:self.shard_count + len(samples)] = samples
+
+    def _close_shard(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, self.buffer[:self.shard_count])
+
+
+class ShardedTarWriter(ShardedWriter):
+    """
+    Stores (h, w, c) uint8 images as encoded files in .tar shards, named by their sample index like
+    00000042.png. Every image is encoded and appended to the open shard right away.
+    """
+    ext = "tar"
+
+    def __init__(self, directory, shard_size=1000, prefix="samples", format="png", compress_level=6, quality=95):
+        super().__init__(directory, shard_size=shard_size, prefix=prefix)
+        self.options = save_options(format, compress_level, quality)
+        self.format = format
+        self.tar = None
+
+    def _add(self, samples):
+        if self.tar is None:
+            self.tar = tarfile.open(os.path.join(self.directory, self.shard_name + ".tmp"), "w")
+        for i, image in enumerate(samples):
+            buffer = io.BytesIO()
+            Image.fromarray(image).save(buffer, format=IMAGE_FORMATS[self.format][1], **self.options)
+            info = tarfile.TarInfo(f"{self.count + i:08}.{IMAGE_FORMATS[self.format][0]}")
+            info.size = buffer.tell()
+            buffer.seek(0)
+            self.tar.addfile(info, buffer)
+
+    def _close_shard(self, path):
+        self.tar.close()
+        self.tar = None
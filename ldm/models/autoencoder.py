@@ -9,6 +9,7 @@ from ldm.modules.diffusionmodules.model import Encoder, Decoder
 from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
 
 from ldm.util import instantiate_from_config
+from ldm.modules.tiling import TileConfig, tiled_apply, tiled_encode
 
 
 class VQModel(pl.LightningModule):
@@ -265,13 +266,35 @@ class VQModelInterface(VQModel):
     def __init__(self, embed_dim, *args, **kwargs):
         super().__init__(embed_dim=embed_dim, *args, **kwargs)
         self.embed_dim = embed_dim
+        self.tiling = None
+
+    def enable_tiling(self, tile_size=64, overlap=16, micro_batch=4, blend="linear"):
+        """
+        Encode and decode in overlapping, blended tiles once the input is larger than one tile. tile_size and
+        overlap are measured in latent pixels, the encoder works on tiles of the corresponding image size.
+        """
+        self.tiling = TileConfig(tile_size, overlap, micro_batch, blend)
+
+    def disable_tiling(self):
+        self.tiling = None
 
     def encode(self, x):
+        if self.tiling is not None:
+            return tiled_encode(self._encode, x, self.tiling, 2 ** (self.decoder.num_resolutions - 1))
+        return self._encode(x)
+
+    def _encode(self, x):
         h = self.encoder(x)
         h = self.quant_conv(h)
         return h
 
     def decode(self, h, force_not_quantize=False):
+        if self.tiling is not None:
+            return tiled_apply(lambda t: self._decode(t, force_not_quantize), h, self.tiling,
+                               scale=2 ** (self.decoder.num_resolutions - 1))
+        return self._decode(h, force_not_quantize)
+
+    def _decode(self, h, force_not_quantize=False):
         # also go through quantization layer
         if not force_not_quantize:
             quant, emb_loss, info = self.quantize(h)
@@ -309,6 +332,7 @@ class AutoencoderKL(pl.LightningModule):
             self.monitor = monitor
         if ckpt_path is not None:
             self.init_from_ckpt(ckpt_path, ignore_keys=ignore_keys)
+        self.tiling = None
 
     def init_from_ckpt(self, path, ignore_keys=list()):
         sd = torch.load(path, map_location="cpu")["state_dict"]
@@ -321,13 +345,35 @@ class AutoencoderKL(pl.LightningModule):
         self.load_state_dict(sd, strict=False)
         print(f"Restored from {path}")
 
+    def enable_tiling(self, tile_size=64, overlap=16, micro_batch=4, blend="linear"):
+        """
+        Encode and decode in overlapping, blended tiles once the input is larger than one tile. tile_size and
+        overlap are measured in latent pixels, the encoder works on tiles of the corresponding image size.
+        """
+        self.tiling = TileConfig(tile_size, overlap, micro_batch, blend)
+
+    def disable_tiling(self):
+        self.tiling = None
+
     def encode(self, x):
-        h = self.encoder(x)
-        moments = self.quant_conv(h)
+        if self.tiling is not None:
+            # the moments are stitched, the posterior is built once for the whole image
+            moments = tiled_encode(self._encode_moments, x, self.tiling, 2 ** (self.decoder.num_resolutions - 1))
+        else:
+            moments = self._encode_moments(x)
         posterior = DiagonalGaussianDistribution(moments)
         return posterior
 
+    def _encode_moments(self, x):
+        h = self.encoder(x)
+        return self.quant_conv(h)
+
     def decode(self, z):
+        if self.tiling is not None:
+            return tiled_apply(self._decode, z, self.tiling, scale=2 ** (self.decoder.num_resolutions - 1))
+        return self._decode(z)
+
+    def _decode(self, z):
         z = self.post_quant_conv(z)
         dec = self.decoder(z)
         return dec
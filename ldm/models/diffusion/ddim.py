@@ -5,8 +5,11 @@ import numpy as np
 from tqdm import tqdm
 from functools import partial
 
-from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like, \
-    extract_into_tensor
+from ldm.modules.diffusionmodules.util import noise_like, extract_into_tensor, make_generators
+from ldm.models.diffusion.sampling_util import make_ddim_schedule, StaticDDIMStep, SamplerStep, check_conditioning
+from ldm.modules.attention import CrossAttentionKVCache, cross_attention_kv_cache
+from ldm.modules.tome import reset_tome
+from ldm.modules.diffusionmodules.openaimodel import make_deep_cache, unet_deep_cache
 
 
 class DDIMSampler(object):
@@ -18,40 +21,15 @@ class DDIMSampler(object):
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            if attr.device != self.model.device:
+                attr = attr.to(self.model.device)
         setattr(self, name, attr)
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
-        self.ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
-                                                  num_ddpm_timesteps=self.ddpm_num_timesteps,verbose=verbose)
-        alphas_cumprod = self.model.alphas_cumprod
-        assert alphas_cumprod.shape[0] == self.ddpm_num_timesteps, 'alphas have to be defined for each timestep'
-        to_torch = lambda x: x.clone().detach().to(torch.float32).to(self.model.device)
-
-        self.register_buffer('betas', to_torch(self.model.betas))
-        self.register_buffer('alphas_cumprod', to_torch(alphas_cumprod))
-        self.register_buffer('alphas_cumprod_prev', to_torch(self.model.alphas_cumprod_prev))
-
-        # calculations for diffusion q(x_t | x_{t-1}) and others
-        self.register_buffer('sqrt_alphas_cumprod', to_torch(np.sqrt(alphas_cumprod.cpu())))
-        self.register_buffer('sqrt_one_minus_alphas_cumprod', to_torch(np.sqrt(1. - alphas_cumprod.cpu())))
-        self.register_buffer('log_one_minus_alphas_cumprod', to_torch(np.log(1. - alphas_cumprod.cpu())))
-        self.register_buffer('sqrt_recip_alphas_cumprod', to_torch(np.sqrt(1. / alphas_cumprod.cpu())))
-        self.register_buffer('sqrt_recipm1_alphas_cumprod', to_torch(np.sqrt(1. / alphas_cumprod.cpu() - 1)))
-
-        # ddim sampling parameters
-        ddim_sigmas, ddim_alphas, ddim_alphas_prev = make_ddim_sampling_parameters(alphacums=alphas_cumprod.cpu(),
-                                                                                   ddim_timesteps=self.ddim_timesteps,
-                                                                                   eta=ddim_eta,verbose=verbose)
-        self.register_buffer('ddim_sigmas', ddim_sigmas)
-        self.register_buffer('ddim_alphas', ddim_alphas)
-        self.register_buffer('ddim_alphas_prev', ddim_alphas_prev)
-        self.register_buffer('ddim_sqrt_one_minus_alphas', np.sqrt(1. - ddim_alphas))
-        sigmas_for_original_sampling_steps = ddim_eta * torch.sqrt(
-            (1 - self.alphas_cumprod_prev) / (1 - self.alphas_cumprod) * (
-                        1 - self.alphas_cumprod / self.alphas_cumprod_prev))
-        self.register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
+        schedule = make_ddim_schedule(self.model, ddim_num_steps, ddim_discretize=ddim_discretize,
+                                      ddim_eta=ddim_eta, verbose=verbose)
+        for name, attr in schedule.items():
+            self.register_buffer(name, attr)
 
     @torch.no_grad()
     def sample(self,
@@ -76,16 +54,15 @@ class DDIMSampler(object):
                unconditional_guidance_scale=1.,
                unconditional_conditioning=None,
                # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+               fast_step=False,
+               kv_cache=False,
+               deep_cache_interval=None,
+               deep_cache_branch=0,
+               seeds=None,
                **kwargs
                ):
-        if conditioning is not None:
-            if isinstance(conditioning, dict):
-                cbs = conditioning[list(conditioning.keys())[0]].shape[0]
-                if cbs != batch_size:
-                    print(f"Warning: Got {cbs} conditionings but batch-size is {batch_size}")
-            else:
-                if conditioning.shape[0] != batch_size:
-                    print(f"Warning: Got {conditioning.shape[0]} conditionings but batch-size is {batch_size}")
+        check_conditioning(conditioning, batch_size)
+        assert seeds is None or len(seeds) == batch_size, f'expected {batch_size} seeds, got {len(seeds)}'
 
         self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=verbose)
         # sampling
@@ -107,20 +84,135 @@ class DDIMSampler(object):
                                                     log_every_t=log_every_t,
                                                     unconditional_guidance_scale=unconditional_guidance_scale,
                                                     unconditional_conditioning=unconditional_conditioning,
+                                                    fast_step=fast_step,
+                                                    kv_cache=kv_cache,
+                                                    deep_cache_interval=deep_cache_interval,
+                                                    deep_cache_branch=deep_cache_branch,
+                                                    generators=make_generators(seeds),
                                                     )
         return samples, intermediates
 
+    @torch.no_grad()
+    def sample_iter(self,
+                    S,
+                    batch_size,
+                    shape,
+                    conditioning=None,
+                    quantize_x0=False,
+                    eta=0.,
+                    mask=None,
+                    x0=None,
+                    temperature=1.,
+                    noise_dropout=0.,
+                    score_corrector=None,
+                    corrector_kwargs=None,
+                    verbose=True,
+                    x_T=None,
+                    unconditional_guidance_scale=1.,
+                    unconditional_conditioning=None,
+                    fast_step=False,
+                    kv_cache=False,
+                    deep_cache_interval=None,
+                    deep_cache_branch=0,
+                    start_step=0,
+                    seeds=None,
+                    **kwargs
+                    ):
+        """
+        Same as sample(), but yields a SamplerStep after every step instead of collecting intermediates.
+        Breaking out of the loop stops sampling. To resume from a saved state, pass its x as x_T and
+        its i + 1 as start_step.
+        seeds gives every sample its own random stream for x_T and the per-step noise, so that it does not depend
+        on the batch it is sampled in. A resumed run restarts these streams, which only matters for eta > 0.
+        """
+        check_conditioning(conditioning, batch_size)
+        assert seeds is None or len(seeds) == batch_size, f'expected {batch_size} seeds, got {len(seeds)}'
+
+        self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=verbose)
+        C, H, W = shape
+        size = (batch_size, C, H, W)
+        print(f'Data shape for DDIM sampling is {size}, eta {eta}')
+
+        yield from self.ddim_sampling_iter(conditioning, size,
+                                           quantize_denoised=quantize_x0,
+                                           mask=mask, x0=x0,
+                                           ddim_use_original_steps=False,
+                                           noise_dropout=noise_dropout,
+                                           temperature=temperature,
+                                           score_corrector=score_corrector,
+                                           corrector_kwargs=corrector_kwargs,
+                                           x_T=x_T,
+                                           unconditional_guidance_scale=unconditional_guidance_scale,
+                                           unconditional_conditioning=unconditional_conditioning,
+                                           fast_step=fast_step,
+                                           kv_cache=kv_cache,
+                                           deep_cache_interval=deep_cache_interval,
+                                           deep_cache_branch=deep_cache_branch,
+                                           start_step=start_step,
+                                           generators=make_generators(seeds))
+
     @torch.no_grad()
     def ddim_sampling(self, cond, shape,
                       x_T=None, ddim_use_original_steps=False,
                       callback=None, timesteps=None, quantize_denoised=False,
                       mask=None, x0=None, img_callback=None, log_every_t=100,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None,):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, fast_step=False,
+                      kv_cache=False, deep_cache_interval=None, deep_cache_branch=0, generators=None):
+        device = self.model.betas.device
+        if x_T is None:
+            img = noise_like(shape, device, generators=generators)
+        else:
+            img = x_T
+
+        deep_cache = make_deep_cache(deep_cache_interval, deep_cache_branch)
+        intermediates = {'x_inter': [img], 'pred_x0': [img]}
+        for state in self.ddim_sampling_iter(cond, shape, x_T=img, ddim_use_original_steps=ddim_use_original_steps,
+                                             timesteps=timesteps, quantize_denoised=quantize_denoised,
+                                             mask=mask, x0=x0, temperature=temperature, noise_dropout=noise_dropout,
+                                             score_corrector=score_corrector, corrector_kwargs=corrector_kwargs,
+                                             unconditional_guidance_scale=unconditional_guidance_scale,
+                                             unconditional_conditioning=unconditional_conditioning,
+                                             fast_step=fast_step, kv_cache=kv_cache,
+                                             deep_cache=deep_cache, generators=generators):
+            img = state.x
+            if callback: callback(state.i)
+            if img_callback: img_callback(state.pred_x0, state.i)
+
+            if state.index % log_every_t == 0 or state.index == state.total_steps - 1:
+                if fast_step:
+                    # the fast step reuses its output buffers
+                    intermediates['x_inter'].append(state.x.clone())
+                    intermediates['pred_x0'].append(state.pred_x0.clone())
+                else:
+                    intermediates['x_inter'].append(state.x)
+                    intermediates['pred_x0'].append(state.pred_x0)
+
+        if deep_cache is not None:
+            intermediates['deep_cache'] = deep_cache.summary()
+        return img, intermediates
+
+    @torch.no_grad()
+    def ddim_sampling_iter(self, cond, shape,
+                           x_T=None, ddim_use_original_steps=False,
+                           timesteps=None, quantize_denoised=False,
+                           mask=None, x0=None,
+                           temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
+                           unconditional_guidance_scale=1., unconditional_conditioning=None, fast_step=False,
+                           kv_cache=False, deep_cache_interval=None, deep_cache_branch=0, deep_cache=None,
+                           start_step=0, generators=None):
+        """
+        generators: one torch.Generator per sample (see make_generators) for x_T and the per-step noise,
+        so that a sample does not depend on the batch it is part of.
+        deep_cache: a DeepCache to use instead of one made from deep_cache_interval and deep_cache_branch,
+        for callers that want its summary() after the run.
+        """
         device = self.model.betas.device
+        # token merging partitions restart with every run
+        reset_tome(self.model)
         b = shape[0]
         if x_T is None:
-            img = torch.randn(shape, device=device)
+            img = noise_like(shape, device, generators=generators)
         else:
             img = x_T
 
@@ -130,42 +222,65 @@ class DDIMSampler(object):
             subset_end = int(min(timesteps / self.ddim_timesteps.shape[0], 1) * self.ddim_timesteps.shape[0]) - 1
             timesteps = self.ddim_timesteps[:subset_end]
 
-        intermediates = {'x_inter': [img], 'pred_x0': [img]}
-        time_range = reversed(range(0,timesteps)) if ddim_use_original_steps else np.flip(timesteps)
+        time_range = list(reversed(range(0,timesteps))) if ddim_use_original_steps else np.flip(timesteps)
         total_steps = timesteps if ddim_use_original_steps else timesteps.shape[0]
         print(f"Running DDIM Sampling with {total_steps} timesteps")
 
-        iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps)
-
-        for i, step in enumerate(iterator):
+        iterator = tqdm(time_range[start_step:], desc='DDIM Sampler', initial=start_step, total=total_steps)
+
+        static_step = None
+        if fast_step:
+            assert not ddim_use_original_steps, 'the fast DDIM step needs the DDIM schedule'
+            # fast_step="compile" captures the update with torch.compile where available
+            static_step = StaticDDIMStep(self.ddim_step_coefficients, img.shape, dtype=img.dtype,
+                                         compile=fast_step == "compile", generators=generators)
+        uc_c = None
+        if unconditional_conditioning is not None and unconditional_guidance_scale != 1.:
+            # the conditioning does not change between steps, concatenating it once also
+            # lets the cross-attention kv cache recognize it
+            uc_c = torch.cat([unconditional_conditioning, cond])
+
+        kv = CrossAttentionKVCache() if kv_cache else None
+        if deep_cache is None:
+            deep_cache = make_deep_cache(deep_cache_interval, deep_cache_branch)
+        for i, step in enumerate(iterator, start_step):
             index = total_steps - i - 1
-            ts = torch.full((b,), step, device=device, dtype=torch.long)
+            if deep_cache is not None:
+                deep_cache.set_step(i)
+            if static_step is not None:
+                ts = static_step.timesteps(step)
+            else:
+                ts = torch.full((b,), step, device=device, dtype=torch.long)
 
             if mask is not None:
                 assert x0 is not None
                 img_orig = self.model.q_sample(x0, ts)  # TODO: deterministic forward pass?
                 img = img_orig * mask + (1. - mask) * img
 
-            outs = self.p_sample_ddim(img, cond, ts, index=index, use_original_steps=ddim_use_original_steps,
-                                      quantize_denoised=quantize_denoised, temperature=temperature,
-                                      noise_dropout=noise_dropout, score_corrector=score_corrector,
-                                      corrector_kwargs=corrector_kwargs,
-                                      unconditional_guidance_scale=unconditional_guidance_scale,
-                                      unconditional_conditioning=unconditional_conditioning)
+            with cross_attention_kv_cache(kv), unet_deep_cache(deep_cache):
+                if static_step is not None:
+                    outs = self.p_sample_ddim_static(img, cond, ts, index, static_step,
+                                                     quantize_denoised=quantize_denoised, temperature=temperature,
+                                                     noise_dropout=noise_dropout, score_corrector=score_corrector,
+                                                     corrector_kwargs=corrector_kwargs,
+                                                     unconditional_guidance_scale=unconditional_guidance_scale,
+                                                     uc_c=uc_c)
+                else:
+                    outs = self.p_sample_ddim(img, cond, ts, index=index,
+                                              use_original_steps=ddim_use_original_steps,
+                                              quantize_denoised=quantize_denoised, temperature=temperature,
+                                              noise_dropout=noise_dropout, score_corrector=score_corrector,
+                                              corrector_kwargs=corrector_kwargs,
+                                              unconditional_guidance_scale=unconditional_guidance_scale,
+                                              unconditional_conditioning=unconditional_conditioning, uc_c=uc_c,
+                                              generators=generators)
             img, pred_x0 = outs
-            if callback: callback(i)
-            if img_callback: img_callback(pred_x0, i)
-
-            if index % log_every_t == 0 or index == total_steps - 1:
-                intermediates['x_inter'].append(img)
-                intermediates['pred_x0'].append(pred_x0)
-
-        return img, intermediates
+            yield SamplerStep(i, index, int(step), total_steps, img, pred_x0)
 
     @torch.no_grad()
     def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, uc_c=None, generators=None):
         b, *_, device = *x.shape, x.device
 
         if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
@@ -173,7 +288,8 @@ class DDIMSampler(object):
         else:
             x_in = torch.cat([x] * 2)
             t_in = torch.cat([t] * 2)
-            c_in = torch.cat([unconditional_conditioning, c])
+            # uc_c: torch.cat([unconditional_conditioning, c]) when the caller built it once for all steps
+            c_in = torch.cat([unconditional_conditioning, c]) if uc_c is None else uc_c
             e_t_uncond, e_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
             e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
 
@@ -190,19 +306,55 @@ class DDIMSampler(object):
         a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
         sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
         sqrt_one_minus_at = torch.full((b, 1, 1, 1), sqrt_one_minus_alphas[index],device=device)
-
+        return self.ddim_update(x, e_t, a_t, a_prev, sigma_t, sqrt_one_minus_at, repeat_noise=repeat_noise,
+                                quantize_denoised=quantize_denoised, temperature=temperature,
+                                noise_dropout=noise_dropout, generators=generators)
+
+    def ddim_update(self, x, e_t, a_t, a_prev, sigma_t, sqrt_one_minus_at, repeat_noise=False,
+                    quantize_denoised=False, temperature=1., noise_dropout=0., generators=None):
+        """
+        DDIM update from x_t to x_{t-1} given the model's eps prediction.
+        The coefficients are (b, 1, 1, 1) tensors, so every row may sit at its own timestep.
+        """
+        device = x.device
         # current prediction for x_0
         pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
         if quantize_denoised:
             pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
         # direction pointing to x_t
         dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-        noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
+        noise = sigma_t * noise_like(x.shape, device, repeat_noise, generators=generators) * temperature
         if noise_dropout > 0.:
             noise = torch.nn.functional.dropout(noise, p=noise_dropout)
         x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
         return x_prev, pred_x0
 
+    @torch.no_grad()
+    def p_sample_ddim_static(self, x, c, t, index, static_step, quantize_denoised=False, temperature=1.,
+                             noise_dropout=0., score_corrector=None, corrector_kwargs=None,
+                             unconditional_guidance_scale=1., uc_c=None):
+        """
+        Fast path of p_sample_ddim on a StaticDDIMStep. uc_c is torch.cat([unconditional_conditioning, c]),
+        built once per sampling run.
+        """
+        if uc_c is None or unconditional_guidance_scale == 1.:
+            e_t = self.model.apply_model(x, t, c)
+        else:
+            x_in, t_in = static_step.guidance_inputs(x, t)
+            e_t_uncond, e_t = self.model.apply_model(x_in, t_in, uc_c).chunk(2)
+            e_t = e_t_uncond.lerp_(e_t, unconditional_guidance_scale)
+
+        if score_corrector is not None:
+            assert self.model.parameterization == "eps"
+            e_t = score_corrector.modify_score(self.model, e_t, x, t, c, **corrector_kwargs)
+
+        if not quantize_denoised:
+            return static_step(x, e_t, index, temperature=temperature, noise_dropout=noise_dropout)
+        pred_x0 = static_step.predict_x0(x, e_t, index)
+        pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
+        x_prev = static_step.step_from_x0(x, pred_x0, e_t, temperature=temperature, noise_dropout=noise_dropout)
+        return x_prev, pred_x0
+
     @torch.no_grad()
     def stochastic_encode(self, x0, t, use_original_steps=False, noise=None):
         # fast, but does not allow for exact reconstruction
@@ -221,8 +373,9 @@ class DDIMSampler(object):
 
     @torch.no_grad()
     def decode(self, x_latent, cond, t_start, unconditional_guidance_scale=1.0, unconditional_conditioning=None,
-               use_original_steps=False):
+               use_original_steps=False, kv_cache=False):
 
+        reset_tome(self.model)
         timesteps = np.arange(self.ddpm_num_timesteps) if use_original_steps else self.ddim_timesteps
         timesteps = timesteps[:t_start]
 
@@ -232,10 +385,15 @@ class DDIMSampler(object):
 
         iterator = tqdm(time_range, desc='Decoding image', total=total_steps)
         x_dec = x_latent
-        for i, step in enumerate(iterator):
-            index = total_steps - i - 1
-            ts = torch.full((x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long)
-            x_dec, _ = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
-                                          unconditional_guidance_scale=unconditional_guidance_scale,
-                                          unconditional_conditioning=unconditional_conditioning)
+        uc_c = None
+        if unconditional_conditioning is not None and unconditional_guidance_scale != 1.:
+            uc_c = torch.cat([unconditional_conditioning, cond])
+        # decode() runs to completion without yielding, the cache can stay active for the whole loop
+        with cross_attention_kv_cache(CrossAttentionKVCache() if kv_cache else None):
+            for i, step in enumerate(iterator):
+                index = total_steps - i - 1
+                ts = torch.full((x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long)
+                x_dec, _ = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
+                                              unconditional_guidance_scale=unconditional_guidance_scale,
+                                              unconditional_conditioning=unconditional_conditioning, uc_c=uc_c)
         return x_dec
\ No newline at end of file
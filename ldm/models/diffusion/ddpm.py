@@ -24,6 +24,7 @@ from ldm.modules.distributions.distributions import normal_kl, DiagonalGaussianD
 from ldm.models.autoencoder import VQModelInterface, IdentityFirstStage, AutoencoderKL
 from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like
 from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.sampling_util import ScheduleCache
 
 
 __conditioning_keys__ = {'concat': 'c_concat',
@@ -421,6 +422,11 @@ class DDPM(pl.LightningModule):
         return opt
 
 
+def crops_to_batch(x):
+    """(bn, nc, h, w, L) crops as returned by unfold and reshaped, to a crop-major (L * bn, nc, h, w) batch."""
+    return rearrange(x, 'b c h w l -> (l b) c h w')
+
+
 class LatentDiffusion(DDPM):
     """main class"""
     def __init__(self,
@@ -462,6 +468,11 @@ class LatentDiffusion(DDPM):
         self.cond_stage_forward = cond_stage_forward
         self.clip_denoised = False
         self.bbox_tokenizer = None  
+        # fold/unfold operators, weighting and normalization of split_input_params, see get_fold_unfold;
+        # least recently used, so that a long-running process that sees many sizes does not keep them all
+        self._fold_unfold_cache = ScheduleCache(max_size=8)
+        # learned conditioning of the bbox patches, see get_patch_bbox_conditioning
+        self._patch_bbox_cond_cache = None
 
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
@@ -598,11 +609,23 @@ class LatentDiffusion(DDPM):
             weighting = weighting * L_weighting
         return weighting
 
-    def get_fold_unfold(self, x, kernel_size, stride, uf=1, df=1):  # todo load once not every time, shorten code
+    def get_fold_unfold(self, x, kernel_size, stride, uf=1, df=1):
         """
+        The operators and weightings only depend on the shape of x, they are built once and cached.
         :param x: img of size (bs, c, h, w)
         :return: n img crops of size (n, bs, c, kernel_size[0], kernel_size[1])
         """
+        weighting_params = tuple(self.split_input_params.get(k) for k in
+                                 ["clip_min_weight", "clip_max_weight", "tie_braker",
+                                  "clip_min_tie_weight", "clip_max_tie_weight"])
+        key = (tuple(x.shape), tuple(kernel_size), tuple(stride), uf, df, x.dtype, x.device, weighting_params)
+        entry = self._fold_unfold_cache.get(key)
+        if entry is None:
+            entry = self._make_fold_unfold(x, kernel_size, stride, uf=uf, df=df)
+            self._fold_unfold_cache.put(key, entry)
+        return entry
+
+    def _make_fold_unfold(self, x, kernel_size, stride, uf=1, df=1):
         bs, nc, h, w = x.shape
 
         # number of crops in image
@@ -888,6 +911,56 @@ class LatentDiffusion(DDPM):
 
         return [rescale_bbox(b) for b in bboxes]
 
+    def get_patch_bbox_conditioning(self, c, w, ks, stride, n_crops):
+        """
+        Learned conditioning of every patch for the coordinates_bbox split-input mode: the tokenized crop position
+        at the end of c is replaced with the one of the respective patch. This only depends on c and the patch
+        geometry, not on t, so when sampling without gradients the result is kept and reused for the following
+        denoising steps.
+        :param c: tokenized bbox conditioning of shape (b, n), the last two tokens are the crop position
+        :return: conditioning of shape (n_crops, b, n, d)
+        """
+        assert 'original_image_size' in self.split_input_params, 'BoudingBoxRescaling is missing original_image_size'
+        # cut tknzd crop position from conditioning
+        cut_cond = c[..., :-2].to(self.device)
+        full_img_h, full_img_w = self.split_input_params['original_image_size']
+        key = (w, tuple(ks), tuple(stride), n_crops, full_img_h, full_img_w)
+        use_cache = not self.training and not torch.is_grad_enabled()
+        if use_cache and self._patch_bbox_cond_cache is not None:
+            cached_key, cached_cut_cond, adapted_cond = self._patch_bbox_cond_cache
+            if cached_key == key and cached_cut_cond.shape == cut_cond.shape and torch.equal(cached_cut_cond, cut_cond):
+                return adapted_cond
+
+        # assuming padding of unfold is always 0 and its dilation is always 1
+        n_patches_per_row = int((w - ks[0]) / stride[0] + 1)
+        # as we are operating on latents, we need the factor from the original image size to the
+        # spatial latent size to properly rescale the crops for regenerating the bbox annotations
+        num_downs = self.first_stage_model.encoder.num_resolutions - 1
+        rescale_latent = 2 ** (num_downs)
+
+        # get top left postions of patches as conforming for the bbbox tokenizer, therefore we
+        # need to rescale the tl patch coordinates to be in between (0,1)
+        tl_patch_coordinates = [(rescale_latent * stride[0] * (patch_nr % n_patches_per_row) / full_img_w,
+                                 rescale_latent * stride[1] * (patch_nr // n_patches_per_row) / full_img_h)
+                                for patch_nr in range(n_crops)]
+
+        # patch_limits are tl_coord, width and height coordinates as (x_tl, y_tl, h, w)
+        patch_limits = [(x_tl, y_tl,
+                         rescale_latent * ks[0] / full_img_w,
+                         rescale_latent * ks[1] / full_img_h) for x_tl, y_tl in tl_patch_coordinates]
+
+        # tokenize crop coordinates for the bounding boxes of the respective patches
+        patch_limits_tknzd = [torch.LongTensor(self.bbox_tokenizer._crop_encoder(bbox))[None].to(self.device)
+                              for bbox in patch_limits]  # list of length l with tensors of shape (1, 2)
+
+        adapted_cond = torch.stack([torch.cat([cut_cond, p], dim=1) for p in patch_limits_tknzd])
+        adapted_cond = rearrange(adapted_cond, 'l b n -> (l b) n')
+        adapted_cond = self.get_learned_conditioning(adapted_cond)
+        adapted_cond = rearrange(adapted_cond, '(l b) n d -> l b n d', l=n_crops)
+        if use_cache:
+            self._patch_bbox_cond_cache = (key, cut_cond, adapted_cond)
+        return adapted_cond
+
     def apply_model(self, x_noisy, t, cond, return_ids=False):
 
         if isinstance(cond, dict):
@@ -912,7 +985,7 @@ class LatentDiffusion(DDPM):
             z = unfold(x_noisy)  # (bn, nc * prod(**ks), L)
             # Reshape to img shape
             z = z.view((z.shape[0], -1, ks[0], ks[1], z.shape[-1]))  # (bn, nc, ks[0], ks[1], L )
-            z_list = [z[:, :, :, :, i] for i in range(z.shape[-1])]
+            n_crops = z.shape[-1]
 
             if self.cond_stage_key in ["image", "LR_image", "segmentation",
                                        'bbox_img'] and self.model.conditioning_key:  # todo check for completeness
@@ -924,59 +997,31 @@ class LatentDiffusion(DDPM):
                 c = unfold(c)
                 c = c.view((c.shape[0], -1, ks[0], ks[1], c.shape[-1]))  # (bn, nc, ks[0], ks[1], L )
 
-                cond_list = [{c_key: [c[:, :, :, :, i]]} for i in range(c.shape[-1])]
+                crop_cond = {c_key: [crops_to_batch(c)]}
 
             elif self.cond_stage_key == 'coordinates_bbox':
-                assert 'original_image_size' in self.split_input_params, 'BoudingBoxRescaling is missing original_image_size'
-
-                # assuming padding of unfold is always 0 and its dilation is always 1
-                n_patches_per_row = int((w - ks[0]) / stride[0] + 1)
-                full_img_h, full_img_w = self.split_input_params['original_image_size']
-                # as we are operating on latents, we need the factor from the original image size to the
-                # spatial latent size to properly rescale the crops for regenerating the bbox annotations
-                num_downs = self.first_stage_model.encoder.num_resolutions - 1
-                rescale_latent = 2 ** (num_downs)
-
-                # get top left postions of patches as conforming for the bbbox tokenizer, therefore we
-                # need to rescale the tl patch coordinates to be in between (0,1)
-                tl_patch_coordinates = [(rescale_latent * stride[0] * (patch_nr % n_patches_per_row) / full_img_w,
-                                         rescale_latent * stride[1] * (patch_nr // n_patches_per_row) / full_img_h)
-                                        for patch_nr in range(z.shape[-1])]
-
-                # patch_limits are tl_coord, width and height coordinates as (x_tl, y_tl, h, w)
-                patch_limits = [(x_tl, y_tl,
-                                 rescale_latent * ks[0] / full_img_w,
-                                 rescale_latent * ks[1] / full_img_h) for x_tl, y_tl in tl_patch_coordinates]
-                # patch_values = [(np.arange(x_tl,min(x_tl+ks, 1.)),np.arange(y_tl,min(y_tl+ks, 1.))) for x_tl, y_tl in tl_patch_coordinates]
-
-                # tokenize crop coordinates for the bounding boxes of the respective patches
-                patch_limits_tknzd = [torch.LongTensor(self.bbox_tokenizer._crop_encoder(bbox))[None].to(self.device)
-                                      for bbox in patch_limits]  # list of length l with tensors of shape (1, 2)
-                print(patch_limits_tknzd[0].shape)
-                # cut tknzd crop position from conditioning
                 assert isinstance(cond, dict), 'cond must be dict to be fed into model'
-                cut_cond = cond['c_crossattn'][0][..., :-2].to(self.device)
-                print(cut_cond.shape)
-
-                adapted_cond = torch.stack([torch.cat([cut_cond, p], dim=1) for p in patch_limits_tknzd])
-                adapted_cond = rearrange(adapted_cond, 'l b n -> (l b) n')
-                print(adapted_cond.shape)
-                adapted_cond = self.get_learned_conditioning(adapted_cond)
-                print(adapted_cond.shape)
-                adapted_cond = rearrange(adapted_cond, '(l b) n d -> l b n d', l=z.shape[-1])
-                print(adapted_cond.shape)
-
-                cond_list = [{'c_crossattn': [e]} for e in adapted_cond]
+                adapted_cond = self.get_patch_bbox_conditioning(cond['c_crossattn'][0], w, ks, stride, n_crops)
+                crop_cond = {'c_crossattn': [rearrange(adapted_cond, 'l b n d -> (l b) n d')]}
 
             else:
-                cond_list = [cond for i in range(z.shape[-1])]  # Todo make this more efficient
-
-            # apply model by loop over crops
-            output_list = [self.model(z_list[i], t, **cond_list[i]) for i in range(z.shape[-1])]
+                # the same conditioning for every crop
+                crop_cond = {k: [c.repeat(n_crops, *([1] * (c.dim() - 1))) for c in v] for k, v in cond.items()}
+
+            # apply model to the crops, batched crop-major as (L * bn, nc, ks[0], ks[1])
+            z = crops_to_batch(z)
+            t_crops = t.repeat(n_crops)
+            # optional split_input_params["micro_batch"] bounds the number of crops per UNet call
+            micro_batch = self.split_input_params.get("micro_batch", n_crops) * x_noisy.shape[0]
+            output_list = []
+            for i in range(0, z.shape[0], micro_batch):
+                cond_i = {k: [c[i:i + micro_batch] for c in v] for k, v in crop_cond.items()}
+                output_list.append(self.model(z[i:i + micro_batch], t_crops[i:i + micro_batch], **cond_i))
             assert not isinstance(output_list[0],
                                   tuple)  # todo cant deal with multiple model outputs check this never happens
 
-            o = torch.stack(output_list, axis=-1)
+            o = torch.cat(output_list)
+            o = rearrange(o, '(l b) c h w -> b c h w l', l=n_crops)
             o = o * weighting
             # Reverse reshape to img shape
             o = o.view((o.shape[0], -1, o.shape[-1]))  # (bn, nc * ks[0] * ks[1], L)
@@ -1406,11 +1451,12 @@ class DiffusionWrapper(pl.LightningModule):
             xc = torch.cat([x] + c_concat, dim=1)
             out = self.diffusion_model(xc, t)
         elif self.conditioning_key == 'crossattn':
-            cc = torch.cat(c_crossattn, 1)
+            # a single context is passed as is, so the cross-attention kv cache can recognize it
+            cc = c_crossattn[0] if len(c_crossattn) == 1 else torch.cat(c_crossattn, 1)
             out = self.diffusion_model(x, t, context=cc)
         elif self.conditioning_key == 'hybrid':
             xc = torch.cat([x] + c_concat, dim=1)
-            cc = torch.cat(c_crossattn, 1)
+            cc = c_crossattn[0] if len(c_crossattn) == 1 else torch.cat(c_crossattn, 1)
             out = self.diffusion_model(xc, t, context=cc)
         elif self.conditioning_key == 'adm':
             cc = c_crossattn[0]
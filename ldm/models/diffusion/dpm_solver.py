@@ -0,0 +1,314 @@
+"""SAMPLING ONLY."""
+
+import math
+import torch
+import numpy as np
+from tqdm import tqdm
+
+from ldm.models.diffusion.sampling_util import SamplerStep, check_conditioning
+from ldm.modules.diffusionmodules.util import noise_like, make_generators
+from ldm.modules.attention import CrossAttentionKVCache, cross_attention_kv_cache
+from ldm.modules.tome import reset_tome
+
+
+def make_dpm_timesteps(skip_type, num_dpm_timesteps, alphacums, verbose=True):
+    """
+    Select the discrete timesteps visited by DPM-Solver, ordered from noise to data.
+    Returns num_dpm_timesteps + 1 entries: the model is evaluated at all but the last one,
+    the last one (t=0) is the final target of the solver.
+    """
+    num_ddpm_timesteps = alphacums.shape[0]
+    assert num_dpm_timesteps < num_ddpm_timesteps, 'DPM-Solver needs fewer steps than the diffusion model has timesteps'
+    if skip_type == 'time_uniform':
+        timesteps = np.linspace(num_ddpm_timesteps - 1, 0, num_dpm_timesteps + 1)
+    elif skip_type == 'logSNR':
+        lambdas = 0.5 * np.log(alphacums) - 0.5 * np.log(1. - alphacums)
+        lambdas_uniform = np.linspace(lambdas[-1], lambdas[0], num_dpm_timesteps + 1)
+        # lambda is decreasing in t, np.interp needs increasing sample points
+        timesteps = np.interp(lambdas_uniform, lambdas[::-1], np.arange(num_ddpm_timesteps)[::-1])
+    else:
+        raise NotImplementedError(f'There is no DPM-Solver skip type called "{skip_type}"')
+    timesteps = np.round(timesteps).astype(int)
+    assert np.all(np.diff(timesteps) < 0), f'Got repeated timesteps for {num_dpm_timesteps} DPM-Solver steps'
+    if verbose:
+        print(f'Selected timesteps for dpm-solver sampler: {timesteps}')
+    return timesteps
+
+
+class DPMSolverSampler(object):
+    """
+    Multistep DPM-Solver++ (https://arxiv.org/abs/2211.01095) on the discrete schedule of the model.
+    Uses the data-prediction formulation, which stays stable under large guidance scales,
+    and reaches DDIM-quality samples in 15-20 model evaluations.
+    """
+    def __init__(self, model, schedule="linear", order=2, skip_type="time_uniform", lower_order_final=True,
+                 **kwargs):
+        super().__init__()
+        assert order in [1, 2, 3], f'DPM-Solver++ order {order} not supported'
+        self.model = model
+        self.ddpm_num_timesteps = model.num_timesteps
+        self.schedule = schedule
+        self.order = order
+        self.skip_type = skip_type
+        self.lower_order_final = lower_order_final
+
+    def make_schedule(self, dpm_num_steps, skip_type=None, verbose=True):
+        skip_type = self.skip_type if skip_type is None else skip_type
+        alphas_cumprod = self.model.alphas_cumprod
+        assert alphas_cumprod.shape[0] == self.ddpm_num_timesteps, 'alphas have to be defined for each timestep'
+        # coefficients are kept in float64 numpy, the solver only needs scalars per step
+        alphacums = alphas_cumprod.detach().cpu().double().numpy()
+        self.dpm_timesteps = make_dpm_timesteps(skip_type, dpm_num_steps, alphacums, verbose=verbose)
+        self.dpm_alphas = np.sqrt(alphacums[self.dpm_timesteps])
+        self.dpm_sigmas = np.sqrt(1. - alphacums[self.dpm_timesteps])
+        self.dpm_lambdas = np.log(self.dpm_alphas) - np.log(self.dpm_sigmas)
+
+    @torch.no_grad()
+    def sample(self,
+               S,
+               batch_size,
+               shape,
+               conditioning=None,
+               callback=None,
+               normals_sequence=None,
+               img_callback=None,
+               quantize_x0=False,
+               eta=0.,
+               mask=None,
+               x0=None,
+               temperature=1.,
+               noise_dropout=0.,
+               score_corrector=None,
+               corrector_kwargs=None,
+               verbose=True,
+               x_T=None,
+               log_every_t=100,
+               unconditional_guidance_scale=1.,
+               unconditional_conditioning=None,
+               # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+               kv_cache=False,
+               seeds=None,
+               **kwargs
+               ):
+        check_conditioning(conditioning, batch_size)
+        assert seeds is None or len(seeds) == batch_size, f'expected {batch_size} seeds, got {len(seeds)}'
+
+        if eta != 0:
+            raise ValueError('eta must be 0 for DPM-Solver')
+        self.make_schedule(dpm_num_steps=S, verbose=verbose)
+        # sampling
+        C, H, W = shape
+        size = (batch_size, C, H, W)
+        print(f'Data shape for DPM-Solver++ sampling is {size}, order {self.order}')
+
+        samples, intermediates = self.dpm_solver_sampling(conditioning, size,
+                                                          callback=callback,
+                                                          img_callback=img_callback,
+                                                          quantize_denoised=quantize_x0,
+                                                          mask=mask, x0=x0,
+                                                          score_corrector=score_corrector,
+                                                          corrector_kwargs=corrector_kwargs,
+                                                          x_T=x_T,
+                                                          log_every_t=log_every_t,
+                                                          unconditional_guidance_scale=unconditional_guidance_scale,
+                                                          unconditional_conditioning=unconditional_conditioning,
+                                                          kv_cache=kv_cache,
+                                                          generators=make_generators(seeds),
+                                                          )
+        return samples, intermediates
+
+    @torch.no_grad()
+    def sample_iter(self,
+                    S,
+                    batch_size,
+                    shape,
+                    conditioning=None,
+                    quantize_x0=False,
+                    eta=0.,
+                    mask=None,
+                    x0=None,
+                    score_corrector=None,
+                    corrector_kwargs=None,
+                    verbose=True,
+                    x_T=None,
+                    unconditional_guidance_scale=1.,
+                    unconditional_conditioning=None,
+                    kv_cache=False,
+                    start_step=0,
+                    seeds=None,
+                    **kwargs
+                    ):
+        """
+        Same as sample(), but yields a SamplerStep after every step instead of collecting intermediates.
+        Breaking out of the loop stops sampling. To resume from a saved state, pass its x as x_T and
+        its i + 1 as start_step; the multistep history is not saved, so the solver restarts at first order.
+        """
+        check_conditioning(conditioning, batch_size)
+        assert seeds is None or len(seeds) == batch_size, f'expected {batch_size} seeds, got {len(seeds)}'
+
+        if eta != 0:
+            raise ValueError('eta must be 0 for DPM-Solver')
+        self.make_schedule(dpm_num_steps=S, verbose=verbose)
+        C, H, W = shape
+        size = (batch_size, C, H, W)
+        print(f'Data shape for DPM-Solver++ sampling is {size}, order {self.order}')
+
+        yield from self.dpm_solver_sampling_iter(conditioning, size,
+                                                 quantize_denoised=quantize_x0,
+                                                 mask=mask, x0=x0,
+                                                 score_corrector=score_corrector,
+                                                 corrector_kwargs=corrector_kwargs,
+                                                 x_T=x_T,
+                                                 unconditional_guidance_scale=unconditional_guidance_scale,
+                                                 unconditional_conditioning=unconditional_conditioning,
+                                                 kv_cache=kv_cache,
+                                                 start_step=start_step,
+                                                 generators=make_generators(seeds))
+
+    @torch.no_grad()
+    def dpm_solver_sampling(self, cond, shape,
+                            x_T=None, callback=None, quantize_denoised=False,
+                            mask=None, x0=None, img_callback=None, log_every_t=100,
+                            score_corrector=None, corrector_kwargs=None,
+                            unconditional_guidance_scale=1., unconditional_conditioning=None, kv_cache=False,
+                            generators=None):
+        device = self.model.betas.device
+        if x_T is None:
+            img = noise_like(shape, device, generators=generators)
+        else:
+            img = x_T
+
+        intermediates = {'x_inter': [img], 'pred_x0': [img]}
+        for state in self.dpm_solver_sampling_iter(cond, shape, x_T=img, quantize_denoised=quantize_denoised,
+                                                   mask=mask, x0=x0, score_corrector=score_corrector,
+                                                   corrector_kwargs=corrector_kwargs,
+                                                   unconditional_guidance_scale=unconditional_guidance_scale,
+                                                   unconditional_conditioning=unconditional_conditioning,
+                                                   kv_cache=kv_cache):
+            img = state.x
+            if callback: callback(state.i)
+            if img_callback: img_callback(state.pred_x0, state.i)
+
+            if state.index % log_every_t == 0 or state.index == state.total_steps - 1:
+                intermediates['x_inter'].append(state.x)
+                intermediates['pred_x0'].append(state.pred_x0)
+
+        return img, intermediates
+
+    @torch.no_grad()
+    def dpm_solver_sampling_iter(self, cond, shape,
+                                 x_T=None, quantize_denoised=False,
+                                 mask=None, x0=None,
+                                 score_corrector=None, corrector_kwargs=None,
+                                 unconditional_guidance_scale=1., unconditional_conditioning=None,
+                                 kv_cache=False, start_step=0, generators=None):
+        """
+        generators: one torch.Generator per sample (see make_generators) for x_T, the only noise of the solver,
+        so that a sample does not depend on the batch it is part of.
+        """
+        device = self.model.betas.device
+        # token merging partitions restart with every run
+        reset_tome(self.model)
+        b = shape[0]
+        if x_T is None:
+            img = noise_like(shape, device, generators=generators)
+        else:
+            img = x_T
+
+        total_steps = self.dpm_timesteps.shape[0] - 1
+        print(f"Running DPM-Solver++ Sampling with {total_steps} timesteps")
+
+        iterator = tqdm(self.dpm_timesteps[start_step:-1], desc='DPM-Solver++ Sampler', initial=start_step,
+                        total=total_steps)
+        old_x0s = []
+        uc_c = None
+        if unconditional_conditioning is not None and unconditional_guidance_scale != 1.:
+            # the conditioning does not change between steps, concatenating it once also
+            # lets the cross-attention kv cache recognize it
+            uc_c = torch.cat([unconditional_conditioning, cond])
+
+        kv = CrossAttentionKVCache() if kv_cache else None
+        for i, step in enumerate(iterator, start_step):
+            index = total_steps - i - 1
+            ts = torch.full((b,), step, device=device, dtype=torch.long)
+
+            if mask is not None:
+                assert x0 is not None
+                img_orig = self.model.q_sample(x0, ts)  # TODO: deterministic forward pass?
+                img = img_orig * mask + (1. - mask) * img
+
+            with cross_attention_kv_cache(kv):
+                pred_x0 = self.get_model_output(img, cond, ts, i, quantize_denoised=quantize_denoised,
+                                                score_corrector=score_corrector, corrector_kwargs=corrector_kwargs,
+                                                unconditional_guidance_scale=unconditional_guidance_scale,
+                                                unconditional_conditioning=unconditional_conditioning, uc_c=uc_c)
+            old_x0s.append(pred_x0)
+            if len(old_x0s) > self.order:
+                old_x0s.pop(0)
+
+            order = min(self.order, len(old_x0s))
+            if self.lower_order_final and total_steps < 15:
+                # higher orders are unstable on the last few, very large steps
+                order = min(order, total_steps - i)
+            img = self.multistep_update(img, old_x0s, i, order)
+            yield SamplerStep(i, index, int(step), total_steps, img, pred_x0)
+
+    @torch.no_grad()
+    def get_model_output(self, x, c, t, i, quantize_denoised=False, score_corrector=None, corrector_kwargs=None,
+                         unconditional_guidance_scale=1., unconditional_conditioning=None, uc_c=None):
+        """
+        Data prediction x0(x_t, t) for the i-th selected timestep. uc_c is
+        torch.cat([unconditional_conditioning, c]) when the caller built it once for all steps.
+        """
+        if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
+            model_out = self.model.apply_model(x, t, c)
+        else:
+            x_in = torch.cat([x] * 2)
+            t_in = torch.cat([t] * 2)
+            c_in = torch.cat([unconditional_conditioning, c]) if uc_c is None else uc_c
+            model_uncond, model_out = self.model.apply_model(x_in, t_in, c_in).chunk(2)
+            model_out = model_uncond + unconditional_guidance_scale * (model_out - model_uncond)
+
+        if score_corrector is not None:
+            assert self.model.parameterization == "eps"
+            model_out = score_corrector.modify_score(self.model, model_out, x, t, c, **corrector_kwargs)
+
+        if self.model.parameterization == "eps":
+            pred_x0 = (x - float(self.dpm_sigmas[i]) * model_out) / float(self.dpm_alphas[i])
+        elif self.model.parameterization == "x0":
+            pred_x0 = model_out
+        else:
+            raise NotImplementedError()
+
+        if quantize_denoised:
+            pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
+        return pred_x0
+
+    def multistep_update(self, x, old_x0s, i, order):
+        """
+        Advance x from the i-th to the (i+1)-th selected timestep with a DPM-Solver++ step of the given order.
+        old_x0s holds the data predictions of the most recent steps, newest last.
+        """
+        lambdas, alphas, sigmas = self.dpm_lambdas.tolist(), self.dpm_alphas.tolist(), self.dpm_sigmas.tolist()
+        h = lambdas[i + 1] - lambdas[i]
+        phi_1 = math.expm1(-h)
+        m0 = old_x0s[-1]
+        x_next = (sigmas[i + 1] / sigmas[i]) * x - (alphas[i + 1] * phi_1) * m0
+
+        if order == 2:
+            m1 = old_x0s[-2]
+            r0 = (lambdas[i] - lambdas[i - 1]) / h
+            d1 = (1. / r0) * (m0 - m1)
+            x_next = x_next - (0.5 * alphas[i + 1] * phi_1) * d1
+        elif order == 3:
+            m1, m2 = old_x0s[-2], old_x0s[-3]
+            r0 = (lambdas[i] - lambdas[i - 1]) / h
+            r1 = (lambdas[i - 1] - lambdas[i - 2]) / h
+            d1_0 = (1. / r0) * (m0 - m1)
+            d1_1 = (1. / r1) * (m1 - m2)
+            d1 = d1_0 + (r0 / (r0 + r1)) * (d1_0 - d1_1)
+            d2 = (1. / (r0 + r1)) * (d1_0 - d1_1)
+            phi_2 = phi_1 / h + 1.
+            phi_3 = phi_2 / h - 0.5
+            x_next = x_next + (alphas[i + 1] * phi_2) * d1 - (alphas[i + 1] * phi_3) * d2
+        return x_next
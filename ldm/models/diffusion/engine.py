@@ -0,0 +1,182 @@
+"""SAMPLING ONLY."""
+
+import torch
+import numpy as np
+
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.sampling_util import make_ddim_schedule
+from ldm.modules.diffusionmodules.util import make_generators, noise_like
+
+
+def _as_floats(x):
+    if isinstance(x, torch.Tensor):
+        x = x.detach().cpu()
+    return np.asarray(x, dtype=np.float64).tolist()
+
+
+class SamplingRequest(object):
+    """
+    A single sample to be produced by the ContinuousBatchingEngine, with its own number of DDIM steps,
+    eta and guidance scale. conditioning and unconditional_conditioning hold one row, e.g. (1, 77, 768).
+    x_T and the per-step noise are drawn from seed like DDIMSampler.sample(seeds=[seed]) does, so a request gives
+    the same sample as on its own; without a seed, one is drawn from the global random state.
+    Once finished, the latent is available as request.samples.
+    """
+    def __init__(self, conditioning, S=50, eta=0., unconditional_guidance_scale=1., unconditional_conditioning=None,
+                 x_T=None, seed=None, callback=None):
+        if isinstance(conditioning, dict):
+            raise NotImplementedError('the continuous batching engine only supports tensor conditionings')
+        self.conditioning = conditioning
+        self.S = S
+        self.eta = eta
+        self.unconditional_guidance_scale = unconditional_guidance_scale
+        self.unconditional_conditioning = unconditional_conditioning
+        self.x_T = x_T
+        self.seed = seed
+        self.callback = callback
+        self.samples = None
+
+    @property
+    def guided(self):
+        return self.unconditional_conditioning is not None and self.unconditional_guidance_scale != 1.
+
+    @property
+    def done(self):
+        return self.samples is not None
+
+
+class _Row(object):
+    # per-row sampling state: the request and its position on its own DDIM schedule
+    def __init__(self, request, generator, timesteps, alphas, alphas_prev, sigmas, sqrt_one_minus_alphas):
+        self.request = request
+        self.generator = generator
+        self.timesteps = timesteps
+        self.alphas = alphas
+        self.alphas_prev = alphas_prev
+        self.sigmas = sigmas
+        self.sqrt_one_minus_alphas = sqrt_one_minus_alphas
+        self.i = 0
+
+    @property
+    def total_steps(self):
+        return len(self.timesteps)
+
+    @property
+    def index(self):
+        return self.total_steps - self.i - 1
+
+
+class ContinuousBatchingEngine(object):
+    """
+    Runs DDIM over a pool of in-flight latents that do not have to share S, eta or the guidance scale.
+    Every row carries its own timestep index and alpha coefficients; new requests join the batch at step
+    boundaries and finished rows leave it without stalling the others. All rows share the latent shape.
+    scripts/server.py keeps its own Batcher: it serves PLMS and DPM-Solver as well, which have no per-row
+    schedule, and batches only requests with the same steps and scale, so it needs none.
+
+        engine = ContinuousBatchingEngine(model, shape=(4, 64, 64), max_batch_size=8)
+        engine.submit(SamplingRequest(c, S=50, unconditional_guidance_scale=7.5, unconditional_conditioning=uc))
+        while engine.has_work:
+            for request in engine.step():
+                x = model.decode_first_stage(request.samples)
+    """
+    def __init__(self, model, shape, max_batch_size=8):
+        self.model = model
+        self.sampler = DDIMSampler(model)
+        self.shape = tuple(shape)
+        self.max_batch_size = max_batch_size
+        self.pending = []
+        self.rows = []
+        self.x = None
+
+    @property
+    def num_active(self):
+        return len(self.rows)
+
+    @property
+    def has_work(self):
+        return len(self.rows) > 0 or len(self.pending) > 0
+
+    def submit(self, request):
+        self.pending.append(request)
+        return request
+
+    def _admit(self):
+        device = self.model.betas.device
+        new_x = []
+        while self.pending and len(self.rows) < self.max_batch_size:
+            request = self.pending.pop(0)
+            schedule = make_ddim_schedule(self.model, request.S, ddim_eta=request.eta, verbose=False)
+            seed = request.seed if request.seed is not None else int(torch.randint(2 ** 63 - 1, ()))
+            generator = make_generators([seed])[0]
+            self.rows.append(_Row(request, generator, schedule['ddim_timesteps'].tolist(),
+                                  _as_floats(schedule['ddim_alphas']),
+                                  _as_floats(schedule['ddim_alphas_prev']),
+                                  _as_floats(schedule['ddim_sigmas']),
+                                  _as_floats(schedule['ddim_sqrt_one_minus_alphas'])))
+            if request.x_T is None:
+                x_T = noise_like((1,) + self.shape, device, generators=[generator])
+            else:
+                x_T = request.x_T.reshape((1,) + self.shape).to(device)
+            new_x.append(x_T)
+        if new_x:
+            self.x = torch.cat(([self.x] if self.x is not None else []) + new_x)
+
+    def _coefficient(self, name):
+        values = [getattr(row, name)[row.index] for row in self.rows]
+        return torch.tensor(values, device=self.x.device, dtype=self.x.dtype).view(-1, 1, 1, 1)
+
+    @torch.no_grad()
+    def get_eps(self, x, t):
+        """Model eps for every row, unconditional rows are only evaluated for requests that use guidance."""
+        requests = [row.request for row in self.rows]
+        c = torch.cat([r.conditioning for r in requests])
+        guided = [k for k, r in enumerate(requests) if r.guided]
+        if not guided:
+            return self.model.apply_model(x, t, c)
+
+        x_in = torch.cat([x, x[guided]])
+        t_in = torch.cat([t, t[guided]])
+        c_in = torch.cat([c] + [requests[k].unconditional_conditioning for k in guided])
+        e_t, e_t_uncond = self.model.apply_model(x_in, t_in, c_in).split([len(requests), len(guided)])
+        scale = torch.tensor([requests[k].unconditional_guidance_scale for k in guided],
+                             device=x.device, dtype=e_t.dtype).view(-1, 1, 1, 1)
+        e_t = e_t.clone()
+        e_t[guided] = e_t_uncond + scale * (e_t[guided] - e_t_uncond)
+        return e_t
+
+    @torch.no_grad()
+    def step(self):
+        """Admit pending requests, advance every in-flight row by one step and return the finished requests."""
+        self._admit()
+        if not self.rows:
+            return []
+
+        t = torch.tensor([row.timesteps[row.index] for row in self.rows], device=self.x.device, dtype=torch.long)
+        e_t = self.get_eps(self.x, t)
+        self.x, _ = self.sampler.ddim_update(self.x, e_t,
+                                             self._coefficient('alphas'),
+                                             self._coefficient('alphas_prev'),
+                                             self._coefficient('sigmas'),
+                                             self._coefficient('sqrt_one_minus_alphas'),
+                                             generators=[row.generator for row in self.rows])
+
+        finished, keep = [], []
+        for k, row in enumerate(self.rows):
+            if row.request.callback: row.request.callback(row.i)
+            row.i += 1
+            if row.i == row.total_steps:
+                row.request.samples = self.x[k:k + 1]
+                finished.append(row.request)
+            else:
+                keep.append(k)
+        if finished:
+            self.rows = [self.rows[k] for k in keep]
+            self.x = self.x[keep] if keep else None
+        return finished
+
+    def run_until_complete(self):
+        finished = []
+        while self.has_work:
+            finished.extend(self.step())
+        return finished
@@ -0,0 +1,235 @@
+import weakref
+from collections import OrderedDict
+
+import torch
+import numpy as np
+
+from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like
+
+
+class ScheduleCache(object):
+    """Least-recently-used cache, for sampler schedules and the fold/unfold operators of split-input sampling."""
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class SamplerStep(object):
+    """
+    State after one sampler step, as yielded by the samplers' iterator API.
+    i counts steps from 0, index is the position on the sampler's schedule (counting down) and
+    timestep the diffusion timestep the model was evaluated at. x is the latent after the step.
+    """
+    __slots__ = ('i', 'index', 'timestep', 'total_steps', 'x', 'pred_x0')
+
+    def __init__(self, i, index, timestep, total_steps, x, pred_x0=None):
+        self.i = i
+        self.index = index
+        self.timestep = timestep
+        self.total_steps = total_steps
+        self.x = x
+        self.pred_x0 = pred_x0
+
+    @property
+    def is_last(self):
+        return self.i == self.total_steps - 1
+
+
+def check_conditioning(conditioning, batch_size):
+    """Warns if the conditioning, a tensor or a dict of tensors, does not have batch_size rows."""
+    if conditioning is not None:
+        if isinstance(conditioning, dict):
+            cbs = conditioning[list(conditioning.keys())[0]].shape[0]
+            if cbs != batch_size:
+                print(f"Warning: Got {cbs} conditionings but batch-size is {batch_size}")
+        else:
+            if conditioning.shape[0] != batch_size:
+                print(f"Warning: Got {conditioning.shape[0]} conditionings but batch-size is {batch_size}")
+
+
+# one cache per diffusion model, dropped together with the model
+_schedule_caches = weakref.WeakKeyDictionary()
+
+
+def get_schedule_cache(model):
+    if model not in _schedule_caches:
+        _schedule_caches[model] = ScheduleCache()
+    return _schedule_caches[model]
+
+
+def make_ddim_schedule(model, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., dtype=torch.float32,
+                       verbose=True):
+    """
+    Buffers of the DDIM/PLMS sampling schedule for model, as a dict of name -> tensor (or array).
+    Schedules are cached per model, keyed by (num_steps, eta, discretize, device, dtype),
+    so repeated sample() calls with the same settings do not rebuild them.
+    """
+    cache = get_schedule_cache(model)
+    key = (ddim_num_steps, float(ddim_eta), ddim_discretize, model.device, dtype)
+    schedule = cache.get(key)
+    if schedule is not None:
+        return schedule
+
+    ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
+                                         num_ddpm_timesteps=model.num_timesteps, verbose=verbose)
+    alphas_cumprod = model.alphas_cumprod
+    assert alphas_cumprod.shape[0] == model.num_timesteps, 'alphas have to be defined for each timestep'
+    to_torch = lambda x: x.clone().detach().to(dtype).to(model.device)
+    to_device = lambda x: x.to(model.device) if isinstance(x, torch.Tensor) else x
+
+    schedule = {'ddim_timesteps': ddim_timesteps}
+    schedule['betas'] = to_torch(model.betas)
+    schedule['alphas_cumprod'] = to_torch(alphas_cumprod)
+    schedule['alphas_cumprod_prev'] = to_torch(model.alphas_cumprod_prev)
+
+    # calculations for diffusion q(x_t | x_{t-1}) and others
+    schedule['sqrt_alphas_cumprod'] = to_torch(np.sqrt(alphas_cumprod.cpu()))
+    schedule['sqrt_one_minus_alphas_cumprod'] = to_torch(np.sqrt(1. - alphas_cumprod.cpu()))
+    schedule['log_one_minus_alphas_cumprod'] = to_torch(np.log(1. - alphas_cumprod.cpu()))
+    schedule['sqrt_recip_alphas_cumprod'] = to_torch(np.sqrt(1. / alphas_cumprod.cpu()))
+    schedule['sqrt_recipm1_alphas_cumprod'] = to_torch(np.sqrt(1. / alphas_cumprod.cpu() - 1))
+
+    # ddim sampling parameters
+    ddim_sigmas, ddim_alphas, ddim_alphas_prev = make_ddim_sampling_parameters(alphacums=alphas_cumprod.cpu(),
+                                                                               ddim_timesteps=ddim_timesteps,
+                                                                               eta=ddim_eta, verbose=verbose)
+    schedule['ddim_sigmas'] = to_device(ddim_sigmas)
+    schedule['ddim_alphas'] = to_device(ddim_alphas)
+    schedule['ddim_alphas_prev'] = to_device(ddim_alphas_prev)
+    schedule['ddim_sqrt_one_minus_alphas'] = to_device(np.sqrt(1. - ddim_alphas))
+    sigmas_for_original_sampling_steps = ddim_eta * torch.sqrt(
+        (1 - schedule['alphas_cumprod_prev']) / (1 - schedule['alphas_cumprod']) * (
+                    1 - schedule['alphas_cumprod'] / schedule['alphas_cumprod_prev']))
+    schedule['ddim_sigmas_for_original_num_steps'] = sigmas_for_original_sampling_steps
+    schedule['ddim_step_coefficients'] = make_ddim_step_coefficients(ddim_alphas, ddim_alphas_prev, ddim_sigmas,
+                                                                     dtype=dtype, device=model.device)
+
+    cache.put(key, schedule)
+    return schedule
+
+
+def make_ddim_step_coefficients(alphas, alphas_prev, sigmas, dtype=torch.float32, device=None):
+    """
+    All scalars of the DDIM update for every step as one (num_steps, 5) tensor with columns
+    1 / sqrt(a_t), sqrt(1 - a_t), sqrt(a_prev), sqrt(1 - a_prev - sigma_t^2) and sigma_t.
+    """
+    alphas, alphas_prev, sigmas = [torch.as_tensor(np.asarray(v, dtype=np.float64)) for v in
+                                   (alphas, alphas_prev, sigmas)]
+    coefficients = torch.stack([1. / alphas.sqrt(),
+                                (1. - alphas).sqrt(),
+                                alphas_prev.sqrt(),
+                                (1. - alphas_prev - sigmas ** 2).sqrt(),
+                                sigmas], dim=1)
+    return coefficients.to(dtype).to(device)
+
+
+def _predict_x0(x, e_t, c, out):
+    torch.addcmul(x, e_t, c[1], value=-1., out=out)
+    return out.mul_(c[0])
+
+
+def _step_from_x0(x, pred_x0, e_t, c, out, noise=None, temperature=1.):
+    torch.mul(pred_x0, c[2], out=out)
+    out.addcmul_(e_t, c[3])
+    if noise is not None:
+        out.addcmul_(noise, c[4], value=temperature)
+    return out
+
+
+def _ddim_update(x, e_t, c, pred_x0, out, noise=None, temperature=1.):
+    _predict_x0(x, e_t, c, pred_x0)
+    return _step_from_x0(x, pred_x0, e_t, c, out, noise=noise, temperature=temperature), pred_x0
+
+
+class StaticDDIMStep(object):
+    """
+    Allocation-free DDIM update for a fixed batch shape, used by the fast path of the DDIM and PLMS samplers.
+    The per-step coefficients are views into a single device tensor (see make_ddim_step_coefficients), the
+    timestep, guidance input and output tensors are preallocated and the update runs as a few fused in-place
+    ops. Only per-sample noise (generators) and noise_dropout allocate.
+    With compile=True (PyTorch >= 2.0, fast_step="compile" in the samplers) the update is captured by
+    torch.compile as one graph. The coefficients enter it as tensors, so all steps share that graph.
+    The returned x_prev and pred_x0 are buffers that later steps overwrite: clone them to keep them around.
+    """
+    def __init__(self, coefficients, shape, dtype=None, compile=False, generators=None):
+        device = coefficients.device
+        dtype = coefficients.dtype if dtype is None else dtype
+        self.coefficients = coefficients.to(dtype)
+        # the five scalars of every step as 0-d views, so that a step does not index the tensor
+        self.step_coefficients = [tuple(row) for row in self.coefficients]
+        self.stochastic = bool(coefficients[:, 4].any())
+        self.ts = torch.empty(shape[0], dtype=torch.long, device=device)
+        self.c = self.step_coefficients[0]
+        self.pred_x0 = torch.empty(shape, dtype=dtype, device=device)
+        self.noise = torch.empty(shape, dtype=dtype, device=device) if self.stochastic else None
+        # one generator per sample for the noise, see noise_like
+        self.generators = generators
+        self.x_buffers = [torch.empty(shape, dtype=dtype, device=device) for _ in range(2)]
+        self.x_in = None
+        self.t_in = None
+        self.update = _ddim_update
+        if compile and hasattr(torch, "compile"):
+            self.update = torch.compile(_ddim_update)
+
+    def timesteps(self, t):
+        self.ts.fill_(int(t))
+        return self.ts
+
+    def guidance_inputs(self, x, t):
+        """x and t stacked twice for the [unconditional, conditional] model evaluation."""
+        if self.x_in is None:
+            self.x_in = torch.empty((2 * x.shape[0],) + tuple(x.shape[1:]), dtype=x.dtype, device=x.device)
+            self.t_in = torch.empty(2 * t.shape[0], dtype=t.dtype, device=t.device)
+        b = x.shape[0]
+        self.x_in[:b].copy_(x)
+        self.x_in[b:].copy_(x)
+        self.t_in[:b].copy_(t)
+        self.t_in[b:].copy_(t)
+        return self.x_in, self.t_in
+
+    def _out(self, x):
+        # never write into the buffer that holds the input
+        return self.x_buffers[1] if x is self.x_buffers[0] else self.x_buffers[0]
+
+    def _noise(self, noise_dropout=0.):
+        if not self.stochastic:
+            return None
+        if self.generators is not None:
+            noise = self.noise.copy_(noise_like(self.noise.shape, self.noise.device, generators=self.generators))
+        else:
+            noise = self.noise.normal_()
+        if noise_dropout > 0.:
+            noise = torch.nn.functional.dropout(noise, p=noise_dropout)
+        return noise
+
+    def predict_x0(self, x, e_t, index):
+        self.c = self.step_coefficients[index]
+        return _predict_x0(x, e_t, self.c, self.pred_x0)
+
+    def step_from_x0(self, x, pred_x0, e_t, temperature=1., noise_dropout=0.):
+        """The update from a (possibly modified) pred_x0 of the step set by the last predict_x0()."""
+        return _step_from_x0(x, pred_x0, e_t, self.c, self._out(x), noise=self._noise(noise_dropout),
+                             temperature=temperature)
+
+    def __call__(self, x, e_t, index, temperature=1., noise_dropout=0.):
+        self.c = self.step_coefficients[index]
+        return self.update(x, e_t, self.c, self.pred_x0, self._out(x), noise=self._noise(noise_dropout),
+                           temperature=temperature)
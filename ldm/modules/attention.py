@@ -1,11 +1,15 @@
 from inspect import isfunction
+from functools import partial
+from contextlib import contextmanager
 import math
+import threading
 import torch
 import torch.nn.functional as F
-from torch import nn, einsum
+from torch import nn
 from einops import rearrange, repeat
 
 from ldm.modules.diffusionmodules.util import checkpoint
+from ldm.modules.attention_backends import attention
 
 
 def exists(val):
@@ -122,6 +126,7 @@ class SpatialSelfAttention(nn.Module):
                                         kernel_size=1,
                                         stride=1,
                                         padding=0)
+        self.attention_backend = None
 
     def forward(self, x):
         h_ = x
@@ -132,23 +137,61 @@ class SpatialSelfAttention(nn.Module):
 
         # compute attention
         b,c,h,w = q.shape
-        q = rearrange(q, 'b c h w -> b (h w) c')
-        k = rearrange(k, 'b c h w -> b c (h w)')
-        w_ = torch.einsum('bij,bjk->bik', q, k)
-
-        w_ = w_ * (int(c)**(-0.5))
-        w_ = torch.nn.functional.softmax(w_, dim=2)
-
-        # attend to values
-        v = rearrange(v, 'b c h w -> b c (h w)')
-        w_ = rearrange(w_, 'b i j -> b j i')
-        h_ = torch.einsum('bij,bjk->bik', v, w_)
-        h_ = rearrange(h_, 'b c (h w) -> b c h w', h=h)
+        q, k, v = map(lambda t: rearrange(t, 'b c h w -> b (h w) c'), (q, k, v))
+        h_ = attention(q, k, v, scale=int(c)**(-0.5), backend=self.attention_backend)
+        h_ = rearrange(h_, 'b (h w) c -> b c h w', h=h)
         h_ = self.proj_out(h_)
 
         return x+h_
 
 
+class CrossAttentionKVCache(object):
+    """
+    Projected and head-split keys/values of cross-attention layers, reused for as long as a layer
+    sees the very same context tensor (compared by identity). A sampling run owns one cache and
+    activates it around its model calls with cross_attention_kv_cache().
+    """
+    def __init__(self):
+        self.entries = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_kv(self, layer, context):
+        entry = self.entries.get(layer)
+        if entry is not None and entry[0] is context:
+            self.hits += 1
+            return entry[1], entry[2]
+        self.misses += 1
+        k, v = layer.project_kv(context)
+        # keeping a reference to the context keeps its identity from being reused
+        self.entries[layer] = (context, k, v)
+        return k, v
+
+    def clear(self):
+        self.entries.clear()
+
+
+# the cache of the model call running on this thread, see cross_attention_kv_cache()
+_kv_cache = threading.local()
+
+
+@contextmanager
+def cross_attention_kv_cache(cache):
+    """
+    Let the cross-attention layers that run on this thread inside the context use cache, a
+    CrossAttentionKVCache or None. The text context is constant across all steps of a sampling run, so
+    with one cache per run to_k/to_v only run on the first step, as long as the caller passes the same
+    context tensor every step. Enter it around the model calls of a step only, never across a yield:
+    interleaved sampling generators would otherwise see each other's cache.
+    """
+    previous = getattr(_kv_cache, "cache", None)
+    _kv_cache.cache = cache
+    try:
+        yield cache
+    finally:
+        _kv_cache.cache = previous
+
+
 class CrossAttention(nn.Module):
     def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0.):
         super().__init__()
@@ -166,29 +209,30 @@ class CrossAttention(nn.Module):
             nn.Linear(inner_dim, query_dim),
             nn.Dropout(dropout)
         )
+        self.attention_backend = None
 
-    def forward(self, x, context=None, mask=None):
-        h = self.heads
-
-        q = self.to_q(x)
-        context = default(context, x)
+    def project_kv(self, context):
         k = self.to_k(context)
         v = self.to_v(context)
+        return tuple(rearrange(t, 'b n (h d) -> (b h) n d', h=self.heads) for t in (k, v))
 
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
+    def forward(self, x, context=None, mask=None):
+        h = self.heads
 
-        sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
+        q = self.to_q(x)
+        q = rearrange(q, 'b n (h d) -> (b h) n d', h=h)
+        kv_cache = getattr(_kv_cache, "cache", None)
+        if context is not None and kv_cache is not None:
+            k, v = kv_cache.get_kv(self, context)
+        else:
+            k, v = self.project_kv(default(context, x))
 
         if exists(mask):
             mask = rearrange(mask, 'b ... -> b (...)')
-            max_neg_value = -torch.finfo(sim.dtype).max
             mask = repeat(mask, 'b j -> (b h) () j', h=h)
-            sim.masked_fill_(~mask, max_neg_value)
 
         # attention, what we cannot get enough of
-        attn = sim.softmax(dim=-1)
-
-        out = einsum('b i j, b j d -> b i d', attn, v)
+        out = attention(q, k, v, scale=self.scale, mask=mask, backend=self.attention_backend)
         out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
         return self.to_out(out)
 
@@ -204,10 +248,20 @@ class BasicTransformerBlock(nn.Module):
         self.norm2 = nn.LayerNorm(dim)
         self.norm3 = nn.LayerNorm(dim)
         self.checkpoint = checkpoint
+        self.tome = None  # token merging settings, see ldm.modules.tome.apply_tome
 
-    def forward(self, x, context=None):
+    def forward(self, x, context=None, hw=None):
+        if self.tome is not None and hw is not None:
+            return checkpoint(partial(self._forward_tome, hw=hw), (x, context), self.parameters(), self.checkpoint)
         return checkpoint(self._forward, (x, context), self.parameters(), self.checkpoint)
 
+    def _forward_tome(self, x, context=None, hw=None):
+        m_a, u_a, m_c, u_c, m_m, u_m = self.tome.merge_fns(x, hw)
+        x = u_a(self.attn1(m_a(self.norm1(x)))) + x
+        x = u_c(self.attn2(m_c(self.norm2(x)), context=context)) + x
+        x = u_m(self.ff(m_m(self.norm3(x)))) + x
+        return x
+
     def _forward(self, x, context=None):
         x = self.attn1(self.norm1(x)) + x
         x = self.attn2(self.norm2(x), context=context) + x
@@ -255,7 +309,7 @@ class SpatialTransformer(nn.Module):
         x = self.proj_in(x)
         x = rearrange(x, 'b c h w -> b (h w) c')
         for block in self.transformer_blocks:
-            x = block(x, context=context)
+            x = block(x, context=context, hw=(h, w))
         x = rearrange(x, 'b (h w) c -> b c h w', h=h, w=w)
         x = self.proj_out(x)
         return x + x_in
\ No newline at end of file
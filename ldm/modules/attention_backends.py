@@ -0,0 +1,157 @@
+"""
+Scaled dot-product attention backends shared by all attention layers.
+
+Every layer calls attention(q, k, v, ...) with q: (B, N, D), k: (B, M, D) and v: (B, M, Dv), where B already
+contains the heads, and gets (B, N, Dv) back. Which backend runs is decided per layer by its attention_backend
+attribute (set from config, see set_attention_backend), falling back to the process-wide default.
+"""
+import math
+import threading
+from contextlib import contextmanager
+
+import torch
+import torch.nn.functional as F
+
+
+ATTENTION_BACKENDS = dict()
+_default_backend = "naive"
+# bytes the chunked backend may spend on the similarities of one chunk of queries
+_memory_budget = 256 * 2 ** 20
+# callables fn(q, k, v) that see every attention call, e.g. for counting FLOPs. The tuple is replaced, never
+# changed, under the lock, so attention() can iterate over it on any thread without locking
+_attention_observers = ()
+_attention_observers_lock = threading.Lock()
+
+
+def register_attention_backend(name):
+    def register(fn):
+        ATTENTION_BACKENDS[name] = fn
+        return fn
+    return register
+
+
+@register_attention_backend("naive")
+def naive_attention(q, k, v, scale=None, mask=None, upcast=False):
+    """Materializes the full (B, N, M) similarity matrix."""
+    scale = q.shape[-1] ** -0.5 if scale is None else scale
+    if upcast:
+        # scaling q and k separately is more stable with f16 than dividing afterwards
+        s = math.sqrt(scale)
+        sim = torch.einsum('b i d, b j d -> b i j', q * s, k * s)
+    else:
+        sim = torch.einsum('b i d, b j d -> b i j', q, k) * scale
+    if mask is not None:
+        sim.masked_fill_(~mask, -torch.finfo(sim.dtype).max)
+    if upcast:
+        attn = sim.float().softmax(dim=-1).type(sim.dtype)
+    else:
+        attn = sim.softmax(dim=-1)
+    return torch.einsum('b i j, b j d -> b i d', attn, v)
+
+
+@register_attention_backend("sdpa")
+def sdpa_attention(q, k, v, scale=None, mask=None, upcast=False):
+    """torch.nn.functional.scaled_dot_product_attention (PyTorch >= 2.0), naive attention on older versions."""
+    if not hasattr(F, "scaled_dot_product_attention"):
+        return naive_attention(q, k, v, scale=scale, mask=mask, upcast=upcast)
+    if scale is not None:
+        # the scale argument of sdpa only exists from PyTorch 2.1 on
+        q = q * (scale * math.sqrt(q.shape[-1]))
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+
+
+def get_attention_memory_budget():
+    return _memory_budget
+
+
+def set_attention_memory_budget(num_bytes):
+    """Memory the chunked backend may use for the similarity matrix of one chunk of queries."""
+    global _memory_budget
+    assert num_bytes > 0, 'the attention memory budget has to be positive'
+    _memory_budget = int(num_bytes)
+
+
+def attention_chunk_size(q, k, upcast=False, budget=None):
+    """Number of queries whose similarities and softmax fit into the memory budget, at least one."""
+    budget = _memory_budget if budget is None else budget
+    # sim and its softmax, plus the float32 copies when upcasting
+    bytes_per_entry = q.element_size() + (8 if upcast else q.element_size())
+    bytes_per_query = q.shape[0] * k.shape[1] * bytes_per_entry
+    return max(1, int(budget // bytes_per_query))
+
+
+@register_attention_backend("chunked")
+def chunked_attention(q, k, v, scale=None, mask=None, upcast=False, chunk_size=None):
+    """
+    Naive attention over chunks of queries, so only (B, chunk_size, M) similarities exist at a time.
+    By default chunk_size is derived from the memory budget (see set_attention_memory_budget), which keeps
+    peak memory linear in the number of tokens instead of quadratic.
+    """
+    if chunk_size is None:
+        chunk_size = attention_chunk_size(q, k, upcast=upcast)
+    n = q.shape[1]
+    if n <= chunk_size:
+        return naive_attention(q, k, v, scale=scale, mask=mask, upcast=upcast)
+    out = q.new_empty(q.shape[:2] + v.shape[2:])
+    for i in range(0, n, chunk_size):
+        mask_i = mask[:, i:i + chunk_size] if mask is not None and mask.shape[1] != 1 else mask
+        out[:, i:i + chunk_size] = naive_attention(q[:, i:i + chunk_size], k, v, scale=scale, mask=mask_i,
+                                                   upcast=upcast)
+    return out
+
+
+def get_attention_backend():
+    return _default_backend
+
+
+def set_attention_backend(name, model=None):
+    """
+    Select the attention backend for all layers of model, or the process-wide default if model is None.
+    name=None on a model makes its layers follow the default again.
+    """
+    global _default_backend
+    if name is not None and name not in ATTENTION_BACKENDS:
+        raise ValueError(f'Unknown attention backend "{name}", choose from {list(ATTENTION_BACKENDS.keys())}')
+    if model is None:
+        assert name is not None, 'the default attention backend can not be None'
+        _default_backend = name
+        return
+    for module in model.modules():
+        if hasattr(module, "attention_backend"):
+            module.attention_backend = name
+
+
+@contextmanager
+def attention_backend(name):
+    """Temporarily change the default backend, e.g. `with attention_backend("sdpa"): model.apply_model(...)`."""
+    previous = get_attention_backend()
+    set_attention_backend(name)
+    try:
+        yield
+    finally:
+        set_attention_backend(previous)
+
+
+def add_attention_observer(fn):
+    global _attention_observers
+    with _attention_observers_lock:
+        _attention_observers = _attention_observers + (fn,)
+
+
+def remove_attention_observer(fn):
+    global _attention_observers
+    with _attention_observers_lock:
+        observers = list(_attention_observers)
+        observers.remove(fn)
+        _attention_observers = tuple(observers)
+
+
+def attention(q, k, v, scale=None, mask=None, upcast=False, backend=None):
+    """
+    Attention of q: (B, N, D) over k: (B, M, D), v: (B, M, Dv) with the given backend or the default one.
+    mask is a boolean (B, 1 or N, M) tensor, False entries are not attended to. scale defaults to D ** -0.5.
+    upcast computes the softmax in float32.
+    """
+    for fn in _attention_observers:
+        fn(q, k, v)
+    return ATTENTION_BACKENDS[backend or _default_backend](q, k, v, scale=scale, mask=mask, upcast=upcast)
@@ -1,6 +1,8 @@
 from abc import abstractmethod
+from contextlib import contextmanager
 from functools import partial
 import math
+import threading
 from typing import Iterable
 
 import numpy as np
@@ -16,8 +18,10 @@ from ldm.modules.diffusionmodules.util import (
     zero_module,
     normalization,
     timestep_embedding,
+    FlopCounter,
 )
 from ldm.modules.attention import SpatialTransformer
+from ldm.modules.attention_backends import attention, set_attention_backend
 
 
 # dummy replace
@@ -352,6 +356,7 @@ class QKVAttentionLegacy(nn.Module):
     def __init__(self, n_heads):
         super().__init__()
         self.n_heads = n_heads
+        self.attention_backend = None
 
     def forward(self, qkv):
         """
@@ -363,13 +368,9 @@ class QKVAttentionLegacy(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = th.einsum(
-            "bct,bcs->bts", q * scale, k * scale
-        )  # More stable with f16 than dividing afterwards
-        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = th.einsum("bts,bcs->bct", weight, v)
-        return a.reshape(bs, -1, length)
+        a = attention(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), scale=1 / math.sqrt(ch),
+                      upcast=True, backend=self.attention_backend)
+        return a.transpose(1, 2).reshape(bs, -1, length)
 
     @staticmethod
     def count_flops(model, _x, y):
@@ -384,6 +385,7 @@ class QKVAttention(nn.Module):
     def __init__(self, n_heads):
         super().__init__()
         self.n_heads = n_heads
+        self.attention_backend = None
 
     def forward(self, qkv):
         """
@@ -394,22 +396,116 @@ class QKVAttention(nn.Module):
         bs, width, length = qkv.shape
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
-        q, k, v = qkv.chunk(3, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = th.einsum(
-            "bct,bcs->bts",
-            (q * scale).view(bs * self.n_heads, ch, length),
-            (k * scale).view(bs * self.n_heads, ch, length),
-        )  # More stable with f16 than dividing afterwards
-        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = th.einsum("bts,bcs->bct", weight, v.reshape(bs * self.n_heads, ch, length))
-        return a.reshape(bs, -1, length)
+        q, k, v = map(lambda t: t.reshape(bs * self.n_heads, ch, length).transpose(1, 2), qkv.chunk(3, dim=1))
+        a = attention(q, k, v, scale=1 / math.sqrt(ch), upcast=True, backend=self.attention_backend)
+        return a.transpose(1, 2).reshape(bs, -1, length)
 
     @staticmethod
     def count_flops(model, _x, y):
         return count_flops_attn(model, _x, y)
 
 
+class DeepCache(object):
+    """
+    DeepCache (https://arxiv.org/abs/2312.00858) feature reuse for UNetModel across adjacent sampling steps.
+    On every interval-th step the full UNet runs and the features entering the output block that pairs with
+    input block `branch` are cached. On the steps in between only input blocks 0..branch and their output
+    blocks run, on top of the cached deep features. A sampling run owns one cache and activates it around its
+    model calls with unet_deep_cache().
+    Features are stored per UNet call of a step, so several calls per step (PLMS's first step, the crops of
+    split-input sampling) each reuse their own features.
+
+    The first full and the first reusing call are run under a FlopCounter, summary() reports the savings;
+    the samplers return it as intermediates["deep_cache"].
+    """
+    def __init__(self, interval=3, branch=0):
+        assert interval >= 1, 'the DeepCache interval has to be at least 1'
+        self.interval = interval
+        self.branch = branch
+        self.step_index = 0
+        self.call_index = 0
+        self.num_steps = 0
+        self.features = dict()
+        self.full_calls = 0
+        self.cached_calls = 0
+        self.flops = dict()
+        self._key = None
+        self._counter = None
+
+    def set_step(self, i):
+        """Called by the sampler before each step, features are refreshed on every interval-th step."""
+        self.step_index = i
+        self.call_index = 0
+        self.num_steps += 1
+
+    def begin(self, unet, x):
+        """Cached deep features for this call, or None if the full UNet has to run."""
+        assert self.branch + 1 < len(unet.input_blocks), \
+            f'DeepCache branch {self.branch} is too deep for a UNet with {len(unet.input_blocks)} input blocks'
+        self._key = (unet, self.call_index)
+        self.call_index += 1
+        entry = self.features.get(self._key)
+        refresh = self.step_index % self.interval == 0 or entry is None or entry[0] != x.shape
+        kind = "full" if refresh else "cached"
+        if kind == "full":
+            self.full_calls += 1
+        else:
+            self.cached_calls += 1
+        if kind not in self.flops and self._counter is None:
+            self._counter = (kind, FlopCounter(unet).__enter__())
+        return None if refresh else entry[1]
+
+    def store(self, x, h):
+        self.features[self._key] = (x.shape, h)
+
+    def end(self, completed=True):
+        """Called after every UNet call, also a failed one, whose FLOPs are not recorded."""
+        if self._counter is not None:
+            kind, counter = self._counter
+            self._counter = None
+            counter.__exit__()
+            if completed:
+                self.flops[kind] = counter.flops
+
+    def summary(self):
+        calls = self.full_calls + self.cached_calls
+        text = f"DeepCache: {self.cached_calls} of {calls} UNet calls reused the deep features"
+        if "full" in self.flops and "cached" in self.flops and self.num_steps > 0:
+            saved = (self.flops["full"] - self.flops["cached"]) * self.cached_calls
+            text += (f", {saved / self.num_steps / 1e9:.1f} GFLOPs saved per step "
+                     f"({100. * saved / (self.flops['full'] * calls):.0f}%)")
+        return text
+
+    def clear(self):
+        self.features.clear()
+
+
+def make_deep_cache(interval=None, branch=0):
+    """A DeepCache that reuses the deep features for interval - 1 out of every interval steps, None for None or 1."""
+    if interval is None or interval <= 1:
+        return None
+    return DeepCache(interval, branch)
+
+
+# the cache of the UNet call running on this thread, see unet_deep_cache()
+_deep_cache = threading.local()
+
+
+@contextmanager
+def unet_deep_cache(cache):
+    """
+    Let the UNets that run on this thread inside the context use cache, a DeepCache (see make_deep_cache) or
+    None. The sampler calls cache.set_step(i) before each step. Enter it around the model calls of a step
+    only, never across a yield: interleaved sampling generators would otherwise see each other's features.
+    """
+    previous = getattr(_deep_cache, "cache", None)
+    _deep_cache.cache = cache
+    try:
+        yield cache
+    finally:
+        _deep_cache.cache = previous
+
+
 class UNetModel(nn.Module):
     """
     The full UNet model with attention and timestep embedding.
@@ -438,6 +534,10 @@ class UNetModel(nn.Module):
     :param resblock_updown: use residual blocks for up/downsampling.
     :param use_new_attention_order: use a different attention pattern for potentially
                                     increased efficiency.
+    :param attention_backend: name of the attention backend (see ldm.modules.attention_backends)
+                              for all attention layers, None follows the process-wide default.
+    :param tome_ratio: token merging ratio of the spatial transformers, a float for the highest
+                       resolution or a list with one ratio per downsampling level (see ldm.modules.tome).
     """
 
     def __init__(
@@ -466,6 +566,8 @@ class UNetModel(nn.Module):
         context_dim=None,                 # custom transformer support
         n_embed=None,                     # custom support for prediction of discrete ids into codebook of first stage vq model
         legacy=True,
+        attention_backend=None,
+        tome_ratio=None,
     ):
         super().__init__()
         if use_spatial_transformer:
@@ -690,6 +792,11 @@ class UNetModel(nn.Module):
             conv_nd(dims, model_channels, n_embed, 1),
             #nn.LogSoftmax(dim=1)  # change to cross_entropy and produce non-normalized logits
         )
+        if attention_backend is not None:
+            set_attention_backend(attention_backend, model=self)
+        if tome_ratio is not None:
+            from ldm.modules.tome import apply_tome
+            apply_tome(self, tome_ratio)
 
     def convert_to_fp16(self):
         """
@@ -719,6 +826,20 @@ class UNetModel(nn.Module):
         assert (y is not None) == (
             self.num_classes is not None
         ), "must specify y if and only if the model is class-conditional"
+        cache = getattr(_deep_cache, "cache", None)
+        if cache is None:
+            return self._forward(x, timesteps, context, y)
+        features = cache.begin(self, x)
+        completed = False
+        try:
+            h = self._forward(x, timesteps, context, y, cache, features)
+            completed = True
+        finally:
+            # uninstalls the FlopCounter of the summary even if the call fails
+            cache.end(completed)
+        return h
+
+    def _forward(self, x, timesteps, context, y, cache=None, features=None):
         hs = []
         t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
         emb = self.time_embed(t_emb)
@@ -727,19 +848,29 @@ class UNetModel(nn.Module):
             assert y.shape == (x.shape[0],)
             emb = emb + self.label_emb(y)
 
+        if features is None:
+            input_blocks, output_blocks = self.input_blocks, self.output_blocks
+        else:
+            # DeepCache step: only the shallow blocks run, the deep ones are replaced by the cached features
+            input_blocks = self.input_blocks[:cache.branch + 1]
+            output_blocks = self.output_blocks[len(self.output_blocks) - cache.branch - 1:]
+
         h = x.type(self.dtype)
-        for module in self.input_blocks:
+        for module in input_blocks:
             h = module(h, emb, context)
             hs.append(h)
-        h = self.middle_block(h, emb, context)
-        for module in self.output_blocks:
+        h = self.middle_block(h, emb, context) if features is None else features
+        for module in output_blocks:
+            if cache is not None and features is None and len(hs) == cache.branch + 1:
+                cache.store(x, h)
             h = th.cat([h, hs.pop()], dim=1)
             h = module(h, emb, context)
         h = h.type(x.dtype)
         if self.predict_codebook_ids:
-            return self.id_predictor(h)
+            h = self.id_predictor(h)
         else:
-            return self.out(h)
+            h = self.out(h)
+        return h
 
 
 class EncoderUNetModel(nn.Module):
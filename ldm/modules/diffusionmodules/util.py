@@ -16,6 +16,7 @@ import numpy as np
 from einops import repeat
 
 from ldm.util import instantiate_from_config
+from ldm.modules.attention_backends import add_attention_observer, remove_attention_observer
 
 
 def make_beta_schedule(schedule, n_timestep, linear_start=1e-4, linear_end=2e-2, cosine_s=8e-3):
@@ -261,7 +262,70 @@ class HybridConditioner(nn.Module):
         return {'c_concat': [c_concat], 'c_crossattn': [c_crossattn]}
 
 
-def noise_like(shape, device, repeat=False):
+def noise_like(shape, device, repeat=False, generators=None):
+    """
+    Normal noise of the given shape. With generators (see make_generators), sample i is drawn from generators[i]
+    on the CPU, so it does not depend on the batch it is part of or on the device.
+    """
+    if generators is not None:
+        assert len(generators) == shape[0], f'expected {shape[0]} generators, got {len(generators)}'
+        if repeat:
+            noise = torch.randn((1, *shape[1:]), generator=generators[0])
+            return noise.repeat(shape[0], *((1,) * (len(shape) - 1))).to(device)
+        return torch.stack([torch.randn(tuple(shape[1:]), generator=g) for g in generators]).to(device)
     repeat_noise = lambda: torch.randn((1, *shape[1:]), device=device).repeat(shape[0], *((1,) * (len(shape) - 1)))
     noise = lambda: torch.randn(shape, device=device)
-    return repeat_noise() if repeat else noise()
\ No newline at end of file
+    return repeat_noise() if repeat else noise()
+
+
+def make_generators(seeds):
+    """One CPU torch.Generator per sample, seeded with seeds[i], for noise_like. None without seeds."""
+    if seeds is None:
+        return None
+    return [torch.Generator().manual_seed(int(seed)) for seed in seeds]
+
+
+class FlopCounter(object):
+    """
+    Counts the floating point operations (two per multiply-add) of the convolutions, linear layers and
+    attention products that run inside the context. Normalizations and elementwise ops are ignored.
+    model can also be a list of models.
+
+        with FlopCounter(unet) as counter:
+            unet(x, t, context=c)
+        print(f"{counter.flops / 1e9:.1f} GFLOPs")
+    """
+    def __init__(self, model):
+        self.model = model
+        self.flops = 0
+        self.handles = []
+
+    def add(self, flops):
+        self.flops += flops
+
+    def _conv_hook(self, module, inputs, output):
+        kernel = int(np.prod(module.kernel_size))
+        self.add(2 * output.numel() * (module.in_channels // module.groups) * kernel)
+
+    def _linear_hook(self, module, inputs, output):
+        self.add(2 * output.numel() * module.in_features)
+
+    def _attention_hook(self, q, k, v):
+        # q k^T and the weighted sum of v
+        self.add(2 * q.shape[0] * q.shape[1] * k.shape[1] * (q.shape[2] + v.shape[2]))
+
+    def __enter__(self):
+        models = self.model if isinstance(self.model, (list, tuple)) else [self.model]
+        for module in (module for model in models for module in model.modules()):
+            if isinstance(module, (nn.Conv1d, nn.Conv2d, nn.Conv3d)):
+                self.handles.append(module.register_forward_hook(self._conv_hook))
+            elif isinstance(module, nn.Linear):
+                self.handles.append(module.register_forward_hook(self._linear_hook))
+        add_attention_observer(self._attention_hook)
+        return self
+
+    def __exit__(self, *args):
+        remove_attention_observer(self._attention_hook)
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
@@ -0,0 +1,108 @@
+import os
+import json
+
+import numpy as np
+import torch
+
+from ldm.modules.encoders.modules import AbstractEncoder
+
+
+class EmbeddingStoreWriter(object):
+    """
+    Writes precomputed text embeddings to a store directory:
+        embeddings.bin  raw rows of shape `shape` and dtype `dtype`, appended in order
+        index.jsonl     one {"prompt": ..., "offset": ...} line per row, offset counted in rows
+        meta.json       shape, dtype and number of rows, written on close
+    """
+    def __init__(self, path, shape=(77, 768), dtype="float16"):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.data_file = open(os.path.join(path, "embeddings.bin"), "wb")
+        self.index_file = open(os.path.join(path, "index.jsonl"), "w")
+
+    def write(self, prompts, embeddings):
+        """Append a batch, embeddings is a (len(prompts), *shape) tensor or array."""
+        if isinstance(embeddings, torch.Tensor):
+            embeddings = embeddings.detach().float().cpu().numpy()
+        assert embeddings.shape == (len(prompts),) + self.shape, \
+            f"expected embeddings of shape {(len(prompts),) + self.shape}, got {embeddings.shape}"
+        self.data_file.write(np.ascontiguousarray(embeddings, dtype=self.dtype).tobytes())
+        for prompt in prompts:
+            self.index_file.write(json.dumps({"prompt": prompt, "offset": self.count}) + "\n")
+            self.count += 1
+
+    def close(self):
+        self.data_file.close()
+        self.index_file.close()
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump({"shape": list(self.shape), "dtype": self.dtype.name, "count": self.count}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class EmbeddingStore(object):
+    """Read side of EmbeddingStoreWriter, the embeddings are memory-mapped and only paged in when used."""
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.shape = tuple(meta["shape"])
+        self.dtype = np.dtype(meta["dtype"])
+        self.count = meta["count"]
+        self.data = np.memmap(os.path.join(path, "embeddings.bin"), dtype=self.dtype, mode="r",
+                              shape=(self.count,) + self.shape)
+        self.prompts = []
+        self.offsets = dict()
+        with open(os.path.join(path, "index.jsonl"), "r") as f:
+            for line in f:
+                entry = json.loads(line)
+                self.prompts.append(entry["prompt"])
+                # the first occurrence wins for repeated prompts
+                self.offsets.setdefault(entry["prompt"], entry["offset"])
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, prompt):
+        return prompt in self.offsets
+
+    def __getitem__(self, i):
+        return self.data[i]
+
+    def lookup(self, prompts):
+        """(len(prompts), *shape) float32 array of the embeddings of the given prompts."""
+        missing = [p for p in prompts if p not in self.offsets]
+        if missing:
+            raise KeyError(f"{len(missing)} prompts are not in the embedding store {self.path}, e.g. {missing[0]!r}")
+        return np.stack([self.data[self.offsets[p]] for p in prompts]).astype(np.float32)
+
+
+class PrecomputedEmbedder(AbstractEncoder):
+    """
+    Stand-in for the text encoder that looks prompts up in an EmbeddingStore instead of running CLIP/BERT,
+    so sampling workers never load the text encoder. Use it as cond_stage_config:
+        target: ldm.modules.encoders.embedding_store.PrecomputedEmbedder
+        params:
+          path: embeddings/
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.store = EmbeddingStore(path)
+        # follows the model to its device
+        self.register_buffer("device_anchor", torch.zeros(0), persistent=False)
+
+    def forward(self, text):
+        if isinstance(text, str):
+            text = [text]
+        z = torch.from_numpy(self.store.lookup(list(text)))
+        return z.to(self.device_anchor.device)
+
+    def encode(self, text):
+        return self(text)
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from collections import OrderedDict
 from functools import partial
 import clip
 from einops import rearrange, repeat
@@ -17,6 +18,89 @@ class AbstractEncoder(nn.Module):
         raise NotImplementedError
 
 
+class EmbeddingCache(object):
+    """
+    Least-recently-used cache of per-prompt text embeddings, one row per entry. Pinned entries (by default
+    the empty prompt used for the unconditional embedding) are never evicted.
+    """
+    def __init__(self, max_size=256, pinned_texts=("",)):
+        self.max_size = max_size
+        self.pinned_texts = set(pinned_texts)
+        self.entries = OrderedDict()
+        self.pinned = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries) + len(self.pinned)
+
+    def get(self, key):
+        if key in self.pinned:
+            return self.pinned[key]
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        if key[0] in self.pinned_texts:
+            self.pinned[key] = value
+            return
+        if self.max_size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self, pinned=False):
+        self.entries.clear()
+        if pinned:
+            self.pinned.clear()
+
+
+def _output_dtype_and_device(encoder):
+    """Device and dtype the encoder's output will have: those of its weights, or the autocast dtype."""
+    param = next(encoder.parameters(), None)
+    if param is None:
+        return None, None
+    device, dtype = param.device, param.dtype
+    if device.type == "cuda" and torch.is_autocast_enabled():
+        dtype = torch.get_autocast_gpu_dtype()
+    elif device.type == "cpu" and torch.is_autocast_cpu_enabled():
+        dtype = torch.get_autocast_cpu_dtype()
+    return dtype, device
+
+
+def cached_encode(encoder, text, encode_fn):
+    """
+    encode_fn(text) through encoder.embedding_cache: rows of cached prompts are reused, the misses of the
+    batch are encoded together in one call. Keys are the prompt text, encoder.max_length and the dtype and
+    device of the output, so that rows encoded under autocast or before the encoder moved are not mixed into
+    other batches. The cache itself belongs to the encoder instance. The cache is bypassed while training or
+    with gradients enabled.
+    """
+    cache = getattr(encoder, "embedding_cache", None)
+    if isinstance(text, str):
+        text = [text]
+    if (cache is None or encoder.training or torch.is_grad_enabled() or
+            not isinstance(text, (list, tuple)) or not all(isinstance(t, str) for t in text)):
+        return encode_fn(text)
+
+    dtype, device = _output_dtype_and_device(encoder)
+    keys = [(t, encoder.max_length, dtype, device) for t in text]
+    rows = [cache.get(key) for key in keys]
+    missing = list(OrderedDict.fromkeys(key for key, row in zip(keys, rows) if row is None))
+    cache.hits += len(keys) - sum(row is None for row in rows)
+    cache.misses += len(missing)
+    if missing:
+        z = encode_fn([key[0] for key in missing])
+        new_rows = {key: z[i:i + 1].clone() for i, key in enumerate(missing)}
+        for key, row in new_rows.items():
+            cache.put(key, row)
+        rows = [new_rows[key] if row is None else row for key, row in zip(keys, rows)]
+    return torch.cat(rows)
+
 
 class ClassEmbedder(nn.Module):
     def __init__(self, embed_dim, n_classes=1000, key='class'):
@@ -80,8 +164,10 @@ class BERTTokenizer(AbstractEncoder):
 class BERTEmbedder(AbstractEncoder):
     """Uses the BERT tokenizr model and add some transformer encoder layers"""
     def __init__(self, n_embed, n_layer, vocab_size=30522, max_seq_len=77,
-                 device="cuda",use_tokenizer=True, embedding_dropout=0.0):
+                 device="cuda",use_tokenizer=True, embedding_dropout=0.0, cache_size=256):
         super().__init__()
+        self.max_length = max_seq_len
+        self.embedding_cache = EmbeddingCache(cache_size) if use_tokenizer else None
         self.use_tknz_fn = use_tokenizer
         if self.use_tknz_fn:
             self.tknz_fn = BERTTokenizer(vq_interface=False, max_length=max_seq_len)
@@ -100,7 +186,7 @@ class BERTEmbedder(AbstractEncoder):
 
     def encode(self, text):
         # output of length 77
-        return self(text)
+        return cached_encode(self, text, self)
 
 
 class SpatialRescaler(nn.Module):
@@ -136,12 +222,14 @@ class SpatialRescaler(nn.Module):
 
 class FrozenCLIPEmbedder(AbstractEncoder):
     """Uses the CLIP transformer encoder for text (from Hugging Face)"""
-    def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77):
+    def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77, cache_size=256):
         super().__init__()
         self.tokenizer = CLIPTokenizer.from_pretrained(version)
         self.transformer = CLIPTextModel.from_pretrained(version)
         self.device = device
         self.max_length = max_length
+        # cache_size=0 only keeps the pinned empty prompt
+        self.embedding_cache = EmbeddingCache(cache_size)
         self.freeze()
 
     def freeze(self):
@@ -159,20 +247,21 @@ class FrozenCLIPEmbedder(AbstractEncoder):
         return z
 
     def encode(self, text):
-        return self(text)
+        return cached_encode(self, text, self)
 
 
 class FrozenCLIPTextEmbedder(nn.Module):
     """
     Uses the CLIP transformer encoder for text.
     """
-    def __init__(self, version='ViT-L/14', device="cuda", max_length=77, n_repeat=1, normalize=True):
+    def __init__(self, version='ViT-L/14', device="cuda", max_length=77, n_repeat=1, normalize=True, cache_size=256):
         super().__init__()
         self.model, _ = clip.load(version, jit=False, device="cpu")
         self.device = device
         self.max_length = max_length
         self.n_repeat = n_repeat
         self.normalize = normalize
+        self.embedding_cache = EmbeddingCache(cache_size)
 
     def freeze(self):
         self.model = self.model.eval()
@@ -187,7 +276,7 @@ class FrozenCLIPTextEmbedder(nn.Module):
         return z
 
     def encode(self, text):
-        z = self(text)
+        z = cached_encode(self, text, self)
         if z.ndim==2:
             z = z[:, None, :]
         z = repeat(z, 'b 1 d -> b k d', k=self.n_repeat)
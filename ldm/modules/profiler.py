@@ -0,0 +1,170 @@
+"""
+Opt-in per-module profiling of the UNet and the autoencoder. Inside the context, forward pre/post hooks on the
+blocks of the given models (ResBlocks, spatial transformers, attention, up- and downsampling, and the blocks of
+the VAE) record wall time, calls and estimated FLOPs per module, optionally as a trace for chrome://tracing or
+Perfetto. Nothing is hooked outside the context, so the profiler costs nothing unless it is used.
+
+    with ModuleProfiler({"unet": model.model.diffusion_model, "vae": model.first_stage_model.decoder}) as profiler:
+        samples, _ = sampler.sample(...)
+        model.decode_first_stage(samples)
+    print(profiler.table())
+    profiler.export_chrome_trace("trace.json")
+
+Time and FLOPs of a module include the profiled modules nested in it (a SpatialTransformer contains its
+CrossAttentions), self time excludes them. On CUDA the hooks synchronize the device around every profiled
+module, which makes the times exact but slows sampling down.
+"""
+import os
+import json
+import time
+import threading
+from functools import partial
+
+import torch
+
+from ldm.modules.attention import SpatialTransformer, CrossAttention
+from ldm.modules.diffusionmodules import model as vae
+from ldm.modules.diffusionmodules.util import FlopCounter
+from ldm.modules.diffusionmodules.openaimodel import ResBlock, AttentionBlock, Upsample, Downsample
+
+
+PROFILED_MODULES = (ResBlock, AttentionBlock, Upsample, Downsample,
+                    SpatialTransformer, CrossAttention,
+                    vae.ResnetBlock, vae.AttnBlock, vae.Upsample, vae.Downsample)
+
+
+class ModuleStats(object):
+    def __init__(self, name, type):
+        self.name = name
+        self.type = type
+        self.calls = 0
+        self.time = 0.
+        self.self_time = 0.
+        self.flops = 0
+
+
+class _ProfilerFlopCounter(FlopCounter):
+    """Attributes the counted FLOPs to the profiled modules that are running on the current thread."""
+    def __init__(self, model, profiler):
+        super().__init__(model)
+        self.profiler = profiler
+
+    def add(self, flops):
+        super().add(flops)
+        for name, _, _ in self.profiler._stack():
+            self.profiler.stats[name].flops += flops
+
+
+class ModuleProfiler(object):
+    """
+    Per-module wall time, calls and FLOPs of the models inside the context. models maps a prefix for the module
+    names to a model, each model itself is reported as well. trace keeps every call for export_chrome_trace().
+    """
+    def __init__(self, models, module_types=PROFILED_MODULES, trace=False, count_flops=True, synchronize=None):
+        self.models = models
+        self.module_types = module_types
+        self.trace = trace
+        self.count_flops = count_flops
+        self.synchronize = synchronize
+        self.stats = dict()
+        self.events = []
+        self.handles = []
+        self._local = threading.local()
+        self._flop_counter = None
+        self._t0 = None
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _sync(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+    def _pre_hook(self, name, module, inputs):
+        self._sync()
+        self._stack().append((name, time.perf_counter(), [0.]))
+
+    def _post_hook(self, name, module, inputs, output):
+        self._sync()
+        end = time.perf_counter()
+        stack = self._stack()
+        # an exception in a nested module skips its post hook, drop what it left behind
+        while stack and stack[-1][0] != name:
+            stack.pop()
+        if not stack:
+            return
+        _, start, child_time = stack.pop()
+        duration = end - start
+        stats = self.stats[name]
+        stats.calls += 1
+        stats.time += duration
+        stats.self_time += duration - child_time[0]
+        if stack:
+            stack[-1][2][0] += duration
+        if self.trace:
+            self.events.append({"name": name, "cat": stats.type, "ph": "X", "pid": os.getpid(),
+                                "tid": threading.get_ident(),
+                                "ts": (start - self._t0) * 1e6, "dur": duration * 1e6})
+
+    def __enter__(self):
+        if self.synchronize is None:
+            self.synchronize = torch.cuda.is_available() and any(
+                p.is_cuda for model in self.models.values() for p in model.parameters())
+        for prefix, model in self.models.items():
+            for name, module in model.named_modules():
+                if module is not model and not isinstance(module, self.module_types):
+                    continue
+                name = f"{prefix}.{name}" if name else prefix
+                self.stats[name] = ModuleStats(name, type(module).__name__)
+                self.handles.append(module.register_forward_pre_hook(partial(self._pre_hook, name)))
+                self.handles.append(module.register_forward_hook(partial(self._post_hook, name)))
+        if self.count_flops:
+            self._flop_counter = _ProfilerFlopCounter(list(self.models.values()), self).__enter__()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self._flop_counter is not None:
+            self._flop_counter.__exit__()
+            self._flop_counter = None
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def summary(self, by_type=False):
+        """ModuleStats of the modules that ran, or of all modules of a type with by_type, by decreasing time."""
+        stats = [s for s in self.stats.values() if s.calls > 0]
+        if by_type:
+            merged = dict()
+            for s in stats:
+                # the models themselves stay separate, they are the totals
+                key = s.name if s.name in self.models else s.type
+                if key not in merged:
+                    merged[key] = ModuleStats(key, s.type)
+                m = merged[key]
+                m.calls += s.calls
+                m.time += s.time
+                m.self_time += s.self_time
+                m.flops += s.flops
+            stats = list(merged.values())
+        return sorted(stats, key=lambda s: s.time, reverse=True)
+
+    def table(self, by_type=False, limit=None):
+        stats = self.summary(by_type)
+        total = sum(s.time for s in stats if s.name in self.models) or 1.
+        width = max([len(s.name) for s in stats] + [6])
+        lines = [f"{'module':<{width}} {'type':<22} {'calls':>7} {'total ms':>10} {'self ms':>10} "
+                 f"{'self %':>7} {'ms/call':>9} {'GFLOPs':>10} {'GFLOP/s':>9}"]
+        for s in stats[:limit]:
+            lines.append(f"{s.name:<{width}} {s.type:<22} {s.calls:>7} {1e3 * s.time:>10.2f} "
+                         f"{1e3 * s.self_time:>10.2f} {100. * s.self_time / total:>6.1f}% "
+                         f"{1e3 * s.time / s.calls:>9.3f} {s.flops / 1e9:>10.2f} "
+                         f"{s.flops / 1e9 / max(s.time, 1e-9):>9.1f}")
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        """Writes the recorded calls in the Trace Event Format of chrome://tracing and Perfetto."""
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
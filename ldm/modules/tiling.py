@@ -0,0 +1,97 @@
+"""
+Tiled application of the first stage autoencoders, so that decoding and encoding large images needs memory
+for one micro-batch of tiles instead of the whole image. Tiles overlap and are blended with feathered weights,
+which hides the seams that per-tile normalization statistics would otherwise leave.
+"""
+import math
+
+import torch
+
+
+BLEND_MODES = ("linear", "cosine", "none")
+
+
+class TileConfig(object):
+    """
+    tile_size and overlap are measured in pixels of the tiled input (latent pixels when decoding).
+    micro_batch tiles go through the model at once, blend is one of BLEND_MODES.
+    """
+    def __init__(self, tile_size=64, overlap=16, micro_batch=4, blend="linear"):
+        assert 0 <= overlap < tile_size, 'the tile overlap has to be smaller than the tile size'
+        assert blend in BLEND_MODES, f'unknown blend mode {blend}, choose from {BLEND_MODES}'
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.micro_batch = micro_batch
+        self.blend = blend
+
+
+def tile_starts(size, tile_size, overlap, align=1):
+    """Start offsets of tiles of tile_size covering [0, size), the last tile ends at size."""
+    if size <= tile_size:
+        return [0]
+    stride = max(align, (tile_size - overlap) // align * align)
+    starts = list(range(0, size - tile_size, stride))
+    last = (size - tile_size) // align * align
+    if not starts or starts[-1] != last:
+        starts.append(last)
+    return starts
+
+
+def feather_weights(length, overlap, ramp_start, ramp_end, blend="linear", device=None):
+    """1D blending weights of a tile, ramping up over `overlap` pixels at the sides that overlap a neighbour."""
+    w = torch.ones(length, device=device)
+    if blend == "none" or overlap <= 0:
+        return w
+    ramp = (torch.arange(overlap, device=device, dtype=torch.float32) + 0.5) / overlap
+    if blend == "cosine":
+        ramp = 0.5 - 0.5 * torch.cos(math.pi * ramp)
+    if ramp_start:
+        w[:overlap] = ramp
+    if ramp_end:
+        w[length - overlap:] = torch.minimum(w[length - overlap:], ramp.flip(0))
+    return w
+
+
+def tiled_apply(fn, x, config, scale=1., align=1):
+    """
+    Apply fn to overlapping tiles of x (b, c, h, w) and blend the results. fn maps a (n, c, th, tw) batch of
+    tiles to (n, c', th * scale, tw * scale). Tile offsets are multiples of align, so that they map to whole
+    output pixels when scale < 1.
+    """
+    b, _, h, w = x.shape
+    th, tw = min(config.tile_size, h), min(config.tile_size, w)
+    ys = tile_starts(h, th, config.overlap, align)
+    xs = tile_starts(w, tw, config.overlap, align)
+    if len(ys) == 1 and len(xs) == 1:
+        return fn(x)
+
+    oth, otw = int(round(th * scale)), int(round(tw * scale))
+    ov_y, ov_x = int(round(min(config.overlap, th) * scale)), int(round(min(config.overlap, tw) * scale))
+    out, norm = None, None
+    positions = [(y, x0) for y in ys for x0 in xs]
+    for k in range(0, len(positions), config.micro_batch):
+        batch = positions[k:k + config.micro_batch]
+        tiles = fn(torch.cat([x[:, :, y:y + th, x0:x0 + tw] for y, x0 in batch]))
+        if out is None:
+            out = torch.zeros(b, tiles.shape[1], int(round(h * scale)), int(round(w * scale)),
+                              device=tiles.device, dtype=torch.float32)
+            norm = torch.zeros(1, 1, out.shape[2], out.shape[3], device=tiles.device, dtype=torch.float32)
+        for i, (y, x0) in enumerate(batch):
+            wy = feather_weights(oth, ov_y, y > 0, y + th < h, config.blend, tiles.device)
+            wx = feather_weights(otw, ov_x, x0 > 0, x0 + tw < w, config.blend, tiles.device)
+            weight = (wy[:, None] * wx[None, :])[None, None]
+            oy, ox = int(round(y * scale)), int(round(x0 * scale))
+            out[:, :, oy:oy + oth, ox:ox + otw] += tiles[i * b:(i + 1) * b].float() * weight
+            norm[:, :, oy:oy + oth, ox:ox + otw] += weight
+    return (out / norm).to(tiles.dtype)
+
+
+def tiled_encode(fn, x, config, factor):
+    """
+    tiled_apply for an encoder that downsamples by factor, with config in latent pixels. The image tiles are
+    factor times larger and start at multiples of factor.
+    """
+    assert x.shape[2] % factor == 0 and x.shape[3] % factor == 0, \
+        f'image size {tuple(x.shape[2:])} has to be a multiple of {factor} for tiled encoding'
+    image_config = TileConfig(config.tile_size * factor, config.overlap * factor, config.micro_batch, config.blend)
+    return tiled_apply(fn, x, image_config, scale=1. / factor, align=factor)
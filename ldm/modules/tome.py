@@ -0,0 +1,193 @@
+"""
+Token merging (ToMe, https://arxiv.org/abs/2303.17604) for the transformer blocks of the UNet.
+Before attention, the most similar tokens of a block are merged by averaging, and afterwards the merged
+outputs are copied back to every token that went into them, so the block output keeps its shape.
+
+    apply_tome(model.model.diffusion_model, ratio=0.5)               # merge half the tokens at full resolution
+    apply_tome(model.model.diffusion_model, ratio=[0.5, 0.25])       # ... and a quarter one level down
+    remove_tome(model.model.diffusion_model)
+"""
+import torch
+
+from ldm.modules.attention import BasicTransformerBlock, SpatialTransformer
+from ldm.modules.diffusionmodules.openaimodel import ResBlock, Downsample, Upsample
+
+
+def do_nothing(x):
+    return x
+
+
+def bipartite_soft_matching_random2d(metric, w, h, sx, sy, r, generator=None):
+    """
+    Split the (B, h * w, C) tokens into destinations, one random token per sy x sx window, and sources,
+    then find the r sources most similar to any destination. Returns merge and unmerge functions for
+    tensors of the same token layout as metric.
+    """
+    B, N, _ = metric.shape
+    if r <= 0:
+        return do_nothing, do_nothing
+
+    with torch.no_grad():
+        hsy, wsx = h // sy, w // sx
+
+        # mark one destination per sy x sx window with -1, sources stay 0
+        if generator is None:
+            rand_idx = torch.zeros(hsy, wsx, 1, device=metric.device, dtype=torch.int64)
+        else:
+            rand_idx = torch.randint(sy * sx, size=(hsy, wsx, 1), generator=generator,
+                                     device=generator.device).to(metric.device)
+        idx_buffer_view = torch.zeros(hsy, wsx, sy * sx, device=metric.device, dtype=torch.int64)
+        idx_buffer_view.scatter_(dim=2, index=rand_idx, src=-torch.ones_like(rand_idx))
+        idx_buffer_view = idx_buffer_view.view(hsy, wsx, sy, sx).transpose(1, 2).reshape(hsy * sy, wsx * sx)
+        if hsy * sy < h or wsx * sx < w:
+            # tokens in the remainder rows/columns are always sources
+            idx_buffer = torch.zeros(h, w, device=metric.device, dtype=torch.int64)
+            idx_buffer[:hsy * sy, :wsx * sx] = idx_buffer_view
+        else:
+            idx_buffer = idx_buffer_view
+
+        # argsort puts the destinations first
+        rand_idx = idx_buffer.reshape(1, -1, 1).argsort(dim=1)
+        num_dst = hsy * wsx
+        a_idx = rand_idx[:, num_dst:, :]  # sources
+        b_idx = rand_idx[:, :num_dst, :]  # destinations
+
+        def split(x):
+            c = x.shape[-1]
+            src = torch.gather(x, dim=1, index=a_idx.expand(B, N - num_dst, c))
+            dst = torch.gather(x, dim=1, index=b_idx.expand(B, num_dst, c))
+            return src, dst
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        scores = a @ b.transpose(-1, -2)
+
+        r = min(a.shape[1], r)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[..., r:, :]  # sources that stay
+        src_idx = edge_idx[..., :r, :]  # sources that are merged
+        dst_idx = torch.gather(node_idx[..., None], dim=-2, index=src_idx)
+
+    def merge(x):
+        src, dst = split(x)
+        n, t1, c = src.shape
+        unm = torch.gather(src, dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = torch.gather(src, dim=-2, index=src_idx.expand(n, r, c))
+        # mean over each destination and its merged sources, scatter_add keeps this working on PyTorch < 1.12
+        index = dst_idx.expand(n, r, c)
+        counts = torch.ones_like(dst).scatter_add_(-2, index, torch.ones_like(src))
+        dst = dst.scatter_add(-2, index, src) / counts
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x):
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        n, _, c = unm.shape
+        src = torch.gather(dst, dim=-2, index=dst_idx.expand(n, r, c))
+        out = torch.zeros(n, N, c, device=x.device, dtype=x.dtype)
+        out.scatter_(dim=-2, index=b_idx.expand(n, num_dst, c), src=dst)
+        out.scatter_(dim=-2, index=torch.gather(a_idx.expand(n, a_idx.shape[1], 1), dim=1,
+                                                index=unm_idx).expand(n, unm_len, c), src=unm)
+        out.scatter_(dim=-2, index=torch.gather(a_idx.expand(n, a_idx.shape[1], 1), dim=1,
+                                                index=src_idx).expand(n, r, c), src=src)
+        return out
+
+    return merge, unmerge
+
+
+class ToMe(object):
+    """
+    Token merging settings of one BasicTransformerBlock. ratio is the fraction of tokens merged away.
+    By default only the self-attention sees merged tokens, merge_crossattn and merge_mlp extend that to the
+    cross-attention and the feed-forward layers. Destinations are drawn from a private generator, so merging
+    does not consume the global random state that sampling noise is drawn from. It is seeded with seed on first
+    use and again after reset_tome().
+    """
+    def __init__(self, ratio, sx=2, sy=2, use_rand=True, merge_attn=True, merge_crossattn=False, merge_mlp=False,
+                 seed=0):
+        self.ratio = ratio
+        self.sx = sx
+        self.sy = sy
+        self.use_rand = use_rand
+        self.merge_attn = merge_attn
+        self.merge_crossattn = merge_crossattn
+        self.merge_mlp = merge_mlp
+        self.seed = seed
+        self.generator = None
+
+    def get_generator(self, device):
+        if self.generator is None or self.generator.device != device:
+            # cuda generators need an explicit device index
+            device = torch.device(device.type, torch.cuda.current_device()) \
+                if device.type == "cuda" and device.index is None else device
+            self.generator = torch.Generator(device=device)
+            self.generator.manual_seed(self.seed)
+        return self.generator
+
+    def merge_fns(self, x, hw):
+        """(merge, unmerge) pairs for the self-attention, the cross-attention and the feed-forward layer."""
+        h, w = hw
+        r = int(x.shape[1] * self.ratio)
+        generator = self.get_generator(x.device) if self.use_rand else None
+        m, u = bipartite_soft_matching_random2d(x, w, h, self.sx, self.sy, r, generator=generator)
+        m_a, u_a = (m, u) if self.merge_attn else (do_nothing, do_nothing)
+        m_c, u_c = (m, u) if self.merge_crossattn else (do_nothing, do_nothing)
+        m_m, u_m = (m, u) if self.merge_mlp else (do_nothing, do_nothing)
+        return m_a, u_a, m_c, u_c, m_m, u_m
+
+
+def transformer_depths(unet):
+    """Yield (depth, SpatialTransformer) for a UNetModel, depth counting the downsamplings above it."""
+    def changes_resolution(layer, cls):
+        return isinstance(layer, cls) or (isinstance(layer, ResBlock) and layer.updown and
+                                          isinstance(layer.h_upd, cls))
+
+    depth = 0
+    for block in unet.input_blocks:
+        for layer in block:
+            if isinstance(layer, SpatialTransformer):
+                yield depth, layer
+            elif changes_resolution(layer, Downsample):
+                depth += 1
+    for layer in unet.middle_block:
+        if isinstance(layer, SpatialTransformer):
+            yield depth, layer
+    for block in unet.output_blocks:
+        for layer in block:
+            if isinstance(layer, SpatialTransformer):
+                yield depth, layer
+            elif changes_resolution(layer, Upsample):
+                depth -= 1
+
+
+def apply_tome(unet, ratio=0.5, **kwargs):
+    """
+    Enable token merging in the transformer blocks of a UNetModel. ratio is either a float, used at the
+    highest resolution only, or a list with one ratio per UNet depth (0 = highest resolution), where
+    missing depths and ratios <= 0 leave the blocks unchanged. Other kwargs go to ToMe.
+    """
+    ratios = [ratio] if isinstance(ratio, (int, float)) else list(ratio)
+    for depth, transformer in transformer_depths(unet):
+        r = ratios[depth] if depth < len(ratios) else 0.
+        for block in transformer.transformer_blocks:
+            block.tome = ToMe(r, **kwargs) if r > 0 else None
+    return unet
+
+
+def reset_tome(model):
+    """
+    Reseed the merge generators of all ToMe blocks in model. The samplers call it at the start of every run,
+    so that the merge partitions, and with them the samples, do not depend on the runs before.
+    """
+    for module in model.modules():
+        if isinstance(module, BasicTransformerBlock) and module.tome is not None:
+            module.tome.generator = None
+    return model
+
+
+def remove_tome(unet):
+    for module in unet.modules():
+        if isinstance(module, BasicTransformerBlock):
+            module.tome = None
+    return unet
@@ -0,0 +1,86 @@
+"""
+Micro-benchmark of the per-step overhead of the DDIM and PLMS samplers on CPU.
+The diffusion model is replaced by a constant eps prediction, so the timings only contain the sampler's
+own Python, allocation and arithmetic cost, for the default step, the fast (static) step and, with
+--compile, the fast step captured by torch.compile.
+
+    python scripts/benchmark_sampler_step.py --batch_size 4 --steps 50
+    python scripts/benchmark_sampler_step.py --batch_size 4 --steps 50 --compile
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from ldm.modules.diffusionmodules.util import make_beta_schedule
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.plms import PLMSSampler
+
+
+class ConstantEpsModel(object):
+    """Just enough of LatentDiffusion for the samplers, with an eps prediction that costs nothing."""
+    parameterization = "eps"
+
+    def __init__(self, shape, timesteps=1000, device="cpu"):
+        betas = make_beta_schedule("linear", timesteps, linear_start=0.00085, linear_end=0.0120)
+        alphas_cumprod = np.cumprod(1. - betas, axis=0)
+        to_torch = lambda x: torch.tensor(x, dtype=torch.float32, device=device)
+        self.device = torch.device(device)
+        self.num_timesteps = timesteps
+        self.betas = to_torch(betas)
+        self.alphas_cumprod = to_torch(alphas_cumprod)
+        self.alphas_cumprod_prev = to_torch(np.append(1., alphas_cumprod[:-1]))
+        self.eps = 0.1 * torch.randn((2 * shape[0],) + tuple(shape[1:]), device=device)
+
+    def apply_model(self, x, t, c):
+        # a fresh tensor like a real model returns, the guided fast step updates it in place
+        return self.eps[:x.shape[0]].clone()
+
+
+def time_sampler(sampler, args, shape, c, uc, fast_step):
+    kwargs = dict(S=args.steps, batch_size=shape[0], shape=shape[1:], conditioning=c, verbose=False,
+                  unconditional_guidance_scale=args.scale, unconditional_conditioning=uc, fast_step=fast_step,
+                  log_every_t=args.steps + 1)
+    sampler.sample(**kwargs)  # warm up, builds the schedule
+    tic = time.perf_counter()
+    for _ in range(args.n_runs):
+        sampler.sample(**kwargs)
+    toc = time.perf_counter()
+    return (toc - tic) / (args.n_runs * args.steps) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--H", type=int, default=64, help="latent height")
+    parser.add_argument("--W", type=int, default=64, help="latent width")
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--n_runs", type=int, default=10)
+    parser.add_argument("--scale", type=float, default=7.5, help="guidance scale, 1.0 disables guidance")
+    parser.add_argument("--compile", action="store_true",
+                        help="also time fast_step=\"compile\", the fast step captured by torch.compile (PyTorch >= 2.0)")
+    parser.add_argument("--threads", type=int, default=1, help="torch threads, 1 makes timings comparable")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    shape = (args.batch_size, 4, args.H, args.W)
+    model = ConstantEpsModel(shape)
+    c = torch.randn(args.batch_size, 77, 768)
+    uc = torch.zeros_like(c)
+
+    print(f"per-step sampler overhead, batch {shape}, {args.steps} steps, guidance scale {args.scale}")
+    for sampler_cls in [DDIMSampler, PLMSSampler]:
+        sampler = sampler_cls(model)
+        default = time_sampler(sampler, args, shape, c, uc, fast_step=False)
+        fast = time_sampler(sampler, args, shape, c, uc, fast_step=True)
+        line = (f"{sampler_cls.__name__:>12}: default {default:8.1f} us/step, fast {fast:8.1f} us/step "
+                f"({default / fast:.2f}x)")
+        if args.compile:
+            compiled = time_sampler(sampler, args, shape, c, uc, fast_step="compile")
+            line += f", compiled {compiled:8.1f} us/step ({default / compiled:.2f}x)"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
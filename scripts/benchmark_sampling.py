@@ -0,0 +1,202 @@
+"""
+End-to-end sampling benchmark on randomly initialized models, so it runs without a checkpoint and on CPU.
+Sweeps sampler, step count, batch size, resolution and guidance, and reports for every case the throughput
+in images/sec (sampling and decoding), the latency percentiles of a sampler step, the decode time and the
+peak memory as JSON:
+
+    python scripts/benchmark_sampling.py --out benchmark.json
+    python scripts/benchmark_sampling.py --baseline benchmark.json --tolerance 0.1
+
+With --baseline every case is compared to the case with the same parameters in a previous --out file, and the
+script exits with status 1 if the throughput of any case dropped by more than the tolerance.
+The text encoder is not part of the benchmark, the conditioning is a random (batch, 77, context_dim) tensor.
+peak_rss_mb is the peak of the whole process so far, as reported by getrusage, so it only grows from case
+to case; on CUDA peak_cuda_mb is the peak allocated memory of the case itself.
+"""
+import argparse
+import itertools
+import json
+import platform
+import resource
+import sys
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+from torch import autocast
+from omegaconf import OmegaConf
+
+from ldm.util import instantiate_from_config
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.plms import PLMSSampler
+from ldm.models.diffusion.dpm_solver import DPMSolverSampler
+
+
+SAMPLERS = {"ddim": DDIMSampler, "plms": PLMSSampler, "dpm": DPMSolverSampler}
+CASE_KEYS = ["config", "sampler", "steps", "batch_size", "H", "W", "scale"]
+
+
+def load_model(config, device):
+    """The randomly initialized model, its downsampling factor and the context dimension of its UNet."""
+    config = OmegaConf.load(config)
+    model = instantiate_from_config(config.model).to(device).eval()
+    f = 2 ** (model.first_stage_model.encoder.num_resolutions - 1)
+    return model, f, config.model.params.unet_config.params.context_dim
+
+
+def peak_rss_mb():
+    # kilobytes on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2 ** 20 if sys.platform == "darwin" else maxrss / 2 ** 10
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def run_case(model, f, context_dim, sampler, case, device):
+    """Samples and decodes one batch, returns the step latencies and the decode time in seconds."""
+    shape = [model.channels, case["H"] // f, case["W"] // f]
+    c = torch.randn(case["batch_size"], 77, context_dim, device=device)
+    uc = torch.zeros_like(c) if case["scale"] != 1.0 else None
+
+    step_times = []
+    synchronize(device)
+    tic = time.perf_counter()
+    for state in sampler.sample_iter(S=case["steps"],
+                                     conditioning=c,
+                                     batch_size=case["batch_size"],
+                                     shape=shape,
+                                     verbose=False,
+                                     unconditional_guidance_scale=case["scale"],
+                                     unconditional_conditioning=uc,
+                                     eta=0.0):
+        synchronize(device)
+        toc = time.perf_counter()
+        step_times.append(toc - tic)
+        tic = toc
+    model.decode_first_stage(state.x)
+    synchronize(device)
+    return step_times, time.perf_counter() - tic
+
+
+def benchmark(opt):
+    device = torch.device(opt.device)
+    precision_scope = autocast if opt.precision == "autocast" else nullcontext
+    results = []
+    for config in opt.configs:
+        model, f, context_dim = load_model(config, device)
+        cases = itertools.product(opt.samplers, opt.steps, opt.batch_sizes, opt.resolutions, opt.scales)
+        for sampler_name, steps, batch_size, resolution, scale in cases:
+            case = {"config": config, "sampler": sampler_name, "steps": steps, "batch_size": batch_size,
+                    "H": resolution, "W": resolution, "scale": scale}
+            sampler = SAMPLERS[sampler_name](model)
+            if device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats(device)
+            step_times, decode_times = [], []
+            with torch.no_grad(), precision_scope(device.type), model.ema_scope():
+                for run in range(opt.n_warmup + opt.n_runs):
+                    torch.manual_seed(opt.seed + run)
+                    run_step_times, decode_time = run_case(model, f, context_dim, sampler, case, device)
+                    if run >= opt.n_warmup:
+                        step_times.extend(run_step_times)
+                        decode_times.append(decode_time)
+            sample_time = sum(step_times) / opt.n_runs
+            decode_time = float(np.mean(decode_times))
+            step_ms = 1e3 * np.array(step_times)
+            result = dict(case,
+                          images_per_sec=batch_size / (sample_time + decode_time),
+                          step_ms={"mean": float(step_ms.mean()),
+                                   "p50": float(np.percentile(step_ms, 50)),
+                                   "p90": float(np.percentile(step_ms, 90)),
+                                   "p99": float(np.percentile(step_ms, 99))},
+                          decode_ms=1e3 * decode_time,
+                          peak_rss_mb=peak_rss_mb())
+            if device.type == "cuda":
+                result["peak_cuda_mb"] = torch.cuda.max_memory_allocated(device) / 2 ** 20
+            results.append(result)
+            print(f"{config} {sampler_name:>4} steps {steps:>3} batch {batch_size:>2} {resolution:>4}px "
+                  f"scale {scale:>4}: {result['images_per_sec']:8.2f} images/s, "
+                  f"step p50 {result['step_ms']['p50']:8.2f} ms, p99 {result['step_ms']['p99']:8.2f} ms, "
+                  f"decode {result['decode_ms']:8.2f} ms, peak rss {result['peak_rss_mb']:.0f} MB")
+        del model
+    return results
+
+
+def case_key(result):
+    return tuple(result[k] for k in CASE_KEYS)
+
+
+def compare(results, baseline, tolerance):
+    """Prints the throughput of every case relative to the baseline, returns the regressed cases."""
+    baseline = {case_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        base = baseline.get(case_key(result))
+        if base is None:
+            print(f"{case_key(result)}: not in the baseline")
+            continue
+        ratio = result["images_per_sec"] / base["images_per_sec"]
+        step_ratio = result["step_ms"]["p50"] / base["step_ms"]["p50"]
+        regressed = ratio < 1. - tolerance
+        print(f"{case_key(result)}: {ratio:.3f}x images/s, {step_ratio:.3f}x step p50"
+              f"{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(result)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", type=str, nargs="+", default=["configs/benchmark/tiny-txt2img.yaml"],
+                        help="model configs, configs/benchmark/small-txt2img.yaml is closer to the real model")
+    parser.add_argument("--samplers", type=str, nargs="+", choices=list(SAMPLERS), default=list(SAMPLERS))
+    parser.add_argument("--steps", type=int, nargs="+", default=[10, 25])
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[64, 128],
+                        help="image side lengths in pixels, the latent is 8 times smaller")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1.0, 7.5],
+                        help="guidance scales, 1.0 samples without guidance")
+    parser.add_argument("--n_runs", type=int, default=3)
+    parser.add_argument("--n_warmup", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--precision", type=str, choices=["full", "autocast"], default="full")
+    parser.add_argument("--threads", type=int, default=None, help="torch threads, 1 makes CPU timings stable")
+    parser.add_argument("--out", type=str, default=None, help="write the results as JSON to this file")
+    parser.add_argument("--baseline", type=str, default=None, help="results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative drop in images/sec that counts as a regression")
+    opt = parser.parse_args()
+
+    if opt.threads is not None:
+        torch.set_num_threads(opt.threads)
+    torch.manual_seed(opt.seed)
+
+    results = benchmark(opt)
+    report = {"environment": {"torch": torch.__version__,
+                              "python": platform.python_version(),
+                              "device": torch.cuda.get_device_name(opt.device) if opt.device.startswith("cuda")
+                              else platform.processor() or platform.machine(),
+                              "threads": torch.get_num_threads(),
+                              "precision": opt.precision},
+              "results": results}
+    if opt.out is not None:
+        with open(opt.out, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if opt.baseline is not None:
+        with open(opt.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, opt.tolerance)
+        if regressions:
+            print(f"{len(regressions)} of {len(results)} cases regressed by more than {opt.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Speed and output drift of token merging (ToMe) in the UNet's spatial transformers.
+Times one UNet evaluation with and without merging for several ratios and reports the relative drift
+||eps_tome - eps|| / ||eps|| against the unmodified model on the same inputs.
+
+    python scripts/benchmark_tome.py --ckpt models/ldm/stable-diffusion-v1/model.ckpt --H 512 --W 512
+    python scripts/benchmark_tome.py --ratios 0.3 0.5 0.7 --depth_ratios 0.5 0.25
+
+Without --ckpt the UNet keeps its random initialization, which is enough for timings. Its output layer is
+zero-initialized though, so the drift can only be reported for trained weights.
+"""
+import argparse
+import time
+from contextlib import nullcontext
+
+import torch
+from torch import autocast
+from omegaconf import OmegaConf
+
+from ldm.util import instantiate_from_config
+from ldm.modules.tome import apply_tome, remove_tome
+
+
+def load_unet(config, ckpt=None):
+    unet_config = OmegaConf.load(config).model.params.unet_config
+    unet_config.params.use_checkpoint = False
+    unet = instantiate_from_config(unet_config)
+    if ckpt is not None:
+        prefix = "model.diffusion_model."
+        sd = torch.load(ckpt, map_location="cpu")["state_dict"]
+        unet.load_state_dict({k[len(prefix):]: v for k, v in sd.items() if k.startswith(prefix)})
+    return unet, unet_config.params.context_dim
+
+
+@torch.no_grad()
+def time_unet(unet, x, t, c, n_runs):
+    out = unet(x, t, context=c)  # warm up
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    tic = time.perf_counter()
+    for _ in range(n_runs):
+        out = unet(x, t, context=c)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return out, (time.perf_counter() - tic) / n_runs * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml")
+    parser.add_argument("--ckpt", type=str, default=None, help="checkpoint with trained UNet weights")
+    parser.add_argument("--H", type=int, default=512, help="image height, the latent is H / 8")
+    parser.add_argument("--W", type=int, default=512, help="image width, the latent is W / 8")
+    parser.add_argument("--batch_size", type=int, default=2, help="2 corresponds to one guided sample")
+    parser.add_argument("--n_runs", type=int, default=5)
+    parser.add_argument("--ratios", type=float, nargs="+", default=[0.3, 0.5, 0.7],
+                        help="merge ratios at the highest resolution")
+    parser.add_argument("--depth_ratios", type=float, nargs="*", default=None,
+                        help="additionally benchmark one ratio per UNet depth, e.g. 0.5 0.25")
+    parser.add_argument("--precision", type=str, choices=["full", "autocast"], default="autocast")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    torch.manual_seed(args.seed)
+    unet, context_dim = load_unet(args.config, args.ckpt)
+    unet = unet.to(device).eval()
+
+    x = torch.randn(args.batch_size, unet.in_channels, args.H // 8, args.W // 8, device=device)
+    t = torch.full((args.batch_size,), 500, device=device, dtype=torch.long)
+    c = torch.randn(args.batch_size, 77, context_dim, device=device)
+
+    settings = [(r, r) for r in args.ratios]
+    if args.depth_ratios:
+        settings.append((" ".join(str(r) for r in args.depth_ratios), args.depth_ratios))
+
+    precision_scope = autocast if args.precision == "autocast" and device.type == "cuda" else nullcontext
+    with precision_scope("cuda"):
+        remove_tome(unet)
+        ref, base_ms = time_unet(unet, x, t, c, args.n_runs)
+        ref = ref.float()
+        print(f"latent {tuple(x.shape)} on {device}, {args.precision} precision")
+        print(f"{'ratio':>12} {'ms/call':>10} {'speedup':>8} {'drift':>8}")
+        print(f"{'none':>12} {base_ms:10.1f} {1.:8.2f} {'':>8}")
+        for name, ratio in settings:
+            apply_tome(unet, ratio)
+            out, ms = time_unet(unet, x, t, c, args.n_runs)
+            drift = f"{((out.float() - ref).norm() / ref.norm()).item():8.4f}" if ref.norm() > 0 else "     n/a"
+            print(f"{name:>12} {ms:10.1f} {base_ms / ms:8.2f} {drift}")
+        remove_tome(unet)
+
+
+if __name__ == "__main__":
+    main()
@@ -192,6 +192,19 @@ def main():
         choices=["full", "autocast"],
         default="autocast"
     )
+    parser.add_argument(
+        "--vae_tile_size",
+        type=int,
+        default=None,
+        help="encode and decode in overlapping tiles of this many latent pixels, bounds autoencoder memory for "
+             "large images",
+    )
+    parser.add_argument(
+        "--vae_tile_overlap",
+        type=int,
+        default=16,
+        help="overlap of the autoencoder tiles in latent pixels",
+    )
 
     opt = parser.parse_args()
     seed_everything(opt.seed)
@@ -201,6 +214,8 @@ def main():
 
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
     model = model.to(device)
+    if opt.vae_tile_size is not None:
+        model.first_stage_model.enable_tiling(tile_size=opt.vae_tile_size, overlap=opt.vae_tile_overlap)
 
     if opt.plms:
         raise NotImplementedError("PLMS sampler not (yet) supported")
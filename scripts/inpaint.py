@@ -50,6 +50,19 @@ if __name__ == "__main__":
         default=50,
         help="number of ddim sampling steps",
     )
+    parser.add_argument(
+        "--vae_tile_size",
+        type=int,
+        default=None,
+        help="encode the masked image and decode in overlapping tiles of this many latent pixels, bounds "
+             "autoencoder memory for large images",
+    )
+    parser.add_argument(
+        "--vae_tile_overlap",
+        type=int,
+        default=16,
+        help="overlap of the autoencoder tiles in latent pixels",
+    )
     opt = parser.parse_args()
 
     masks = sorted(glob.glob(os.path.join(opt.indir, "*_mask.png")))
@@ -63,6 +76,10 @@ if __name__ == "__main__":
 
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
     model = model.to(device)
+    if opt.vae_tile_size is not None:
+        # the masked image is encoded by the cond stage, which is the first stage autoencoder here
+        for autoencoder in {model.first_stage_model, model.cond_stage_model}:
+            autoencoder.enable_tiling(tile_size=opt.vae_tile_size, overlap=opt.vae_tile_overlap)
     sampler = DDIMSampler(model)
 
     os.makedirs(opt.outdir, exist_ok=True)
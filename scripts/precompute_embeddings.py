@@ -0,0 +1,59 @@
+"""
+Encode a prompt file with the model's text encoder into an embedding store, so that sampling can run without
+loading the text encoder (see txt2img.py --embeddings). Prompts are streamed from the file, one per line, and
+encoded in large batches. The empty prompt is always stored first, for unconditional guidance.
+
+    python scripts/precompute_embeddings.py --from_file prompts.txt --outdir embeddings/
+    python scripts/txt2img.py --embeddings embeddings/ --plms
+"""
+import argparse
+from itertools import islice
+
+import torch
+from omegaconf import OmegaConf
+from tqdm import tqdm
+
+from ldm.util import instantiate_from_config
+from ldm.modules.encoders.embedding_store import EmbeddingStoreWriter
+
+
+def read_prompts(path):
+    with open(path, "r") as f:
+        for line in f:
+            yield line.rstrip("\n")
+
+
+def batched(it, size):
+    it = iter(it)
+    return iter(lambda: list(islice(it, size)), [])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--from_file", type=str, required=True, help="prompt file, one prompt per line")
+    parser.add_argument("--outdir", type=str, required=True, help="directory of the embedding store")
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml",
+                        help="model config, only its cond_stage_config is instantiated")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--dtype", type=str, default="float16", choices=["float16", "float32"])
+    args = parser.parse_args()
+
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    cond_stage_config = OmegaConf.load(args.config).model.params.cond_stage_config
+    cond_stage_config.params = OmegaConf.merge(cond_stage_config.get("params", {}), {"device": str(device)})
+    encoder = instantiate_from_config(cond_stage_config).to(device).eval()
+    # every prompt is encoded once, the encoder's cache would only hold on to rows that are never reused
+    encoder.embedding_cache = None
+
+    with torch.no_grad():
+        # the empty prompt also gives the shape, so an empty prompt file still makes a valid store
+        z = encoder.encode([""])
+        with EmbeddingStoreWriter(args.outdir, shape=z.shape[1:], dtype=args.dtype) as writer:
+            writer.write([""], z)
+            for prompts in tqdm(batched(read_prompts(args.from_file), args.batch_size), desc="encoding"):
+                writer.write(prompts, encoder.encode(prompts))
+    print(f"wrote {writer.count} embeddings of shape {writer.shape} to {args.outdir}")
+
+
+if __name__ == "__main__":
+    main()
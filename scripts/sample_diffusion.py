@@ -9,6 +9,7 @@ from PIL import Image
 
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.util import instantiate_from_config
+from ldm.inference.writers import ShardedNpzWriter, ShardedTarWriter
 
 rescale = lambda x: (x + 1.) / 2.
 
@@ -105,7 +106,8 @@ def make_convolutional_sample(model, batch_size, vanilla=False, custom_steps=Non
     print(f'Throughput for this batch: {log["throughput"]}')
     return log
 
-def run(model, logdir, batch_size=50, vanilla=False, custom_steps=None, eta=None, n_samples=50000, nplog=None):
+def run(model, logdir, batch_size=50, vanilla=False, custom_steps=None, eta=None, n_samples=50000, nplog=None,
+        shard_size=10000, tar=False):
     if vanilla:
         print(f'Using Vanilla DDPM sampling with {model.num_timesteps} sampling steps.')
     else:
@@ -116,23 +118,29 @@ def run(model, logdir, batch_size=50, vanilla=False, custom_steps=None, eta=None
     n_saved = len(glob.glob(os.path.join(logdir,'*.png')))-1
     # path = logdir
     if model.cond_stage_model is None:
-        all_images = []
+        # samples are streamed into shards of shard_size samples, memory does not grow with n_samples
+        np_writer = ShardedNpzWriter(nplog, shard_size=shard_size)
+        tar_writer = ShardedTarWriter(logdir, shard_size=shard_size) if tar else None
 
         print(f"Running unconditional sampling for {n_samples} samples")
         for _ in trange(n_samples // batch_size, desc="Sampling Batches (unconditional)"):
             logs = make_convolutional_sample(model, batch_size=batch_size,
                                              vanilla=vanilla, custom_steps=custom_steps,
                                              eta=eta)
-            n_saved = save_logs(logs, logdir, n_saved=n_saved, key="sample")
-            all_images.extend([custom_to_np(logs["sample"])])
+            npbatch = custom_to_np(logs["sample"]).numpy()[:n_samples - np_writer.count]
+            if tar_writer is None:
+                n_saved = save_logs(logs, logdir, n_saved=n_saved, key="sample")
+            else:
+                tar_writer.write(npbatch)
+                n_saved = tar_writer.count
+            np_writer.write(npbatch)
             if n_saved >= n_samples:
                 print(f'Finish after generating {n_saved} samples')
                 break
-        all_img = np.concatenate(all_images, axis=0)
-        all_img = all_img[:n_samples]
-        shape_str = "x".join([str(x) for x in all_img.shape])
-        nppath = os.path.join(nplog, f"{shape_str}-samples.npz")
-        np.savez(nppath, all_img)
+        np_writer.close()
+        if tar_writer is not None:
+            tar_writer.close()
+        print(f"wrote {np_writer.count} samples in {np_writer.shard} shards to {nplog}")
 
     else:
        raise NotImplementedError('Currently only sampling for unconditional models supported.')
@@ -214,6 +222,18 @@ def get_parser():
         help="the bs",
         default=10
     )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=10000,
+        help="samples per .npz (and .tar) shard",
+    )
+    parser.add_argument(
+        "--tar",
+        default=False,
+        action='store_true',
+        help="write the sample images into .tar shards instead of one png per sample",
+    )
     return parser
 
 
@@ -308,6 +328,6 @@ if __name__ == "__main__":
 
     run(model, imglogdir, eta=opt.eta,
         vanilla=opt.vanilla_sample,  n_samples=opt.n_samples, custom_steps=opt.custom_steps,
-        batch_size=opt.batch_size, nplog=numpylogdir)
+        batch_size=opt.batch_size, nplog=numpylogdir, shard_size=opt.shard_size, tar=opt.tar)
 
     print("done.")
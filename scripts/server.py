@@ -0,0 +1,344 @@
+"""
+Long-running txt2img server that keeps the model, the sampler and the safety checker warm, so that a request
+only pays for sampling. Requests are JSON, compatible requests (same size, steps, guidance scale, eta and output
+type) that arrive within a short collection window are sampled together as one batch.
+
+    python scripts/server.py --port 8000 --plms
+    curl -X POST localhost:8000/generate -d '{"prompt": "a painting of a virus monster playing guitar"}'
+    python scripts/server_loadgen.py --url http://localhost:8000 --n_requests 64 --concurrency 8
+
+POST /generate takes
+    {"prompt": str, "n_samples": 1, "H": 512, "W": 512, "steps": 50, "scale": 7.5, "eta": 0.0,
+     "seed": int, "output": "png" | "latent"}
+where everything but the prompt is optional, and returns
+    {"seed": int, "batch_size": int, "queue_ms": float, "latency_ms": float,
+     "images": [base64 png, ...]}  or  {..., "latents": base64 .npy of shape (n_samples, C, H / f, W / f)}
+All noise of a request is drawn from its seed, so the result does not depend on how it was batched.
+GET /health returns the number of served requests and batches.
+"""
+import argparse
+import base64
+import io
+import json
+import queue
+import random
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+from PIL import Image
+from torch import autocast
+from imwatermark import WatermarkEncoder
+
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.plms import PLMSSampler
+from ldm.models.diffusion.dpm_solver import DPMSolverSampler
+from ldm.modules.attention_backends import ATTENTION_BACKENDS, set_attention_backend
+
+# loads the safety checker once, when the server starts
+from txt2img import load_model_from_config, check_safety, put_watermark
+
+
+OUTPUT_TYPES = ("png", "latent")
+
+
+class GenerationRequest(object):
+    """
+    One parsed /generate request, completed by the worker thread through `done`. H and W have to be multiples
+    of the downsampling factor f, eta has to be 0 unless the sampler supports_eta (DDIM).
+    """
+    def __init__(self, params, defaults, f=8, supports_eta=True):
+        if not isinstance(params, dict):
+            raise ValueError("the request has to be a JSON object")
+        unknown = set(params) - set(defaults) - {"prompt"}
+        if unknown:
+            raise ValueError(f"unknown request fields {sorted(unknown)}")
+        if not isinstance(params.get("prompt"), str):
+            raise ValueError("the request needs a prompt string")
+        self.prompt = params["prompt"]
+        self.n_samples = int(params.get("n_samples", defaults["n_samples"]))
+        self.H = int(params.get("H", defaults["H"]))
+        self.W = int(params.get("W", defaults["W"]))
+        self.steps = int(params.get("steps", defaults["steps"]))
+        self.scale = float(params.get("scale", defaults["scale"]))
+        self.eta = float(params.get("eta", defaults["eta"]))
+        self.output = params.get("output", defaults["output"])
+        seed = params.get("seed", defaults["seed"])
+        self.seed = int(seed) if seed is not None else random.randrange(2 ** 32)
+        if self.output not in OUTPUT_TYPES:
+            raise ValueError(f"unknown output {self.output}, choose from {OUTPUT_TYPES}")
+        if self.n_samples < 1 or self.steps < 1:
+            raise ValueError("n_samples and steps have to be positive")
+        if self.H < 1 or self.W < 1 or self.H % f != 0 or self.W % f != 0:
+            raise ValueError(f"H and W have to be positive multiples of {f}")
+        if self.eta != 0 and not supports_eta:
+            raise ValueError("eta has to be 0 for the PLMS and DPM-Solver samplers")
+
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.t_submit = time.perf_counter()
+        self.t_start = None
+
+    @property
+    def key(self):
+        """Requests with the same key can be sampled in one batch."""
+        return self.H, self.W, self.steps, self.scale, self.eta, self.output
+
+    @property
+    def seeds(self):
+        """One seed per sample, the sampler draws all noise of a sample from its own seed."""
+        return [self.seed + i for i in range(self.n_samples)]
+
+
+class Batcher(object):
+    """
+    Collects compatible requests into batches of at most max_batch_size samples. The first request of a batch
+    waits at most `window` seconds for others, requests that do not fit are kept for the following batches.
+    """
+    def __init__(self, run_batch, max_batch_size=8, window=0.05):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.queue = queue.Queue()
+        self.pending = []
+        self.n_requests = 0
+        self.n_batches = 0
+
+    def submit(self, request):
+        if request.n_samples > self.max_batch_size:
+            raise ValueError(f"n_samples {request.n_samples} exceeds the batch size {self.max_batch_size}")
+        self.queue.put(request)
+
+    def next_batch(self):
+        first = self.pending.pop(0) if self.pending else self.queue.get()
+        batch, size = [first], first.n_samples
+
+        def take(request):
+            nonlocal size
+            if request.key == first.key and size + request.n_samples <= self.max_batch_size:
+                batch.append(request)
+                size += request.n_samples
+                return True
+            return False
+
+        self.pending = [r for r in self.pending if not take(r)]
+        deadline = time.perf_counter() + self.window
+        while size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if not take(request):
+                self.pending.append(request)
+        return batch
+
+    def serve_forever(self):
+        while True:
+            batch = self.next_batch()
+            t_start = time.perf_counter()
+            for request in batch:
+                request.t_start = t_start
+            try:
+                results = self.run_batch(batch)
+                for request, result in zip(batch, results):
+                    request.result = result
+            except Exception as e:
+                print(f"batch of {len(batch)} requests failed: {e!r}")
+                for request in batch:
+                    request.error = repr(e)
+            self.n_requests += len(batch)
+            self.n_batches += 1
+            for request in batch:
+                request.done.set()
+
+
+class Generator(object):
+    """Samples a batch of compatible requests with the warm model, runs on the batcher's thread only."""
+    def __init__(self, model, sampler, opt):
+        self.model = model
+        self.sampler = sampler
+        self.opt = opt
+        self.wm_encoder = WatermarkEncoder()
+        self.wm_encoder.set_watermark('bytes', "StableDiffusionV1".encode('utf-8'))
+
+    def __call__(self, batch):
+        first = batch[0]
+        model, opt = self.model, self.opt
+        prompts = [r.prompt for r in batch for _ in range(r.n_samples)]
+        n = len(prompts)
+        shape = [opt.C, first.H // opt.f, first.W // opt.f]
+
+        uc = None
+        if first.scale != 1.0:
+            uc = model.get_learned_conditioning(n * [""])
+        c = model.get_learned_conditioning(prompts)
+        samples, _ = self.sampler.sample(S=first.steps,
+                                         conditioning=c,
+                                         batch_size=n,
+                                         shape=shape,
+                                         verbose=False,
+                                         unconditional_guidance_scale=first.scale,
+                                         unconditional_conditioning=uc,
+                                         eta=first.eta,
+                                         seeds=[seed for r in batch for seed in r.seeds])
+
+        if first.output == "latent":
+            latents = samples.float().cpu().numpy()
+        else:
+            x_samples = model.decode_first_stage(samples)
+            x_samples = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
+            x_samples = x_samples.cpu().permute(0, 2, 3, 1).numpy()
+            if not opt.skip_safety:
+                x_samples, _ = check_safety(x_samples)
+            images = [encode_png(put_watermark(Image.fromarray((255. * x).astype(np.uint8)), self.wm_encoder))
+                      for x in x_samples]
+
+        t_end = time.perf_counter()
+        results, i = [], 0
+        for r in batch:
+            result = {
+                "seed": r.seed,
+                "batch_size": n,
+                "queue_ms": (r.t_start - r.t_submit) * 1e3,
+                "latency_ms": (t_end - r.t_submit) * 1e3,
+            }
+            if r.output == "latent":
+                result["latents"] = encode_npy(latents[i:i + r.n_samples])
+            else:
+                result["images"] = images[i:i + r.n_samples]
+            i += r.n_samples
+            results.append(result)
+        return results
+
+
+def encode_npy(x):
+    buffer = io.BytesIO()
+    np.save(buffer, x)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def encode_png(img):
+    buffer = io.BytesIO()
+    img.save(buffer, format="png")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server_version = "ldm-server"
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        batcher = self.server.batcher
+        self.send_json(200, {"status": "ok", "requests": batcher.n_requests, "batches": batcher.n_batches,
+                             "queued": batcher.queue.qsize() + len(batcher.pending)})
+
+    def do_POST(self):
+        if self.path != "/generate":
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            params = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            request = GenerationRequest(params, self.server.defaults, f=self.server.f,
+                                        supports_eta=self.server.supports_eta)
+            self.server.batcher.submit(request)
+        except (ValueError, TypeError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        request.done.wait()
+        if request.error is not None:
+            self.send_json(500, {"error": request.error})
+        else:
+            self.send_json(200, request.result)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml",
+                        help="path to config which constructs model")
+    parser.add_argument("--ckpt", type=str, default="models/ldm/stable-diffusion-v1/model.ckpt",
+                        help="path to checkpoint of model")
+    parser.add_argument("--plms", action='store_true', help="use plms sampling")
+    parser.add_argument("--dpm_solver", action='store_true', help="use DPM-Solver++ sampling")
+    parser.add_argument("--max_batch_size", type=int, default=8, help="most samples in one batch")
+    parser.add_argument("--batch_window_ms", type=float, default=50.,
+                        help="how long the first request of a batch waits for compatible requests")
+    parser.add_argument("--precision", type=str, choices=["full", "autocast"], default="autocast",
+                        help="evaluate at this precision")
+    parser.add_argument("--attention", type=str, choices=list(ATTENTION_BACKENDS.keys()), default="naive",
+                        help="attention backend for all attention layers")
+    parser.add_argument("--C", type=int, default=4, help="latent channels")
+    parser.add_argument("--f", type=int, default=8, help="downsampling factor")
+    parser.add_argument("--H", type=int, default=512, help="default image height")
+    parser.add_argument("--W", type=int, default=512, help="default image width")
+    parser.add_argument("--steps", type=int, default=50, help="default number of sampling steps")
+    parser.add_argument("--scale", type=float, default=7.5, help="default unconditional guidance scale")
+    parser.add_argument("--skip_safety", action='store_true', help="do not run the safety checker on images")
+    parser.add_argument("--verbose", action='store_true', help="log every HTTP request")
+    opt = parser.parse_args()
+
+    config = OmegaConf.load(f"{opt.config}")
+    model = load_model_from_config(config, f"{opt.ckpt}")
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    model = model.to(device)
+    set_attention_backend(opt.attention)
+
+    if opt.dpm_solver:
+        sampler = DPMSolverSampler(model)
+    elif opt.plms:
+        sampler = PLMSSampler(model)
+    else:
+        sampler = DDIMSampler(model)
+
+    batcher = Batcher(Generator(model, sampler, opt), max_batch_size=opt.max_batch_size,
+                      window=opt.batch_window_ms / 1e3)
+    precision_scope = autocast if opt.precision == "autocast" else nullcontext
+
+    def serve():
+        # grad mode and autocast are thread local, so they are entered on the sampling thread
+        with torch.no_grad(), precision_scope("cuda"), model.ema_scope():
+            batcher.serve_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+
+    server = ThreadingHTTPServer((opt.host, opt.port), RequestHandler)
+    server.daemon_threads = True
+    server.batcher = batcher
+    server.verbose = opt.verbose
+    server.f = opt.f
+    server.supports_eta = isinstance(sampler, DDIMSampler)
+    server.defaults = {"n_samples": 1, "H": opt.H, "W": opt.W, "steps": opt.steps, "scale": opt.scale,
+                       "eta": 0.0, "seed": None, "output": "png"}
+    print(f"serving on http://{opt.host}:{opt.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Load generator for scripts/server.py. Sends n_requests /generate requests from `concurrency` client threads and
+reports throughput and latency percentiles, as measured by the client and as reported by the server.
+
+    python scripts/server_loadgen.py --url http://localhost:8000 --n_requests 64 --concurrency 8 --steps 20
+"""
+import argparse
+import json
+import threading
+import time
+import urllib.request
+from itertools import cycle, islice
+
+import numpy as np
+
+
+def read_prompts(path):
+    with open(path, "r") as f:
+        return [line for line in f.read().splitlines() if line]
+
+
+def post_json(url, body, timeout):
+    request = urllib.request.Request(url, data=json.dumps(body).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def percentiles(values, ps=(50, 90, 99)):
+    if not values:
+        return {}
+    return {f"p{p}": float(np.percentile(values, p)) for p in ps}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8000")
+    parser.add_argument("--n_requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=4, help="number of client threads")
+    parser.add_argument("--prompt", type=str, default="a painting of a virus monster playing guitar")
+    parser.add_argument("--from-file", type=str, help="cycle through the prompts of this file instead")
+    parser.add_argument("--n_samples", type=int, default=1, help="samples per request")
+    parser.add_argument("--H", type=int, default=None)
+    parser.add_argument("--W", type=int, default=None)
+    parser.add_argument("--steps", type=int, default=None)
+    parser.add_argument("--scale", type=float, default=None)
+    parser.add_argument("--output", type=str, choices=["png", "latent"], default="png")
+    parser.add_argument("--timeout", type=float, default=600.)
+    parser.add_argument("--json", type=str, default=None, help="also write the summary to this file")
+    opt = parser.parse_args()
+
+    prompts = read_prompts(opt.from_file) if opt.from_file else [opt.prompt]
+    overrides = {k: getattr(opt, k) for k in ["H", "W", "steps", "scale"] if getattr(opt, k) is not None}
+    bodies = [dict(prompt=p, seed=i, n_samples=opt.n_samples, output=opt.output, **overrides)
+              for i, p in enumerate(islice(cycle(prompts), opt.n_requests))]
+
+    lock = threading.Lock()
+    latencies, queue_times, batch_sizes, errors = [], [], [], []
+
+    def client(bodies):
+        for body in bodies:
+            tic = time.perf_counter()
+            try:
+                result = post_json(opt.url.rstrip("/") + "/generate", body, opt.timeout)
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+                continue
+            with lock:
+                latencies.append((time.perf_counter() - tic) * 1e3)
+                queue_times.append(result["queue_ms"])
+                batch_sizes.append(result["batch_size"])
+
+    threads = [threading.Thread(target=client, args=(bodies[i::opt.concurrency],)) for i in range(opt.concurrency)]
+    tic = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - tic
+
+    summary = {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "concurrency": opt.concurrency,
+        "elapsed_s": elapsed,
+        "requests_per_s": len(latencies) / elapsed,
+        "samples_per_s": len(latencies) * opt.n_samples / elapsed,
+        "latency_ms": percentiles(latencies),
+        "queue_ms": percentiles(queue_times),
+        "mean_batch_size": float(np.mean(batch_sizes)) if batch_sizes else 0.,
+    }
+    print(json.dumps(summary, indent=2))
+    if errors:
+        print(f"first error: {errors[0]}")
+    if opt.json:
+        with open(opt.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
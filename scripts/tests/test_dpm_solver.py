@@ -0,0 +1,111 @@
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from ldm.util import instantiate_from_config
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.dpm_solver import DPMSolverSampler, make_dpm_timesteps
+from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters
+
+
+TINY_LDM_CONFIG = {
+    "target": "ldm.models.diffusion.ddpm.LatentDiffusion",
+    "params": {
+        "linear_start": 0.00085,
+        "linear_end": 0.0120,
+        "timesteps": 1000,
+        "image_size": 8,
+        "channels": 4,
+        "first_stage_key": "image",
+        "cond_stage_key": "image",
+        "conditioning_key": "crossattn",
+        "use_ema": False,
+        "unet_config": {
+            "target": "ldm.modules.diffusionmodules.openaimodel.UNetModel",
+            "params": {
+                "image_size": 8,
+                "in_channels": 4,
+                "out_channels": 4,
+                "model_channels": 32,
+                "attention_resolutions": [2],
+                "num_res_blocks": 1,
+                "channel_mult": [1, 2],
+                "num_heads": 2,
+                "use_spatial_transformer": True,
+                "context_dim": 16,
+                "legacy": False,
+            },
+        },
+        "first_stage_config": {"target": "ldm.models.autoencoder.IdentityFirstStage"},
+        "cond_stage_config": "__is_first_stage__",
+    },
+}
+
+
+def make_tiny_model():
+    torch.manual_seed(0)
+    model = instantiate_from_config(OmegaConf.create(TINY_LDM_CONFIG)).eval()
+    # zero-initialized output layers would make the UNet predict eps == 0 everywhere
+    with torch.no_grad():
+        for p in model.model.parameters():
+            if not p.any():
+                p.normal_(0., 0.05)
+    return model
+
+
+def run_ddim_on_dpm_grid(model, steps, x_T, c, uc, scale):
+    """
+    DDIM on the same time grid as DPM-Solver: the default DDIM grid starts at t=996 for 200 steps,
+    and with an untrained UNet that offset alone would dominate the comparison.
+    """
+    alphacums = model.alphas_cumprod.cpu().double().numpy()
+    sampler = DDIMSampler(model)
+    sampler.make_schedule(steps, ddim_eta=0., verbose=False)
+    timesteps = np.ascontiguousarray(make_dpm_timesteps("time_uniform", steps, alphacums, verbose=False)[-2::-1])
+    sigmas, alphas, alphas_prev = make_ddim_sampling_parameters(alphacums, timesteps, eta=0., verbose=False)
+    sampler.ddim_timesteps = timesteps
+    sampler.ddim_sigmas = torch.tensor(sigmas, dtype=torch.float32)
+    sampler.ddim_alphas = torch.tensor(alphas, dtype=torch.float32)
+    sampler.ddim_alphas_prev = torch.tensor(alphas_prev, dtype=torch.float32)
+    sampler.ddim_sqrt_one_minus_alphas = torch.sqrt(1. - sampler.ddim_alphas)
+    samples, _ = sampler.ddim_sampling(c, tuple(x_T.shape), x_T=x_T.clone(),
+                                       unconditional_guidance_scale=scale, unconditional_conditioning=uc)
+    return samples
+
+
+def run_dpm_solver(model, order, steps, x_T, c, uc, scale):
+    sampler = DPMSolverSampler(model, order=order)
+    samples, _ = sampler.sample(S=steps, batch_size=x_T.shape[0], shape=tuple(x_T.shape[1:]), conditioning=c,
+                                verbose=False, x_T=x_T.clone(), eta=0.,
+                                unconditional_guidance_scale=scale, unconditional_conditioning=uc)
+    return samples
+
+
+def relative_error(x, ref):
+    return ((x - ref).norm() / ref.norm()).item()
+
+
+def test_dpm_solver_matches_ddim_reference():
+    model = make_tiny_model()
+    torch.manual_seed(1)
+    x_T = torch.randn(2, 4, 8, 8)
+    c = torch.randn(2, 3, 16)
+    uc = torch.zeros(2, 3, 16)
+
+    for scale in [1., 3.]:
+        reference = run_ddim_on_dpm_grid(model, 200, x_T, c, uc, scale)
+        ddim_error = relative_error(run_ddim_on_dpm_grid(model, 20, x_T, c, uc, scale), reference)
+
+        # first order DPM-Solver++ is DDIM
+        dpm = run_dpm_solver(model, 1, 20, x_T, c, uc, scale)
+        assert abs(relative_error(dpm, reference) - ddim_error) < 1e-4
+
+        for order in [2, 3]:
+            dpm_error = relative_error(run_dpm_solver(model, order, 20, x_T, c, uc, scale), reference)
+            assert dpm_error < 0.025, f"order {order}, scale {scale}: relative error {dpm_error:.4f}"
+            assert dpm_error < 0.75 * ddim_error, \
+                f"order {order}, scale {scale}: {dpm_error:.4f} vs DDIM {ddim_error:.4f}"
+
+
+if __name__ == "__main__":
+    test_dpm_solver_matches_ddim_reference()
@@ -0,0 +1,152 @@
+import os
+
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from ldm.util import instantiate_from_config
+from ldm.modules import attention
+from ldm.modules.diffusionmodules import openaimodel
+from ldm.modules.tome import apply_tome, remove_tome
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.plms import PLMSSampler
+from ldm.models.diffusion.dpm_solver import DPMSolverSampler
+from ldm.models.diffusion.engine import ContinuousBatchingEngine, SamplingRequest
+
+
+CONFIG = os.path.join(os.path.dirname(__file__), "..", "..", "configs", "benchmark", "tiny-txt2img.yaml")
+SHAPE = [4, 8, 8]
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    model = instantiate_from_config(OmegaConf.load(CONFIG).model).eval()
+    # the zero-initialized output layers would make eps == 0 everywhere, and every test pass trivially
+    with torch.no_grad():
+        for p in model.model.parameters():
+            if not p.any():
+                p.normal_(0., 0.05)
+    return model
+
+
+def make_conditioning(batch_size, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    c = torch.randn(batch_size, 77, 64, generator=generator)
+    return c, torch.zeros_like(c)
+
+
+def sample(model, sampler_cls, c, uc, seeds, **kwargs):
+    sampler = sampler_cls(model)
+    samples, _ = sampler.sample(S=8, conditioning=c, batch_size=c.shape[0], shape=SHAPE, verbose=False,
+                                unconditional_guidance_scale=5., unconditional_conditioning=uc, seeds=seeds,
+                                **kwargs)
+    return samples
+
+
+@pytest.mark.parametrize("sampler_cls,eta", [(DDIMSampler, 0.), (DDIMSampler, 1.), (PLMSSampler, 0.)])
+def test_fast_step_matches_default_step(model, sampler_cls, eta):
+    c, uc = make_conditioning(2)
+    default = sample(model, sampler_cls, c, uc, [1, 2], eta=eta)
+    fast = sample(model, sampler_cls, c, uc, [1, 2], eta=eta, fast_step=True)
+    assert default.abs().max() > 0.1
+    assert torch.allclose(fast, default, atol=1e-4)
+
+
+@pytest.mark.skipif(not hasattr(torch, "compile"), reason="torch.compile needs PyTorch >= 2.0")
+def test_compiled_fast_step_matches_default_step(model):
+    c, uc = make_conditioning(2)
+    default = sample(model, DDIMSampler, c, uc, [1, 2], eta=1.)
+    compiled = sample(model, DDIMSampler, c, uc, [1, 2], eta=1., fast_step="compile")
+    assert torch.allclose(compiled, default, atol=1e-4)
+
+
+def interleave(*generators):
+    """Runs sampling generators round-robin, returns the last SamplerStep of each."""
+    last = [None] * len(generators)
+    active = list(enumerate(generators))
+    while active:
+        for entry in list(active):
+            n, generator = entry
+            try:
+                last[n] = next(generator)
+            except StopIteration:
+                active.remove(entry)
+    return last
+
+
+def sample_iter(model, sampler_cls, c, uc, seeds, **kwargs):
+    return sampler_cls(model).sample_iter(S=8, conditioning=c, batch_size=c.shape[0], shape=SHAPE, verbose=False,
+                                          unconditional_guidance_scale=5., unconditional_conditioning=uc,
+                                          seeds=seeds, **kwargs)
+
+
+@pytest.mark.parametrize("sampler_cls", [DDIMSampler, PLMSSampler, DPMSolverSampler])
+def test_interleaved_kv_caches_stay_separate(model, sampler_cls):
+    (c1, uc1), (c2, uc2) = make_conditioning(1, seed=1), make_conditioning(1, seed=2)
+    alone = [sample(model, sampler_cls, c, uc, [seed], kv_cache=True)
+             for c, uc, seed in [(c1, uc1, 1), (c2, uc2, 2)]]
+    states = interleave(sample_iter(model, sampler_cls, c1, uc1, [1], kv_cache=True),
+                        sample_iter(model, sampler_cls, c2, uc2, [2], kv_cache=True))
+    for state, x in zip(states, alone):
+        assert torch.allclose(state.x, x, atol=1e-5)
+    assert getattr(attention._kv_cache, "cache", None) is None
+
+
+@pytest.mark.parametrize("sampler_cls", [DDIMSampler, PLMSSampler])
+def test_tome_runs_are_reproducible(model, sampler_cls):
+    c, uc = make_conditioning(1)
+    unet = model.model.diffusion_model
+    apply_tome(unet, ratio=0.5)
+    try:
+        first = sample(model, sampler_cls, c, uc, [1])
+        second = sample(model, sampler_cls, c, uc, [1])
+    finally:
+        remove_tome(unet)
+    assert torch.equal(first, second)
+
+
+@pytest.mark.parametrize("sampler_cls", [DDIMSampler, PLMSSampler])
+def test_interleaved_deep_caches_stay_separate(model, sampler_cls):
+    (c1, uc1), (c2, uc2) = make_conditioning(1, seed=1), make_conditioning(1, seed=2)
+    alone = [sample(model, sampler_cls, c, uc, [seed], deep_cache_interval=3)
+             for c, uc, seed in [(c1, uc1, 1), (c2, uc2, 2)]]
+    states = interleave(sample_iter(model, sampler_cls, c1, uc1, [1], deep_cache_interval=3),
+                        sample_iter(model, sampler_cls, c2, uc2, [2], deep_cache_interval=3))
+    for state, x in zip(states, alone):
+        assert torch.allclose(state.x, x, atol=1e-5)
+    assert getattr(openaimodel._deep_cache, "cache", None) is None
+
+
+@pytest.mark.parametrize("sampler_cls", [DDIMSampler, PLMSSampler])
+def test_sample_returns_deep_cache_summary(model, sampler_cls, capsys):
+    c, uc = make_conditioning(1)
+    _, intermediates = sampler_cls(model).sample(S=8, conditioning=c, batch_size=1, shape=SHAPE, verbose=False,
+                                                 unconditional_guidance_scale=5., unconditional_conditioning=uc,
+                                                 deep_cache_interval=3)
+    assert intermediates["deep_cache"].startswith("DeepCache:")
+    assert "DeepCache" not in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("sampler_cls,eta,fast_step", [(DDIMSampler, 1., False), (DDIMSampler, 1., True),
+                                                       (PLMSSampler, 0., False)])
+def test_samples_do_not_depend_on_their_batch(model, sampler_cls, eta, fast_step):
+    c, uc = make_conditioning(3)
+    batch = sample(model, sampler_cls, c, uc, [1, 2, 3], eta=eta, fast_step=fast_step)
+    alone = sample(model, sampler_cls, c[1:2], uc[1:2], [2], eta=eta, fast_step=fast_step)
+    assert torch.allclose(batch[1:2], alone, atol=1.5e-4)
+
+
+def test_continuous_batching_matches_single_requests(model):
+    c, uc = make_conditioning(3)
+    settings = [(8, 5., 0.), (5, 1., 0.), (6, 3., 1.)]
+    engine = ContinuousBatchingEngine(model, SHAPE, max_batch_size=2)
+    requests = [engine.submit(SamplingRequest(c[k:k + 1], S=S, eta=eta, unconditional_guidance_scale=scale,
+                                              unconditional_conditioning=uc[k:k + 1], seed=k))
+                for k, (S, scale, eta) in enumerate(settings)]
+    engine.run_until_complete()
+    for k, (S, scale, eta) in enumerate(settings):
+        alone, _ = DDIMSampler(model).sample(S=S, conditioning=c[k:k + 1], batch_size=1, shape=SHAPE, verbose=False,
+                                             eta=eta, unconditional_guidance_scale=scale,
+                                             unconditional_conditioning=uc[k:k + 1], seeds=[k])
+        assert torch.allclose(requests[k].samples, alone, atol=1e-4)
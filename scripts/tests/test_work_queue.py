@@ -0,0 +1,91 @@
+import os
+import time
+import multiprocessing
+
+from ldm.inference.jobs import JobItem
+from ldm.inference.workqueue import FileWorkQueue, Worker
+
+
+def make_items(n):
+    return [JobItem(id=i, prompt=f"prompt {i}", seed=i, steps=10, scale=7.5) for i in range(n)]
+
+
+def run_worker(root, outdir, worker_id, crash=False):
+    """Writes one file per item, like txt2img --work_queue. A crashing worker leases a chunk and exits."""
+    worker = Worker(FileWorkQueue(root), worker_id=worker_id, heartbeat_interval=0.05, poll_interval=0.05)
+    for lease in worker.leases():
+        if crash:
+            os._exit(1)
+        for item in lease.items:
+            with open(os.path.join(outdir, f"{item.name}.{worker_id}"), "w") as f:
+                f.write(item.prompt)
+            time.sleep(0.01)
+        lease.count_done(len(lease.items))
+    worker.close()
+
+
+def start_workers(root, outdir, n, crash=False):
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_worker, args=(root, outdir, f"worker{i}", crash)) for i in range(n)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def coordinate(queue, workers, lease_timeout, timeout=60.):
+    deadline = time.time() + timeout
+    while not queue.finished() and time.time() < deadline:
+        queue.requeue_expired(lease_timeout)
+        time.sleep(0.05)
+    for worker in workers:
+        worker.join(timeout=deadline - time.time())
+
+
+def done_items(outdir):
+    return {int(name.split(".")[0]) for name in os.listdir(outdir)}
+
+
+def test_workers_share_the_queue(tmp_path):
+    queue = FileWorkQueue(str(tmp_path / "queue"))
+    os.makedirs(tmp_path / "out")
+    assert queue.put(make_items(40), chunk_size=4) == 10
+
+    workers = start_workers(queue.root, str(tmp_path / "out"), 3)
+    coordinate(queue, workers, lease_timeout=5.)
+
+    assert queue.status() == {"todo": 0, "leased": 0, "done": 10}
+    assert done_items(tmp_path / "out") == set(range(40))
+    # every chunk was leased exactly once, and by more than one worker overall
+    assert len(os.listdir(tmp_path / "out")) == 40
+    assert len({name.split(".")[1] for name in os.listdir(tmp_path / "out")}) > 1
+
+
+def test_leases_of_dead_workers_are_reassigned(tmp_path):
+    queue = FileWorkQueue(str(tmp_path / "queue"))
+    os.makedirs(tmp_path / "out")
+    queue.put(make_items(12), chunk_size=4)
+
+    crashed = start_workers(queue.root, str(tmp_path / "out"), 2, crash=True)
+    for worker in crashed:
+        worker.join()
+    assert queue.status()["leased"] == 2
+
+    workers = start_workers(queue.root, str(tmp_path / "out"), 2)
+    coordinate(queue, workers, lease_timeout=0.5)
+
+    assert queue.status() == {"todo": 0, "leased": 0, "done": 3}
+    assert done_items(tmp_path / "out") == set(range(12))
+
+
+def test_expiry_does_not_use_the_coordinator_clock(tmp_path, monkeypatch):
+    queue = FileWorkQueue(str(tmp_path / "queue"))
+    queue.put(make_items(4), chunk_size=2)
+    lease = queue.lease("worker0")
+    # a coordinator whose clock runs an hour ahead must not expire a fresh lease
+    skewed = time.time() + 3600.
+    monkeypatch.setattr(time, "time", lambda: skewed)
+    assert queue.requeue_expired(lease_timeout=60.) == []
+    # a heartbeat that is old on the filesystem's clock expires
+    mtime = os.path.getmtime(lease.path)
+    os.utime(lease.path, (mtime - 120., mtime - 120.))
+    assert queue.requeue_expired(lease_timeout=60.) == [lease.chunk]
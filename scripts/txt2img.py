@@ -4,11 +4,9 @@ import torch
 import numpy as np
 from omegaconf import OmegaConf
 from PIL import Image
-from tqdm import tqdm, trange
-from imwatermark import WatermarkEncoder
+from tqdm import tqdm
 from itertools import islice
 from einops import rearrange
-from torchvision.utils import make_grid
 import time
 from pytorch_lightning import seed_everything
 from torch import autocast
@@ -17,6 +15,13 @@ from contextlib import contextmanager, nullcontext
 from ldm.util import instantiate_from_config
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
+from ldm.models.diffusion.dpm_solver import DPMSolverSampler
+from ldm.modules.attention_backends import ATTENTION_BACKENDS, set_attention_backend, set_attention_memory_budget
+from ldm.modules.profiler import ModuleProfiler
+from ldm.inference.pipeline import Pipeline
+from ldm.inference.jobs import Manifest, batch_items, read_job
+from ldm.inference.workqueue import FileWorkQueue, Worker
+from ldm.inference.writers import IMAGE_FORMATS, GridAssembler, ImageWriter
 
 from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
 from transformers import AutoFeatureExtractor
@@ -132,6 +137,11 @@ def main():
         action='store_true',
         help="use plms sampling",
     )
+    parser.add_argument(
+        "--dpm_solver",
+        action='store_true',
+        help="use DPM-Solver++ sampling (15-20 steps are usually enough)",
+    )
     parser.add_argument(
         "--laion400m",
         action='store_true',
@@ -219,6 +229,11 @@ def main():
         default=42,
         help="the seed (for reproducible sampling)",
     )
+    parser.add_argument(
+        "--per_sample_seeds",
+        action='store_true',
+        help="give sample i its own noise from seed + i, so that it does not depend on n_samples or the batching",
+    )
     parser.add_argument(
         "--precision",
         type=str,
@@ -226,7 +241,135 @@ def main():
         choices=["full", "autocast"],
         default="autocast"
     )
+    parser.add_argument(
+        "--attention",
+        type=str,
+        help="attention backend for all attention layers",
+        choices=list(ATTENTION_BACKENDS.keys()),
+        default="naive"
+    )
+    parser.add_argument(
+        "--attention_memory_mb",
+        type=int,
+        default=None,
+        help="memory budget in MB for the similarities of one chunk of queries, implies --attention chunked. "
+             "Keeps peak memory linear in the resolution",
+    )
+    parser.add_argument(
+        "--fast_step",
+        type=str,
+        choices=["static", "compile"],
+        default=None,
+        help="run the DDIM/PLMS update on preallocated buffers, compile also captures it with torch.compile",
+    )
+    parser.add_argument(
+        "--kv_cache",
+        action='store_true',
+        help="project the text context to cross-attention keys/values once per batch instead of once per step",
+    )
+    parser.add_argument(
+        "--deep_cache",
+        type=int,
+        default=None,
+        help="run the full UNet only every N steps and reuse its deep features in between (DDIM and PLMS)",
+    )
+    parser.add_argument(
+        "--embeddings",
+        type=str,
+        default=None,
+        help="embedding store written by scripts/precompute_embeddings.py. The text encoder is not loaded, "
+             "prompts come from --from_file or, without it, from the store",
+    )
+    parser.add_argument(
+        "--vae_tile_size",
+        type=int,
+        default=None,
+        help="decode latents in overlapping tiles of this many latent pixels, bounds decoder memory for large images",
+    )
+    parser.add_argument(
+        "--vae_tile_overlap",
+        type=int,
+        default=16,
+        help="overlap of the decoder tiles in latent pixels",
+    )
+    parser.add_argument(
+        "--pipeline_depth",
+        type=int,
+        default=1,
+        help="batches waiting between two pipeline stages (encode, sample, decode, save), bounds memory use",
+    )
+    parser.add_argument(
+        "--profile",
+        action='store_true',
+        help="time the blocks of the UNet and the VAE decoder and print a table per block type at the end",
+    )
+    parser.add_argument(
+        "--profile_trace",
+        type=str,
+        default=None,
+        help="profile as with --profile and also write every block call as a Chrome trace (chrome://tracing, Perfetto)",
+    )
+    parser.add_argument(
+        "--job",
+        type=str,
+        default=None,
+        help="resumable job file with one prompt or JSON item ({\"prompt\", \"seed\", \"steps\", \"scale\"}) per "
+             "line, one sample per item. Finished items are recorded in the manifest and skipped on restart",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="manifest of a --job (default: <outdir>/manifest.jsonl)",
+    )
+    parser.add_argument(
+        "--work_queue",
+        type=str,
+        default=None,
+        help="run as a worker of the queue directory set up by scripts/work_queue.py, until the queue is done",
+    )
+    parser.add_argument(
+        "--worker_id",
+        type=str,
+        default=None,
+        help="name of this worker in the queue (default: <hostname>-<pid>)",
+    )
+    parser.add_argument(
+        "--grid_max_images",
+        type=int,
+        default=64,
+        help="most samples in one grid, further samples start a new grid",
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=list(IMAGE_FORMATS.keys()),
+        default="png",
+        help="image format of the samples and the grid",
+    )
+    parser.add_argument(
+        "--compress_level",
+        type=int,
+        default=6,
+        help="png compression level, 0 (fastest) to 9 (smallest)",
+    )
+    parser.add_argument(
+        "--quality",
+        type=int,
+        default=95,
+        help="webp and jpeg quality, 100 is lossless for webp",
+    )
+    parser.add_argument(
+        "--writer_processes",
+        type=int,
+        default=2,
+        help="processes that watermark, encode and save images, 0 writes on a background thread",
+    )
     opt = parser.parse_args()
+    if opt.dpm_solver and opt.fast_step is not None:
+        parser.error("--fast_step is only supported by the DDIM and PLMS samplers")
+    if opt.dpm_solver and opt.deep_cache is not None:
+        parser.error("--deep_cache is only supported by the DDIM and PLMS samplers")
 
     if opt.laion400m:
         print("Falling back to LAION 400M model...")
@@ -236,13 +379,31 @@ def main():
 
     seed_everything(opt.seed)
 
+    print("Creating invisible watermark encoder (see https://github.com/ShieldMnt/invisible-watermark)...")
+    wm = "StableDiffusionV1"
+    writer = ImageWriter(format=opt.format, compress_level=opt.compress_level, quality=opt.quality,
+                         watermark=wm, processes=opt.writer_processes)
+
     config = OmegaConf.load(f"{opt.config}")
+    if opt.embeddings:
+        config.model.params.cond_stage_config = OmegaConf.create({
+            "target": "ldm.modules.encoders.embedding_store.PrecomputedEmbedder",
+            "params": {"path": opt.embeddings},
+        })
     model = load_model_from_config(config, f"{opt.ckpt}")
 
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
     model = model.to(device)
-
-    if opt.plms:
+    if opt.attention_memory_mb is not None:
+        opt.attention = "chunked"
+        set_attention_memory_budget(opt.attention_memory_mb * 2 ** 20)
+    set_attention_backend(opt.attention)
+    if opt.vae_tile_size is not None:
+        model.first_stage_model.enable_tiling(tile_size=opt.vae_tile_size, overlap=opt.vae_tile_overlap)
+
+    if opt.dpm_solver:
+        sampler = DPMSolverSampler(model)
+    elif opt.plms:
         sampler = PLMSSampler(model)
     else:
         sampler = DDIMSampler(model)
@@ -250,14 +411,22 @@ def main():
     os.makedirs(opt.outdir, exist_ok=True)
     outpath = opt.outdir
 
-    print("Creating invisible watermark encoder (see https://github.com/ShieldMnt/invisible-watermark)...")
-    wm = "StableDiffusionV1"
-    wm_encoder = WatermarkEncoder()
-    wm_encoder.set_watermark('bytes', wm.encode('utf-8'))
-
     batch_size = opt.n_samples
     n_rows = opt.n_rows if opt.n_rows > 0 else batch_size
-    if not opt.from_file:
+    manifest = None
+    if opt.work_queue:
+        worker = Worker(FileWorkQueue(opt.work_queue), worker_id=opt.worker_id)
+        print(f"worker {worker.worker_id} of the queue {opt.work_queue}")
+        opt.skip_grid = True
+    elif opt.job:
+        manifest = Manifest(opt.manifest or os.path.join(outpath, "manifest.jsonl"))
+        print(f"running job {opt.job}, {len(manifest)} items are already done")
+        opt.skip_grid = True
+    elif opt.embeddings and not opt.from_file:
+        print(f"sampling all prompts of {opt.embeddings}")
+        data = [p for p in model.cond_stage_model.store.prompts if p != ""]
+        data = list(chunk(data, batch_size))
+    elif not opt.from_file:
         prompt = opt.prompt
         assert prompt is not None
         data = [batch_size * [prompt]]
@@ -270,71 +439,130 @@ def main():
 
     sample_path = os.path.join(outpath, "samples")
     os.makedirs(sample_path, exist_ok=True)
-    base_count = len(os.listdir(sample_path))
-    grid_count = len(os.listdir(outpath)) - 1
 
     start_code = None
     if opt.fixed_code:
         start_code = torch.randn([opt.n_samples, opt.C, opt.H // opt.f, opt.W // opt.f], device=device)
 
     precision_scope = autocast if opt.precision=="autocast" else nullcontext
-    with torch.no_grad():
-        with precision_scope("cuda"):
-            with model.ema_scope():
-                tic = time.time()
-                all_samples = list()
-                for n in trange(opt.n_iter, desc="Sampling"):
-                    for prompts in tqdm(data, desc="data"):
-                        uc = None
-                        if opt.scale != 1.0:
-                            uc = model.get_learned_conditioning(batch_size * [""])
-                        if isinstance(prompts, tuple):
-                            prompts = list(prompts)
-                        c = model.get_learned_conditioning(prompts)
-                        shape = [opt.C, opt.H // opt.f, opt.W // opt.f]
-                        samples_ddim, _ = sampler.sample(S=opt.ddim_steps,
-                                                         conditioning=c,
-                                                         batch_size=opt.n_samples,
-                                                         shape=shape,
-                                                         verbose=False,
-                                                         unconditional_guidance_scale=opt.scale,
-                                                         unconditional_conditioning=uc,
-                                                         eta=opt.ddim_eta,
-                                                         x_T=start_code)
-
-                        x_samples_ddim = model.decode_first_stage(samples_ddim)
-                        x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
-                        x_samples_ddim = x_samples_ddim.cpu().permute(0, 2, 3, 1).numpy()
-
-                        x_checked_image, has_nsfw_concept = check_safety(x_samples_ddim)
-
-                        x_checked_image_torch = torch.from_numpy(x_checked_image).permute(0, 3, 1, 2)
-
-                        if not opt.skip_save:
-                            for x_sample in x_checked_image_torch:
-                                x_sample = 255. * rearrange(x_sample.cpu().numpy(), 'c h w -> h w c')
-                                img = Image.fromarray(x_sample.astype(np.uint8))
-                                img = put_watermark(img, wm_encoder)
-                                img.save(os.path.join(sample_path, f"{base_count:05}.png"))
-                                base_count += 1
-
-                        if not opt.skip_grid:
-                            all_samples.append(x_checked_image_torch)
-
-                if not opt.skip_grid:
-                    # additionally, save as grid
-                    grid = torch.stack(all_samples, 0)
-                    grid = rearrange(grid, 'n b c h w -> (n b) c h w')
-                    grid = make_grid(grid, nrow=n_rows)
-
-                    # to image
-                    grid = 255. * rearrange(grid, 'c h w -> h w c').cpu().numpy()
-                    img = Image.fromarray(grid.astype(np.uint8))
-                    img = put_watermark(img, wm_encoder)
-                    img.save(os.path.join(outpath, f'grid-{grid_count:04}.png'))
-                    grid_count += 1
-
-                toc = time.time()
+
+    @contextmanager
+    def inference_scope():
+        # grad mode and autocast are thread local and have to be entered on every pipeline thread
+        with torch.no_grad(), precision_scope("cuda"):
+            yield
+
+    shape = [opt.C, opt.H // opt.f, opt.W // opt.f]
+
+    def job_batch(items, lease=None):
+        # every item samples from its own seed, so it does not depend on the batching
+        return {"prompts": [item.prompt for item in items], "steps": items[0].steps, "scale": items[0].scale,
+                "x_T": None, "seeds": [item.seed for item in items], "items": items, "lease": lease}
+
+    def prompt_batch(index, prompts):
+        seeds = None
+        if opt.per_sample_seeds and start_code is None:
+            first = opt.seed + index * batch_size
+            seeds = list(range(first, first + len(prompts)))
+        return {"prompts": list(prompts), "steps": opt.ddim_steps, "scale": opt.scale, "x_T": start_code,
+                "seeds": seeds, "items": None, "lease": None}
+
+    if opt.work_queue:
+        batches = (job_batch(items, lease) for lease in worker.leases()
+                   for items in batch_items(lease.items, batch_size))
+        n_batches = None
+    elif opt.job:
+        items = manifest.pending(read_job(opt.job, seed=opt.seed, steps=opt.ddim_steps, scale=opt.scale))
+        batches = (job_batch(items) for items in batch_items(items, batch_size))
+        n_batches = None
+    else:
+        batches = (prompt_batch(index, prompts)
+                   for index, prompts in enumerate(prompts for n in range(opt.n_iter) for prompts in data))
+        n_batches = opt.n_iter * len(data)
+
+    def encode(batch):
+        uc = None
+        if batch["scale"] != 1.0:
+            uc = model.get_learned_conditioning(len(batch["prompts"]) * [""])
+        c = model.get_learned_conditioning(batch["prompts"])
+        return dict(batch, uc=uc, c=c)
+
+    def sample(batch):
+        samples_ddim, intermediates = sampler.sample(S=batch["steps"],
+                                                     conditioning=batch["c"],
+                                                     batch_size=len(batch["prompts"]),
+                                                     shape=shape,
+                                                     verbose=False,
+                                                     unconditional_guidance_scale=batch["scale"],
+                                                     unconditional_conditioning=batch["uc"],
+                                                     eta=opt.ddim_eta,
+                                                     x_T=batch["x_T"],
+                                                     seeds=batch["seeds"],
+                                                     fast_step=opt.fast_step or False,
+                                                     kv_cache=opt.kv_cache,
+                                                     deep_cache_interval=opt.deep_cache)
+        if "deep_cache" in intermediates:
+            print(intermediates["deep_cache"])
+        return batch, samples_ddim
+
+    def decode(batch_samples):
+        batch, samples_ddim = batch_samples
+        x_samples_ddim = model.decode_first_stage(samples_ddim)
+        x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
+        x_samples_ddim = x_samples_ddim.cpu().permute(0, 2, 3, 1).numpy()
+
+        x_checked_image, has_nsfw_concept = check_safety(x_samples_ddim)
+
+        return batch, torch.from_numpy(x_checked_image).permute(0, 3, 1, 2)
+
+    def save(batch_images):
+        batch, x_checked_image_torch = batch_images
+        x_samples = 255. * rearrange(x_checked_image_torch.cpu().numpy(), 'b c h w -> b h w c')
+        x_samples = x_samples.astype(np.uint8)
+        items = batch["items"]
+        if items is not None:
+            # items count as done once their image is on disk
+            def on_done(paths):
+                if manifest is not None:
+                    manifest.add([{"id": item.id, "seed": item.seed, "file": path} for item, path in zip(items, paths)])
+                if batch["lease"] is not None:
+                    batch["lease"].count_done(len(items))
+            writer.write(x_samples, sample_path, names=[item.name for item in items], on_done=on_done)
+        elif not opt.skip_save:
+            writer.write(x_samples, sample_path)
+        return x_samples
+
+    # text encoding of the next batch and decoding/saving of the previous batch overlap with sampling
+    pipeline = Pipeline([("encode", encode), ("sample", sample), ("decode", decode), ("save", save)],
+                        queue_size=opt.pipeline_depth, thread_context=inference_scope)
+    # additionally, save as grids, assembled as the samples come in
+    grid = GridAssembler(lambda img: writer.write(img[None], outpath, prefix="grid-", digits=4),
+                         nrow=n_rows, max_images=opt.grid_max_images)
+
+    profiler = None
+    if opt.profile or opt.profile_trace is not None:
+        profiler = ModuleProfiler({"unet": model.model.diffusion_model, "vae": model.first_stage_model.decoder},
+                                  trace=opt.profile_trace is not None)
+
+    with model.ema_scope(), profiler or nullcontext():
+        tic = time.time()
+        for x_samples in tqdm(pipeline.run(batches), desc="Sampling", total=n_batches):
+            if not opt.skip_grid:
+                grid.add(x_samples)
+        grid.flush()
+
+        toc = time.time()
+
+    writer.close()
+    if manifest is not None:
+        manifest.close()
+    if opt.work_queue:
+        worker.close()
+    print(pipeline.report())
+    if profiler is not None:
+        print(profiler.table(by_type=True))
+        if opt.profile_trace is not None:
+            profiler.export_chrome_trace(opt.profile_trace)
 
     print(f"Your samples are ready and waiting for you here: \n{outpath} \n"
           f" \nEnjoy.")
@@ -0,0 +1,51 @@
+"""
+Coordinator of a distributed txt2img job. Splits a job file (see txt2img.py --job) into chunks on a shared
+filesystem queue, then watches the workers and puts the chunks of workers without a heartbeat back into the queue
+until every chunk is done. Start any number of workers, on this or other machines that share the queue directory:
+
+    python scripts/work_queue.py --job prompts.txt --queue /shared/queue --chunk_size 16
+    python scripts/txt2img.py --work_queue /shared/queue --outdir /shared/outputs --plms
+
+Restarting the coordinator on an existing queue only resumes watching it.
+"""
+import argparse
+import time
+
+from ldm.inference.jobs import read_job
+from ldm.inference.workqueue import FileWorkQueue
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--job", type=str, required=True, help="job file, one prompt or JSON item per line")
+    parser.add_argument("--queue", type=str, required=True, help="queue directory shared with the workers")
+    parser.add_argument("--chunk_size", type=int, default=16, help="items per chunk, the unit of leasing")
+    parser.add_argument("--seed", type=int, default=42, help="seed of items without one, plus their line number")
+    parser.add_argument("--steps", type=int, default=50, help="sampling steps of items without steps")
+    parser.add_argument("--scale", type=float, default=7.5, help="guidance scale of items without a scale")
+    parser.add_argument("--lease_timeout", type=float, default=120.,
+                        help="seconds without a heartbeat after which a worker's chunk is given to another worker")
+    parser.add_argument("--poll_interval", type=float, default=10.)
+    opt = parser.parse_args()
+
+    queue = FileWorkQueue(opt.queue)
+    if sum(queue.status().values()) == 0:
+        n_chunks = queue.put(read_job(opt.job, seed=opt.seed, steps=opt.steps, scale=opt.scale),
+                             chunk_size=opt.chunk_size)
+        print(f"queued {n_chunks} chunks of {opt.job} in {opt.queue}")
+    else:
+        print(f"resuming {opt.queue}: {queue.status()}")
+
+    tic = time.time()
+    while not queue.finished():
+        requeued = queue.requeue_expired(opt.lease_timeout)
+        if requeued:
+            print(f"requeued expired chunks {requeued}")
+        status = queue.status()
+        print(f"[{time.time() - tic:8.0f}s] todo {status['todo']}, leased {status['leased']}, done {status['done']}")
+        time.sleep(opt.poll_interval)
+    print(f"all {queue.status()['done']} chunks done")
+
+
+if __name__ == "__main__":
+    main()